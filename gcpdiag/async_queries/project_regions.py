@@ -2,6 +2,7 @@
 
 from typing import Any, Iterable, List, Mapping, Optional
 
+from gcpdiag import caching
 from gcpdiag.async_queries.utils import loader, protocols
 
 
@@ -28,6 +29,11 @@ class ProjectRegions:
     resp = await self.call_api()
     self.regions = self.parse_resp(resp)
 
+  def __cache_key__(self) -> bytes:
+    # All gateways of a project share the cached API response.
+    return self.project_id.encode()
+
+  @caching.async_cached_api_call
   async def call_api(self) -> Any:
     return await self.api.call(
       method='GET',
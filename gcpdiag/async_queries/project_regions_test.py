@@ -1,8 +1,10 @@
 "Tests for gcpdiag.async_queries.ProjectRegions"
 
+import tempfile
 from asyncio import gather
-from unittest import IsolatedAsyncioTestCase
+from unittest import IsolatedAsyncioTestCase, mock
 
+from gcpdiag import caching
 from gcpdiag.async_queries.utils import fake_api
 
 from .project_regions import ProjectRegions
@@ -12,6 +14,13 @@ class TestProjectRegions(IsolatedAsyncioTestCase):
   "Tests for gcpdiag.async_queries.ProjectRegions"
 
   def setUp(self) -> None:
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    cache = caching.SQLiteCache(temp_dir.name)
+    self.addCleanup(cache.close)
+    patcher = mock.patch('gcpdiag.caching.get_disk_cache', return_value=cache)
+    patcher.start()
+    self.addCleanup(patcher.stop)
     self.call = fake_api.APICall(
       'GET', 'https://compute.googleapis.com/compute/v1/projects/test-project/regions', None
     )
@@ -27,3 +36,9 @@ class TestProjectRegions(IsolatedAsyncioTestCase):
   async def test_deduplication(self) -> None:
     await gather(self.project_regions.get_all(), self.project_regions.get_all())
     self.assertEqual(self.api.count_calls(self.call), 1)
+
+  async def test_cached_across_gateways(self) -> None:
+    other_gateway = ProjectRegions(api=self.api, project_id='test-project')
+    await gather(self.project_regions.get_all(), other_gateway.get_all())
+    await ProjectRegions(api=self.api, project_id='test-project').get_all()
+    self.assertEqual(self.api.count_calls(self.call), 1)
@@ -0,0 +1,90 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache command to export and import snapshots of the API cache.
+
+A snapshot contains the results of all cached API calls of a `gcpdiag lint`
+or `gcpdiag runbook` execution that used --cache-record. An imported snapshot
+is used by executions with --cache-readonly, which don't call the APIs.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+
+from gcpdiag import caching, config
+
+
+def _init_cache_args_parser() -> argparse.ArgumentParser:
+  """Initialize and return the argument parser for the cache command."""
+  parser = argparse.ArgumentParser(
+    description='Export and import snapshots of the API cache', prog='gcpdiag cache'
+  )
+  parser.add_argument(
+    '-v', '--verbose', action='count', default=config.get('verbose'), help='Increase log verbosity'
+  )
+  subparsers = parser.add_subparsers(dest='action', metavar='ACTION', required=True)
+
+  export_parser = subparsers.add_parser(
+    'export', help='Export the snapshot recorded by the last execution with --cache-record'
+  )
+  export_parser.add_argument(
+    '--project', metavar='P', required=True, help='Project ID of the snapshot to export'
+  )
+  export_parser.add_argument('file', metavar='FILE', help='Output file (must not exist)')
+
+  import_parser = subparsers.add_parser(
+    'import', help='Import a snapshot, to be used with --cache-readonly'
+  )
+  import_parser.add_argument('file', metavar='FILE', help='Snapshot file created by export')
+  import_parser.add_argument(
+    '--allow-pickle',
+    action='store_true',
+    help=(
+      'Import the entries serialized with pickle, which can execute code when they are read.'
+      ' Only use this with snapshots from a trusted source'
+    ),
+  )
+  return parser
+
+
+def run(argv) -> None:
+  parser = _init_cache_args_parser()
+  args = parser.parse_args(argv[1:])
+  config.init(vars(args))
+  logging.basicConfig(level=logging.DEBUG if config.get('verbose') >= 2 else logging.INFO)
+
+  cache = caching.get_disk_cache()
+  try:
+    if args.action == 'export':
+      count = cache.export_snapshot(args.project, args.file)
+      if not count:
+        os.remove(args.file)
+        print(
+          f'ERROR: no cache snapshot for project {args.project}. Run gcpdiag lint or'
+          ' gcpdiag runbook with --cache-record first.',
+          file=sys.stderr,
+        )
+        sys.exit(1)
+      print(f'Exported {count} cached API results of project {args.project} to {args.file}')
+    else:
+      project, count = cache.import_snapshot(args.file, allow_pickle=args.allow_pickle)
+      print(
+        f'Imported {count} cached API results of project {project}. Use --cache-readonly'
+        ' to run gcpdiag with them.'
+      )
+  except (OSError, ValueError, KeyError, sqlite3.Error) as err:
+    print(f'ERROR: {err}', file=sys.stderr)
+    sys.exit(1)
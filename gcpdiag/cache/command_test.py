@@ -0,0 +1,71 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test gcpdiag cache command"""
+
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from gcpdiag import caching
+from gcpdiag.cache import command as cache_cmd
+
+
+class TestGcpdiagCacheCommand(unittest.TestCase):
+  """Unit tests for the gcpdiag cache command."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.path = pathlib.Path(self.temp_dir.name)
+    self.source = caching.SQLiteCache(self.path / 'source')
+    self.target = caching.SQLiteCache(self.path / 'target')
+    self.addCleanup(self.source.close)
+    self.addCleanup(self.target.close)
+
+  def _run(self, cache, *argv):
+    with mock.patch('gcpdiag.caching.get_disk_cache', return_value=cache):
+      cache_cmd.run(['gcpdiag cache', *argv])
+
+  def test_parse_args(self):
+    parser = cache_cmd._init_cache_args_parser()
+    args = parser.parse_args(['export', '--project', 'p1', 'out.db'])
+    self.assertEqual((args.action, args.project, args.file), ('export', 'p1', 'out.db'))
+    with self.assertRaises(SystemExit):
+      parser.parse_args(['export', 'out.db'])
+
+  def test_export_import(self):
+    self.source.set(b'key', 'value', tag='tmp')
+    self.source.retain_snapshot('p1', [b'key'])
+    snapshot = str(self.path / 'p1.db')
+    self._run(self.source, 'export', '--project', 'p1', snapshot)
+    # the value is serialized with pickle
+    with self.assertRaises(SystemExit) as cm:
+      self._run(self.target, 'import', snapshot)
+    self.assertEqual(cm.exception.code, 1)
+    self._run(self.target, 'import', '--allow-pickle', snapshot)
+    self.target.readonly = True
+    self.assertEqual(self.target.get(b'key'), 'value')
+
+  def test_export_without_snapshot(self):
+    snapshot = self.path / 'p1.db'
+    with self.assertRaises(SystemExit) as cm:
+      self._run(self.source, 'export', '--project', 'p1', str(snapshot))
+    self.assertEqual(cm.exception.code, 1)
+    self.assertFalse(snapshot.exists())
+
+  def test_import_missing_file(self):
+    with self.assertRaises(SystemExit) as cm:
+      self._run(self.target, 'import', str(self.path / 'missing.db'))
+    self.assertEqual(cm.exception.code, 1)
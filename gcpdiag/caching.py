@@ -15,29 +15,423 @@
 # Lint as: python3
 """Persistent caching using SQLite3."""
 
+import asyncio
 import atexit
+import collections
+import concurrent.futures
 import contextlib
 import functools
 import hashlib
+import importlib
+import itertools
+import json
 import logging
+import lzma
+import math
+import os
 import pathlib
 import pickle
 import shutil
 import sqlite3
+import sys
 import tempfile
 import threading
 import time
 import weakref
-from typing import List, Optional
+import zlib
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import googleapiclient.errors
 import googleapiclient.http
 
-from gcpdiag import config
+from gcpdiag import config, executor, fingerprints, models, profiling, tracing, utils
 
 _cache: Optional['SQLiteCache'] = None
+_memory_cache: Optional['MemoryCache'] = None
 _bypass_cache = False
 _use_cache = True
+# Projects of this execution, and whether their cache entries are recorded as
+# snapshots, or the execution is replayed from the cache (see configure_session).
+_session_projects: List[str] = []
+_session_record = False
+_readonly = False
+# Keys used by cached_api_call functions while recording.
+_session_keys: Set[bytes] = set()
+
+
+class _ConnectionManager:
+  """Keeps one SQLite connection per thread and per database path.
+
+  Opening a connection (and setting it up) is relatively expensive compared to
+  a single cache lookup, so we keep the connections open for the whole life of
+  the process and close them at exit. Connections are only ever used by the
+  thread that created them, but they can be closed from any thread.
+  """
+
+  def __init__(self):
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    # (thread ident, db path) -> connection, used to close connections
+    # of other threads and of threads that are not running anymore.
+    self._connections: Dict[Tuple[int, str], sqlite3.Connection] = {}
+    # incremented every time that connections are closed, so that threads
+    # know that their thread-local connections must not be used anymore.
+    self._epoch = 0
+    self._forked_connections: List[sqlite3.Connection] = []
+
+  def get(self, db_path) -> sqlite3.Connection:
+    """Return the connection of the current thread for `db_path`."""
+    local = self._local
+    if getattr(local, 'epoch', None) != self._epoch:
+      local.connections = {}
+      local.epoch = self._epoch
+    db_path = str(db_path)
+    conn = local.connections.get(db_path)
+    if conn is None:
+      conn = self._connect(db_path)
+      local.connections[db_path] = conn
+    return conn
+
+  def _connect(self, db_path: str) -> sqlite3.Connection:
+    key = (threading.get_ident(), db_path)
+    with self._lock:
+      conn = self._connections.get(key)
+      if conn is None:
+        self._close_dead_threads_locked()
+        conn = sqlite3.connect(db_path, timeout=30.0, check_same_thread=False)
+        self._connections[key] = conn
+    return conn
+
+  def _close_dead_threads_locked(self):
+    alive = {t.ident for t in threading.enumerate()}
+    for key in [k for k in self._connections if k[0] not in alive]:
+      self._connections.pop(key).close()
+
+  def close(self, db_path=None) -> None:
+    """Close all connections (of all threads) to `db_path`, or all of them."""
+    with self._lock:
+      for key in list(self._connections):
+        if db_path is None or key[1] == str(db_path):
+          self._connections.pop(key).close()
+      self._epoch += 1
+
+  def reset_after_fork(self) -> None:
+    """Forget the connections inherited from the parent process.
+
+    SQLite connections must not be used across a fork(), and closing them in
+    the child could release locks that the parent still holds, so we just
+    keep them referenced and never touch them again.
+    """
+    self._forked_connections.extend(self._connections.values())
+    self._connections = {}
+    self._lock = threading.Lock()
+    self._epoch += 1
+
+
+_connections = _ConnectionManager()
+atexit.register(_connections.close)
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_connections.reset_after_fork)
+
+# Columns added to the cache table after its first version, migrated on open.
+_CACHE_ADDED_COLUMNS = [
+  ('size', 'INTEGER NOT NULL DEFAULT 0'),
+  ('atime', 'REAL NOT NULL DEFAULT 0'),
+  ('hits', 'INTEGER NOT NULL DEFAULT 0'),
+  ('codec', "TEXT NOT NULL DEFAULT ''"),
+  ('serializer', "TEXT NOT NULL DEFAULT 'pickle'"),
+]
+# ORDER BY clause used to select eviction candidates, per eviction policy.
+_EVICTION_ORDER = {'lru': 'atime', 'lfu': 'hits, atime'}
+# Maximum number of entries evicted by a single write.
+_EVICTION_BATCH = 32
+# Number of buffered cache hits after which access stats are written.
+_TOUCHES_FLUSH_THRESHOLD = 100
+# Buffered writes are written in a single transaction when there are that
+# many of them, or when the oldest one is that old (checked on every write).
+_WRITE_BATCH_SIZE = 500
+_WRITE_BATCH_SECONDS = 1.0
+# Number of rows read per query when iterating over a SQLiteDeque.
+_DEQUE_PAGE_SIZE = 500
+# Tag of the entries retained for a cache snapshot of a project (see
+# SQLiteCache.retain_snapshot). These entries are only visible in read-only
+# mode.
+_SNAPSHOT_TAG_PREFIX = 'snapshot:'
+# Entries of recorded snapshots that weren't exported yet, which are neither
+# expired nor evicted.
+_PINNED_KEYS = 'SELECT key FROM snapshot_keys WHERE pinned'
+# Version of the format of exported snapshot files.
+_SNAPSHOT_FORMAT_VERSION = 1
+
+
+class _AgeFlusher:
+  """Flushes the write buffers whose oldest row is older than their max_age,
+  also when no further writes arrive, so that other processes see the rows.
+
+  A single daemon thread serves all the buffers of the process, which are
+  referenced weakly.
+  """
+
+  def __init__(self):
+    self._cond = threading.Condition()
+    self._deadlines: 'weakref.WeakKeyDictionary[_WriteBuffer, float]' = weakref.WeakKeyDictionary()
+    self._thread: Optional[threading.Thread] = None
+
+  def schedule(self, buffer: '_WriteBuffer', deadline: float):
+    """Flushes `buffer` at `deadline` (time.monotonic() value)."""
+    with self._cond:
+      self._deadlines[buffer] = min(deadline, self._deadlines.get(buffer, deadline))
+      if self._thread is None or not self._thread.is_alive():
+        self._thread = threading.Thread(target=self._run, name='cache-write-flusher', daemon=True)
+        self._thread.start()
+      self._cond.notify()
+
+  def _run(self):
+    while True:
+      with self._cond:
+        now = time.monotonic()
+        due = [b for b, deadline in list(self._deadlines.items()) if deadline <= now]
+        for buffer in due:
+          del self._deadlines[buffer]
+        if not due:
+          next_deadline = min(self._deadlines.values(), default=None)
+          self._cond.wait(None if next_deadline is None else next_deadline - now)
+          continue
+      for buffer in due:
+        try:
+          buffer.flush()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+          logging.error("can't write buffered cache rows: %s", err)
+
+  def reset_after_fork(self):
+    # The thread doesn't exist in the child, and might have held the lock.
+    self._cond = threading.Condition()
+    self._thread = None
+
+
+_age_flusher = _AgeFlusher()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_age_flusher.reset_after_fork)
+
+
+class _WriteBuffer:
+  """Groups writes to a SQLite database into executemany() transactions.
+
+  Rows are buffered by key (a later write of the same key replaces the
+  buffered one) and handed to `write` in insertion order, when there are
+  `max_rows` of them, when the oldest one is older than `max_age` seconds
+  (by the next write, or else by a background thread, see _AgeFlusher), or
+  when flush() is called. Owners must flush before reading rows that might be
+  buffered.
+  """
+
+  def __init__(
+    self,
+    write: Callable[[List[tuple]], None],
+    max_rows: int = _WRITE_BATCH_SIZE,
+    max_age: float = _WRITE_BATCH_SECONDS,
+  ):
+    self._write = write
+    self.max_rows = max_rows
+    self.max_age = max_age
+    self._rows: Dict[Any, tuple] = {}
+    self._oldest: Optional[float] = None
+    # Held while writing, so that batches are written in order.
+    self._lock = threading.Lock()
+
+  def add(self, key, row: tuple):
+    with self._lock:
+      self._rows.pop(key, None)
+      self._rows[key] = row
+      now = time.monotonic()
+      if self._oldest is None:
+        self._oldest = now
+        _age_flusher.schedule(self, now + self.max_age)
+      if len(self._rows) >= self.max_rows or now - self._oldest >= self.max_age:
+        self._flush_locked()
+
+  def flush(self):
+    if self._rows:
+      with self._lock:
+        self._flush_locked()
+
+  def write_through(self, rows: List[tuple]):
+    """Writes the buffered rows followed by `rows` without buffering them."""
+    with self._lock:
+      self._flush_locked(rows)
+
+  def _flush_locked(self, extra_rows: Iterable[tuple] = ()):
+    rows = list(self._rows.values())
+    rows.extend(extra_rows)
+    self._rows = {}
+    self._oldest = None
+    if rows:
+      self._write(rows)
+
+  def __contains__(self, key) -> bool:
+    return key in self._rows
+
+  def __len__(self) -> int:
+    return len(self._rows)
+
+
+def _zstd_codec() -> Optional[Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]]:
+  try:
+    # zstandard is an optional dependency.
+    # pylint: disable=import-outside-toplevel
+    import zstandard  # type: ignore
+  except ImportError:
+    return None
+  return zstandard.compress, zstandard.decompress
+
+
+# Compression codecs for cached values: name -> (compress, decompress). The
+# name is stored with every row, so that rows written with any codec can still
+# be read after the configuration changes. '' means uncompressed.
+_CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+  '': (bytes, bytes),
+  'zlib': (zlib.compress, zlib.decompress),
+  'lzma': (lzma.compress, lzma.decompress),
+}
+_zstd = _zstd_codec()
+if _zstd:
+  _CODECS['zstd'] = _zstd
+
+# Key used to mark serialized models.Resource objects in JSON cache values.
+_JSON_RESOURCE_MARKER = '__gcpdiag_resource__'
+_JSON_SCALAR_TYPES = frozenset([str, int, bool, type(None)])
+
+
+class _NotJsonError(Exception):
+  pass
+
+
+def _to_json_value(value):
+  """Return a structure that JSON round-trips exactly, or raise _NotJsonError.
+
+  Only exact JSON types are accepted (no tuples, subclasses or non-str keys),
+  plus models.Resource objects whose attributes are JSON values themselves.
+  Containers are only copied if they contain resources. Attributes computed
+  by functools.cached_property are not stored, they will be computed again
+  when needed.
+  """
+  value_type = type(value)
+  if value_type in _JSON_SCALAR_TYPES:
+    return value
+  if value_type is float:
+    if not math.isfinite(value):
+      raise _NotJsonError()
+    return value
+  if value_type is list:
+    result = value
+    for i, v in enumerate(value):
+      if type(v) in _JSON_SCALAR_TYPES:
+        continue
+      converted = _to_json_value(v)
+      if converted is not v:
+        if result is value:
+          result = list(value)
+        result[i] = converted
+    return result
+  if value_type is dict:
+    if _JSON_RESOURCE_MARKER in value:
+      raise _NotJsonError()
+    result = value
+    for k, v in value.items():
+      if type(k) is not str:
+        raise _NotJsonError()
+      if type(v) in _JSON_SCALAR_TYPES:
+        continue
+      converted = _to_json_value(v)
+      if converted is not v:
+        if result is value:
+          result = dict(value)
+        result[k] = converted
+    return result
+  if isinstance(value, models.Resource):
+    state = {
+      k: _to_json_value(v)
+      for k, v in vars(value).items()
+      if not isinstance(getattr(value_type, k, None), functools.cached_property)
+    }
+    return {
+      _JSON_RESOURCE_MARKER: f'{value_type.__module__}:{value_type.__qualname__}',
+      'state': state,
+    }
+  raise _NotJsonError()
+
+
+@functools.lru_cache(maxsize=None)
+def _json_resource_class(path: str) -> type:
+  module_name, qualname = path.split(':')
+  if not module_name.startswith('gcpdiag.'):
+    raise ValueError(f'not a gcpdiag resource: {path}')
+  cls = importlib.import_module(module_name)
+  for name in qualname.split('.'):
+    cls = getattr(cls, name)
+  if not (isinstance(cls, type) and issubclass(cls, models.Resource)):
+    raise ValueError(f'not a gcpdiag resource: {path}')
+  return cls
+
+
+def _from_json_value(value):
+  """Rebuild the models.Resource objects serialized by _to_json_value."""
+  if type(value) is list:
+    for i, v in enumerate(value):
+      if type(v) in (dict, list):
+        value[i] = _from_json_value(v)
+  elif type(value) is dict:
+    if _JSON_RESOURCE_MARKER in value:
+      cls = _json_resource_class(value[_JSON_RESOURCE_MARKER])
+      resource = cls.__new__(cls)
+      resource.__dict__.update(_from_json_value(value['state']))
+      return resource
+    for k, v in value.items():
+      if type(v) in (dict, list):
+        value[k] = _from_json_value(v)
+  return value
+
+
+def _orjson_module():
+  try:
+    # orjson is an optional dependency, used to speed up JSON serialization.
+    # pylint: disable=import-outside-toplevel
+    import orjson  # type: ignore
+  except ImportError:
+    return None
+  return orjson
+
+
+_orjson = _orjson_module()
+
+
+def _json_dumps(value) -> Optional[bytes]:
+  """Serialize a JSON-shaped value as compact UTF-8 JSON, or return None."""
+  try:
+    value = _to_json_value(value)
+    if _orjson:
+      return _orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, allow_nan=False).encode(
+      'utf-8'
+    )
+  except (_NotJsonError, UnicodeEncodeError, RecursionError, TypeError):
+    return None
+
+
+def _json_loads(data: bytes):
+  value = _orjson.loads(data) if _orjson else json.loads(data)
+  if _JSON_RESOURCE_MARKER.encode() in data:
+    value = _from_json_value(value)
+  return value
+
+
+# Serializers for cached values: name -> (dumps, loads). dumps returns None if
+# it can't serialize a value, in which case the value is pickled instead.
+_SERIALIZERS: Dict[str, Tuple[Callable[[Any], Optional[bytes]], Callable[[bytes], Any]]] = {
+  'pickle': (pickle.dumps, pickle.loads),
+  'json': (_json_dumps, _json_loads),
+}
 
 
 class SQLiteCache:
@@ -45,35 +439,158 @@ class SQLiteCache:
 
   This is a replacement for diskcache that is built into the google3 python
   standard library.
-  This implementation lacks a size limit or an LRU eviction policy. The cache
-  file will grow unbounded unless entries expire on their own or are explicitly
-  evicted.
+
+  The cache can optionally be bounded by total value size and/or number of
+  entries. When a write brings the cache above its budget, a small batch of
+  entries is evicted (expired entries first, then according to the 'lru' or
+  'lfu' policy), so that no single call pays for a full-table sweep. Totals
+  are maintained by triggers, so they are also correct when multiple
+  processes share the same cache file.
+
+  Values are serialized with `serializer`: 'json' stores JSON-shaped values
+  (API responses and the models.Resource objects wrapping them) as compact
+  JSON and falls back to pickle for everything else, 'pickle' always uses
+  pickle. Values bigger than `compression_min_bytes` are then compressed with
+  the `compression` codec ('zlib', 'lzma' or 'zstd' if the zstandard module is
+  installed), unless that doesn't make them smaller.
+
+  With `write_batch_size` > 1, set() only encodes the value and buffers the
+  row; buffered rows are written in a single transaction when there are
+  `write_batch_size` of them or after _WRITE_BATCH_SECONDS, and before the key
+  is read again. Other processes only see the rows once they are written.
+
+  Entries of a project can be retained as a snapshot, exported to a file and
+  imported in another cache (see retain_snapshot, export_snapshot and
+  import_snapshot). Snapshot entries are only returned by a `readonly` cache,
+  which also returns expired entries and never writes.
   """
 
-  def __init__(self, directory: str, tag_index: bool = True):
+  def __init__(
+    self,
+    directory: str,
+    tag_index: bool = True,
+    max_size_bytes: Optional[int] = None,
+    max_entries: Optional[int] = None,
+    eviction_policy: str = 'lru',
+    compression: Optional[str] = None,
+    compression_min_bytes: int = 0,
+    serializer: str = 'pickle',
+    write_batch_size: int = 1,
+    readonly: bool = False,
+  ):
     del tag_index  # Unused
+    if eviction_policy not in _EVICTION_ORDER:
+      raise ValueError(f'unknown cache eviction policy: {eviction_policy}')
+    compression = compression or ''
+    if compression == 'zstd' and 'zstd' not in _CODECS:
+      logging.warning('zstandard module not installed, using zlib compression for the cache')
+      compression = 'zlib'
+    if compression not in _CODECS:
+      raise ValueError(f'unknown cache compression: {compression}')
+    if serializer not in _SERIALIZERS:
+      raise ValueError(f'unknown cache serializer: {serializer}')
     path = pathlib.Path(directory)
     # Restrict cache directory permissions to owner to mitigate pickle insecurity.
     path.mkdir(mode=0o700, parents=True, exist_ok=True)
     path.chmod(0o700)
     self.db_path = path / 'sqlite_cache.db'
+    self.max_size_bytes = max_size_bytes
+    self.max_entries = max_entries
+    self.eviction_policy = eviction_policy
+    self.compression = compression
+    self.compression_min_bytes = compression_min_bytes
+    self.serializer = serializer
+    self.readonly = readonly
+    # key -> (last access time, number of accesses) not yet written to the db.
+    # Access tracking is buffered so that reads don't need a write transaction.
+    self._touches: Dict[bytes, Tuple[float, int]] = {}
+    self._touches_lock = threading.Lock()
+    # Writes are buffered and written in batches if write_batch_size > 1.
+    self._writes = (
+      _WriteBuffer(self._write_rows, max_rows=write_batch_size) if write_batch_size > 1 else None
+    )
     self._init_db()
 
+  def _conn(self) -> sqlite3.Connection:
+    return _connections.get(self.db_path)
+
   def _init_db(self):
-    """Initializes the SQLite database and creates the cache table and indexes."""
-    with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-      with conn:
-        conn.execute('PRAGMA journal_mode=WAL;')
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS cache (
-                key BLOB PRIMARY KEY,
-                value BLOB,
-                expire REAL,
-                tag TEXT
-            );
-        """)
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_tag ON cache(tag);')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_expire ON cache(expire);')
+    """Initializes the SQLite database and creates the cache table and indexes.
+
+    Databases created by older versions are migrated in place.
+    """
+    conn = self._conn()
+    conn.execute('PRAGMA journal_mode=WAL;')
+    with conn:
+      conn.execute('BEGIN IMMEDIATE')
+      conn.execute("""
+          CREATE TABLE IF NOT EXISTS cache (
+              key BLOB PRIMARY KEY,
+              value BLOB,
+              expire REAL,
+              tag TEXT,
+              size INTEGER NOT NULL DEFAULT 0,
+              atime REAL NOT NULL DEFAULT 0,
+              hits INTEGER NOT NULL DEFAULT 0,
+              codec TEXT NOT NULL DEFAULT '',
+              serializer TEXT NOT NULL DEFAULT 'pickle'
+          );
+      """)
+      columns = {row[1] for row in conn.execute('PRAGMA table_info(cache)')}
+      for name, definition in _CACHE_ADDED_COLUMNS:
+        if name not in columns:
+          conn.execute(f'ALTER TABLE cache ADD COLUMN {name} {definition}')
+      if 'size' not in columns:
+        conn.execute('UPDATE cache SET size = length(value), atime = ?', (time.time(),))
+      conn.execute('CREATE INDEX IF NOT EXISTS idx_tag ON cache(tag);')
+      conn.execute('CREATE INDEX IF NOT EXISTS idx_expire ON cache(expire);')
+      conn.execute('CREATE INDEX IF NOT EXISTS idx_atime ON cache(atime);')
+      conn.execute('CREATE INDEX IF NOT EXISTS idx_hits ON cache(hits, atime);')
+      conn.execute("""
+          CREATE TABLE IF NOT EXISTS cache_totals (
+              id INTEGER PRIMARY KEY CHECK (id = 0),
+              entries INTEGER NOT NULL,
+              size INTEGER NOT NULL
+          );
+      """)
+      conn.execute('INSERT OR IGNORE INTO cache_totals SELECT 0, COUNT(*), TOTAL(size) FROM cache')
+      conn.execute("""
+          CREATE TABLE IF NOT EXISTS snapshot_keys (
+              project TEXT NOT NULL,
+              key BLOB NOT NULL,
+              pinned INTEGER NOT NULL DEFAULT 0,
+              PRIMARY KEY (project, key)
+          );
+      """)
+      columns = {row[1] for row in conn.execute('PRAGMA table_info(snapshot_keys)')}
+      if 'pinned' not in columns:
+        conn.execute('ALTER TABLE snapshot_keys ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0')
+      conn.execute('CREATE INDEX IF NOT EXISTS idx_pinned ON snapshot_keys(key) WHERE pinned;')
+      conn.execute("""
+          CREATE TABLE IF NOT EXISTS leases (
+              key BLOB PRIMARY KEY,
+              owner TEXT NOT NULL,
+              expire REAL NOT NULL
+          );
+      """)
+      conn.execute("""
+          CREATE TRIGGER IF NOT EXISTS cache_totals_insert AFTER INSERT ON cache
+          BEGIN
+            UPDATE cache_totals SET entries = entries + 1, size = size + NEW.size;
+          END;
+      """)
+      conn.execute("""
+          CREATE TRIGGER IF NOT EXISTS cache_totals_delete AFTER DELETE ON cache
+          BEGIN
+            UPDATE cache_totals SET entries = entries - 1, size = size - OLD.size;
+          END;
+      """)
+      conn.execute("""
+          CREATE TRIGGER IF NOT EXISTS cache_totals_update AFTER UPDATE OF size ON cache
+          BEGIN
+            UPDATE cache_totals SET size = size - OLD.size + NEW.size;
+          END;
+      """)
 
   def get(self, key: bytes, default=None):
     """Retrieves a value from the cache.
@@ -85,22 +602,44 @@ class SQLiteCache:
     Returns:
       The cached value if found and not expired, otherwise the default value.
     """
+    entry = self.get_entry(key)
+    return entry[0] if entry else default
+
+  def get_entry(self, key: bytes) -> Optional[Tuple[Any, int, Optional[float]]]:
+    """Retrieves a value from the cache together with its metadata.
+
+    Returns:
+      None if the key is not found or has expired, otherwise a tuple with the
+      cached value, its serialized (uncompressed) size and its expiration
+      timestamp (None if it doesn't expire).
+    """
+    if self._writes is not None and key in self._writes:
+      self._writes.flush()
     now = time.time()
     try:
-      with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-        with conn:
-          cur = conn.cursor()
-          cur.execute('SELECT value, expire FROM cache WHERE key = ?', (sqlite3.Binary(key),))
-          row = cur.fetchone()
-          if row:
-            value_bytes, expire = row
-            if expire is not None and expire < now:
-              return default
-            return pickle.loads(value_bytes)
-          return default
+      with self._conn() as conn:
+        cur = conn.execute(
+          'SELECT value, expire, codec, serializer, tag FROM cache WHERE key = ?',
+          (sqlite3.Binary(key),),
+        )
+        row = cur.fetchone()
+      if row:
+        value_bytes, expire, codec, serializer, tag = row
+        if not self.readonly:
+          if expire is not None and expire < now:
+            return None
+          if tag and tag.startswith(_SNAPSHOT_TAG_PREFIX):
+            return None
+        if codec not in _CODECS or serializer not in _SERIALIZERS:
+          logging.debug('cache entry with unsupported format %s/%s, ignoring', serializer, codec)
+          return None
+        self._touch(key, now)
+        data = _CODECS[codec][1](value_bytes) if codec else value_bytes
+        return _SERIALIZERS[serializer][1](data), len(data), expire
+      return None
     except (sqlite3.Error, Exception) as e:
       logging.error('SQLiteCache.get error: %s', e)
-      return default
+      return None
 
   def set(self, key: bytes, value, expire=None, tag=None):
     """Stores a value in the cache.
@@ -111,23 +650,146 @@ class SQLiteCache:
       expire: Optional. The number of seconds from now when the cache entry
         should expire. If None, the entry will persist until explicitly evicted.
       tag: Optional. A string tag to group cache entries for eviction.
+
+    Returns:
+      The serialized (uncompressed) size of the value.
     """
+    if self.readonly:
+      return 0
     now = time.time()
     expire_time = (now + expire) if expire is not None else None
-    value_bytes = pickle.dumps(value)
+    value_bytes, codec, serializer, size = self._encode(value)
+    row = (
+      sqlite3.Binary(key),
+      sqlite3.Binary(value_bytes),
+      expire_time,
+      tag,
+      len(value_bytes),
+      now,
+      codec,
+      serializer,
+    )
+    if self._writes is not None:
+      self._writes.add(key, row)
+    else:
+      self._write_rows([row])
+    return size
+
+  def _write_rows(self, rows: List[tuple]):
     try:
-      with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-        with conn:
-          conn.execute(
-            """
-              INSERT OR REPLACE INTO cache (key, value, expire, tag)
-              VALUES (?, ?, ?, ?)
-              """,
-            (sqlite3.Binary(key), sqlite3.Binary(value_bytes), expire_time, tag),
-          )
+      with self._conn() as conn:
+        conn.executemany(
+          """
+            INSERT INTO cache (key, value, expire, tag, size, atime, codec, serializer)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+              value = excluded.value, expire = excluded.expire, tag = excluded.tag,
+              size = excluded.size, atime = excluded.atime, codec = excluded.codec,
+              serializer = excluded.serializer
+            """,
+          rows,
+        )
+      if self.max_size_bytes or self.max_entries:
+        # Every batch of writes evicts at most as many batches of entries.
+        for _ in range(len(rows) // _EVICTION_BATCH + 1):
+          if not self._evict_over_budget():
+            break
     except sqlite3.Error as e:
       logging.error('SQLiteCache.set error: %s', e)
 
+  def flush_writes(self):
+    """Writes the buffered rows to the database."""
+    if self._writes is not None:
+      self._writes.flush()
+
+  def _encode(self, value) -> Tuple[bytes, str, str, int]:
+    """Serializes (and possibly compresses) a value.
+
+    Returns:
+      The encoded value, the compression codec and the serializer used, and
+      the serialized size before compression.
+    """
+    serializer = self.serializer
+    data = _SERIALIZERS[serializer][0](value)
+    if data is None:
+      serializer = 'pickle'
+      data = pickle.dumps(value)
+    if self.compression and len(data) >= self.compression_min_bytes:
+      compressed = _CODECS[self.compression][0](data)
+      if len(compressed) < len(data):
+        return compressed, self.compression, serializer, len(data)
+    return data, '', serializer, len(data)
+
+  def _touch(self, key: bytes, now: float):
+    if self.readonly:
+      return
+    with self._touches_lock:
+      _, hits = self._touches.get(key, (now, 0))
+      self._touches[key] = (now, hits + 1)
+      pending = len(self._touches)
+    if pending >= _TOUCHES_FLUSH_THRESHOLD:
+      self.flush_access_stats()
+
+  def flush_access_stats(self):
+    """Writes the buffered access times and hit counts to the database."""
+    with self._touches_lock:
+      touches, self._touches = self._touches, {}
+    if not touches:
+      return
+    try:
+      with self._conn() as conn:
+        conn.executemany(
+          'UPDATE cache SET atime = max(atime, ?), hits = hits + ? WHERE key = ?',
+          [(atime, hits, sqlite3.Binary(key)) for key, (atime, hits) in touches.items()],
+        )
+    except sqlite3.Error as e:
+      logging.error('SQLiteCache.flush_access_stats error: %s', e)
+
+  def totals(self) -> Tuple[int, int]:
+    """Returns the number of entries and the total size of the cached values."""
+    self.flush_writes()
+    return self._read_totals()
+
+  def _read_totals(self) -> Tuple[int, int]:
+    with self._conn() as conn:
+      entries, size = conn.execute('SELECT entries, size FROM cache_totals').fetchone()
+    return entries, size
+
+  def _evict_over_budget(self) -> int:
+    """Evicts at most _EVICTION_BATCH entries if the cache is above budget."""
+    entries, size = self._read_totals()
+    excess_entries = entries - self.max_entries if self.max_entries else 0
+    excess_bytes = size - self.max_size_bytes if self.max_size_bytes else 0
+    if excess_entries <= 0 and excess_bytes <= 0:
+      return 0
+    self.flush_access_stats()
+    victims: List[bytes] = []
+    freed = 0
+    with self._conn() as conn:
+      # Expired entries go first, then the least recently/frequently used ones.
+      candidates = conn.execute(
+        f'SELECT key, size FROM cache WHERE expire < ? AND key NOT IN ({_PINNED_KEYS}) LIMIT ?',
+        (time.time(), _EVICTION_BATCH),
+      ).fetchall()
+      candidates += conn.execute(
+        f"""
+          SELECT key, size FROM cache WHERE key NOT IN ({_PINNED_KEYS})
+          ORDER BY {_EVICTION_ORDER[self.eviction_policy]} LIMIT ?
+        """,
+        (_EVICTION_BATCH,),
+      ).fetchall()
+      for victim, victim_size in candidates:
+        if len(victims) >= _EVICTION_BATCH or (
+          len(victims) >= excess_entries and freed >= excess_bytes
+        ):
+          break
+        if victim not in victims:
+          victims.append(victim)
+          freed += victim_size
+      conn.executemany('DELETE FROM cache WHERE key = ?', [(v,) for v in victims])
+    logging.debug('evicted %d items (%d bytes) from cache', len(victims), freed)
+    return len(victims)
+
   def evict(self, tag: str) -> int:
     """Evicts all cache entries associated with a given tag.
 
@@ -137,163 +799,712 @@ class SQLiteCache:
     Returns:
       The number of entries removed from the cache.
     """
+    if self.readonly:
+      return 0
+    self.flush_writes()
     try:
-      with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-        with conn:
-          cur = conn.cursor()
-          cur.execute('DELETE FROM cache WHERE tag = ?', (tag,))
-          return cur.rowcount
+      with self._conn() as conn:
+        return conn.execute('DELETE FROM cache WHERE tag = ?', (tag,)).rowcount
     except sqlite3.Error as e:
       logging.error('SQLiteCache.evict error: %s', e)
       return 0
 
   def expire(self) -> int:
-    """Removes all expired cache entries.
+    """Removes all expired cache entries, except the entries of recorded
+    snapshots that weren't exported yet.
 
     Returns:
       The number of expired entries removed from the cache.
     """
+    if self.readonly:
+      return 0
+    self.flush_writes()
     now = time.time()
     try:
-      with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-        with conn:
-          cur = conn.cursor()
-          cur.execute('DELETE FROM cache WHERE expire < ?', (now,))
-          return cur.rowcount
+      with self._conn() as conn:
+        return conn.execute(
+          f'DELETE FROM cache WHERE expire < ? AND key NOT IN ({_PINNED_KEYS})', (now,)
+        ).rowcount
     except sqlite3.Error as e:
       logging.error('SQLiteCache.expire error: %s', e)
       return 0
 
+  def acquire_lease(self, key: bytes, owner: str, duration: float) -> bool:
+    """Acquires the lease of `key` for `duration` seconds.
+
+    Leases are used to make sure that only one process sharing the cache
+    computes the value of a key (see SharedFlight).
+
+    Returns:
+      True if `owner` holds the lease, False if another owner holds it and it
+      hasn't expired.
+    """
+    now = time.time()
+    with self._conn() as conn:
+      conn.execute('BEGIN IMMEDIATE')
+      conn.execute('DELETE FROM leases WHERE key = ? AND expire < ?', (sqlite3.Binary(key), now))
+      conn.execute(
+        'INSERT OR IGNORE INTO leases (key, owner, expire) VALUES (?, ?, ?)',
+        (sqlite3.Binary(key), owner, now + duration),
+      )
+      (holder,) = conn.execute(
+        'SELECT owner FROM leases WHERE key = ?', (sqlite3.Binary(key),)
+      ).fetchone()
+    return holder == owner
+
+  def renew_leases(self, owner: str, duration: float) -> int:
+    """Extends all leases of `owner` by `duration` seconds from now.
+
+    Returns:
+      The number of leases renewed.
+    """
+    with self._conn() as conn:
+      return conn.execute(
+        'UPDATE leases SET expire = ? WHERE owner = ?', (time.time() + duration, owner)
+      ).rowcount
+
+  def release_lease(self, key: bytes, owner: str):
+    """Releases the lease of `key`, after making pending writes visible."""
+    self.flush_writes()
+    with self._conn() as conn:
+      conn.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (sqlite3.Binary(key), owner))
+
+  def retain_snapshot(self, project: str, keys: Iterable[bytes]):
+    """Retains the entries with `keys` as the snapshot of `project`.
+
+    The entries that would be removed at the end of the execution (tag 'tmp')
+    are retagged so that they are kept, but only returned by read-only
+    caches. The entries of the snapshot are pinned until it is exported: they
+    are neither expired nor evicted. The previous snapshot of the project is
+    replaced.
+    """
+    self.flush_writes()
+    tag = _SNAPSHOT_TAG_PREFIX + project
+    with self._conn() as conn:
+      conn.execute('BEGIN IMMEDIATE')
+      conn.execute('DELETE FROM cache WHERE tag = ?', (tag,))
+      conn.execute('DELETE FROM snapshot_keys WHERE project = ?', (project,))
+      conn.executemany(
+        'INSERT OR IGNORE INTO snapshot_keys (project, key, pinned) VALUES (?, ?, 1)',
+        [(project, sqlite3.Binary(k)) for k in keys],
+      )
+      retained = conn.execute(
+        """
+          UPDATE cache SET tag = ?
+          WHERE tag = 'tmp' AND key IN (SELECT key FROM snapshot_keys WHERE project = ?)
+        """,
+        (tag, project),
+      ).rowcount
+    logging.debug('retained %d cache entries as snapshot of %s', retained, project)
+
+  def export_snapshot(self, project: str, path: str) -> int:
+    """Writes the snapshot of `project` to the SQLite database file `path`.
+
+    The entries of the snapshot are unpinned (see retain_snapshot).
+
+    Returns:
+      The number of exported entries. Entries of the snapshot that were
+      replaced by later executions, and removed at their end, are missing.
+    """
+    if os.path.exists(path):
+      raise FileExistsError(f'{path} already exists')
+    self.flush_writes()
+    conn = self._conn()
+    conn.execute('ATTACH DATABASE ? AS export', (str(path),))
+    try:
+      with conn:
+        conn.execute("""
+            CREATE TABLE export.snapshot (
+                key BLOB PRIMARY KEY,
+                value BLOB,
+                codec TEXT NOT NULL,
+                serializer TEXT NOT NULL
+            );
+        """)
+        conn.execute('CREATE TABLE export.metadata (name TEXT PRIMARY KEY, value TEXT)')
+        conn.executemany(
+          'INSERT INTO export.metadata (name, value) VALUES (?, ?)',
+          [
+            ('format_version', str(_SNAPSHOT_FORMAT_VERSION)),
+            ('project', project),
+            ('created', str(time.time())),
+          ],
+        )
+        count = conn.execute(
+          """
+            INSERT INTO export.snapshot (key, value, codec, serializer)
+            SELECT c.key, c.value, c.codec, c.serializer
+            FROM cache c JOIN snapshot_keys s ON s.key = c.key
+            WHERE s.project = ?
+          """,
+          (project,),
+        ).rowcount
+        conn.execute('UPDATE snapshot_keys SET pinned = 0 WHERE project = ?', (project,))
+        return count
+    finally:
+      conn.execute('DETACH DATABASE export')
+
+  def import_snapshot(self, path: str, allow_pickle: bool = False) -> Tuple[str, int]:
+    """Imports a snapshot written by export_snapshot(), replacing the
+    snapshot of the same project.
+
+    Entries serialized with pickle can execute arbitrary code when they are
+    read, so snapshots containing such entries are refused unless
+    `allow_pickle` is set, for snapshots coming from a trusted source.
+
+    Returns:
+      The project of the snapshot and the number of imported entries.
+    """
+    if not os.path.exists(path):
+      raise FileNotFoundError(f'{path} does not exist')
+    self.flush_writes()
+    conn = self._conn()
+    conn.execute('ATTACH DATABASE ? AS import', (str(path),))
+    try:
+      metadata = dict(conn.execute('SELECT name, value FROM import.metadata'))
+      if metadata.get('format_version') != str(_SNAPSHOT_FORMAT_VERSION):
+        raise ValueError(f'unsupported cache snapshot format: {metadata.get("format_version")}')
+      project = metadata['project']
+      (pickled,) = conn.execute(
+        "SELECT count(*) FROM import.snapshot WHERE serializer != 'json'"
+      ).fetchone()
+      if pickled and not allow_pickle:
+        raise ValueError(
+          f'{path} contains {pickled} pickle-serialized entries, which can execute code when'
+          ' they are read: import it only if you trust its origin, with --allow-pickle'
+        )
+      if pickled:
+        logging.warning(
+          'importing %d pickle-serialized entries from %s, which can execute code when they'
+          ' are read',
+          pickled,
+          path,
+        )
+      tag = _SNAPSHOT_TAG_PREFIX + project
+      with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM cache WHERE tag = ?', (tag,))
+        conn.execute('DELETE FROM snapshot_keys WHERE project = ?', (project,))
+        conn.execute(
+          'INSERT INTO snapshot_keys (project, key) SELECT ?, key FROM import.snapshot',
+          (project,),
+        )
+        count = conn.execute(
+          """
+            INSERT INTO cache (key, value, expire, tag, size, atime, codec, serializer)
+            SELECT key, value, NULL, ?, length(value), ?, codec, serializer
+            FROM import.snapshot WHERE true
+            ON CONFLICT(key) DO UPDATE SET
+              value = excluded.value, expire = NULL, tag = excluded.tag,
+              size = excluded.size, atime = excluded.atime, codec = excluded.codec,
+              serializer = excluded.serializer
+          """,
+          (tag, time.time()),
+        ).rowcount
+    finally:
+      conn.execute('DETACH DATABASE import')
+    return project, count
+
   def close(self):
-    """Closes the cache. Currently, this is a no-op."""
-    pass
+    """Closes the connections to the cache database of all threads."""
+    self.flush_writes()
+    self.flush_access_stats()
+    _connections.close(self.db_path)
 
 
 class SQLiteDeque:
-  """A thread-safe, disk-backed sequence/deque backed by SQLite3."""
+  """A thread-safe, disk-backed sequence/deque backed by SQLite3.
 
-  def __init__(self, directory: str):
+  Appended values are buffered and inserted in batches of `write_batch_size`
+  rows (see _WriteBuffer); reads write the buffered values first.
+
+  Values can only be added on the left, so row ids are contiguous and
+  positions map directly to row ids: len() and indexing don't scan the
+  table.
+  Iteration reads `_DEQUE_PAGE_SIZE` rows at a time, so that deques bigger
+  than the available memory can be processed.
+  """
+
+  def __init__(self, directory: str, write_batch_size: int = _WRITE_BATCH_SIZE):
     path = pathlib.Path(directory)
     # Restrict cache directory permissions to owner to mitigate pickle insecurity.
     path.mkdir(mode=0o700, parents=True, exist_ok=True)
     path.chmod(0o700)
     self.db_path = path / 'sqlite_deque.db'
+    self.write_batch_size = write_batch_size
+    self._init_writes()
     self._init_db()
 
+  def _init_writes(self):
+    self._writes = _WriteBuffer(self._write_rows, max_rows=self.write_batch_size)
+    self._write_seq = itertools.count()
+
+  def __getstate__(self):
+    # Deques are returned by cached functions, so they get pickled.
+    self.flush()
+    return {'db_path': self.db_path, 'write_batch_size': self.write_batch_size}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._init_writes()
+
+  def _conn(self) -> sqlite3.Connection:
+    return _connections.get(self.db_path)
+
   def _init_db(self):
-    with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-      with conn:
-        conn.execute('PRAGMA journal_mode=WAL;')
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS deque (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                value BLOB
-            );
-        """)
+    with self._conn() as conn:
+      conn.execute('PRAGMA journal_mode=WAL;')
+      conn.execute("""
+          CREATE TABLE IF NOT EXISTS deque (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              value BLOB
+          );
+      """)
 
   def appendleft(self, value):
-    value_bytes = pickle.dumps(value)
-    with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-      with conn:
-        conn.execute('INSERT INTO deque (value) VALUES (?)', (sqlite3.Binary(value_bytes),))
+    self._writes.add(next(self._write_seq), (sqlite3.Binary(pickle.dumps(value)),))
+
+  def extendleft(self, values: Iterable[Any]):
+    """Adds `values` on the left, in one transaction (like appendleft of each)."""
+    self._writes.write_through([(sqlite3.Binary(pickle.dumps(v)),) for v in values])
+
+  def _write_rows(self, rows: List[tuple]):
+    with self._conn() as conn:
+      conn.executemany('INSERT INTO deque (value) VALUES (?)', rows)
+
+  def _get_bounds(self) -> Tuple[int, int]:
+    """Returns the ids of the oldest and of the newest value."""
+    self.flush()
+    # Unlike COUNT(*), this only looks at both ends of the rowid b-tree (with
+    # separate subqueries: SQLite optimizes only a single MIN() or MAX()). It
+    # isn't cached because copies of a deque (see __getstate__) share the table.
+    with self._conn() as conn:
+      first_id, last_id = conn.execute(
+        'SELECT (SELECT MIN(id) FROM deque), (SELECT MAX(id) FROM deque)'
+      ).fetchone()
+    if first_id is None:
+      return (1, 0)
+    return (first_id, last_id)
+
+  def flush(self):
+    """Writes the buffered values to the database."""
+    self._writes.flush()
 
   def __len__(self) -> int:
-    with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-      with conn:
-        cur = conn.cursor()
-        cur.execute('SELECT COUNT(*) FROM deque')
-        return cur.fetchone()[0]
+    first_id, last_id = self._get_bounds()
+    return last_id - first_id + 1
+
+  def _scan(self, first_id: int, last_id: int, descending: bool):
+    """Yields the values with ids between first_id and last_id, one page at a time."""
+    order = 'DESC' if descending else 'ASC'
+    while first_id <= last_id:
+      with self._conn() as conn:
+        rows = conn.execute(
+          f'SELECT id, value FROM deque WHERE id BETWEEN ? AND ? ORDER BY id {order} LIMIT ?',
+          (first_id, last_id, _DEQUE_PAGE_SIZE),
+        ).fetchall()
+      if not rows:
+        return
+      if descending:
+        last_id = rows[-1][0] - 1
+      else:
+        first_id = rows[-1][0] + 1
+      for _, value in rows:
+        yield pickle.loads(value)
 
   def __iter__(self):
-    with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-      with conn:
-        cur = conn.cursor()
-        cur.execute('SELECT value FROM deque ORDER BY id DESC')
-        rows = cur.fetchall()
-    for row in rows:
-      yield pickle.loads(row[0])
+    return self._scan(*self._get_bounds(), descending=True)
 
   def __reversed__(self):
-    with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-      with conn:
-        cur = conn.cursor()
-        cur.execute('SELECT value FROM deque ORDER BY id ASC')
-        rows = cur.fetchall()
-    for row in rows:
-      yield pickle.loads(row[0])
+    return self._scan(*self._get_bounds(), descending=False)
 
   def __getitem__(self, index):
+    first_id, last_id = self._get_bounds()
+    length = last_id - first_id + 1
     if isinstance(index, int):
       if index < 0:
-        length = len(self)
-        index = length + index
-        if index < 0:
-          raise IndexError('deque index out of range')
-
-      with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-        with conn:
-          cur = conn.cursor()
-          cur.execute('SELECT value FROM deque ORDER BY id DESC LIMIT 1 OFFSET ?', (index,))
-          row = cur.fetchone()
-          if row is None:
-            raise IndexError('deque index out of range')
-          return pickle.loads(row[0])
+        index += length
+      if not 0 <= index < length:
+        raise IndexError('deque index out of range')
+      with self._conn() as conn:
+        row = conn.execute('SELECT value FROM deque WHERE id = ?', (last_id - index,)).fetchone()
+      if row is None:
+        raise IndexError('deque index out of range')
+      return pickle.loads(row[0])
     else:
-      with contextlib.closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
-        with conn:
-          cur = conn.cursor()
-          cur.execute('SELECT value FROM deque ORDER BY id DESC')
-          rows = cur.fetchall()
-      values = [pickle.loads(row[0]) for row in rows]
-      try:
-        return values[index]
-      except IndexError as e:
-        raise IndexError('deque index out of range') from e
+      positions = range(*index.indices(length))
+      if not positions:
+        return []
+      # Position 0 is the newest value, i.e. the highest id.
+      ids = (last_id - positions[0], last_id - positions[-1])
+      values = self._scan(min(ids), max(ids), descending=positions.step > 0)
+      return list(itertools.islice(values, None, None, abs(positions.step)))
+
+
+class MemoryCache:
+  """A thread-safe in-process LRU cache of decoded values.
+
+  This is the first tier in front of SQLiteCache for cached_api_call(tiered=True):
+  a hit returns the already decoded object, so that values requested by many
+  rules are not read from SQLite and deserialized again every time. The cache
+  is bounded by number of entries and by total size, where the size of an
+  entry is the size of its serialized representation as reported by
+  SQLiteCache. Least recently used entries are dropped first.
+
+  Values are returned as is (not copied), exactly like with lru_cache, so
+  callers must not modify them.
+  """
 
+  def __init__(self, max_size_bytes: Optional[int] = None, max_entries: Optional[int] = None):
+    self.max_size_bytes = max_size_bytes
+    self.max_entries = max_entries
+    # key -> (value, size, expiration timestamp or None)
+    self._entries: 'collections.OrderedDict[bytes, Tuple[Any, int, Optional[float]]]' = (
+      collections.OrderedDict()
+    )
+    self._size = 0
+    self._lock = threading.Lock()
 
-class RefLock:
-  """Wrapper for threading.Lock to support weak referencing in LockDict."""
+  def get(self, key: bytes, default=None):
+    """Returns the value for `key`, or `default` if it is not cached or expired."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return default
+      if entry[2] is not None and entry[2] < time.time():
+        self._pop_locked(key)
+        return default
+      self._entries.move_to_end(key)
+      return entry[0]
+
+  def set(self, key: bytes, value, size: int, expire_time: Optional[float] = None):
+    """Stores `value`, evicting least recently used entries if over budget.
+
+    Values bigger than the whole size budget are not stored.
+    """
+    with self._lock:
+      self._pop_locked(key)
+      if self.max_size_bytes and size > self.max_size_bytes:
+        return
+      self._entries[key] = (value, size, expire_time)
+      self._size += size
+      while (self.max_entries and len(self._entries) > self.max_entries) or (
+        self.max_size_bytes and self._size > self.max_size_bytes
+      ):
+        self._size -= self._entries.popitem(last=False)[1][1]
+
+  def _pop_locked(self, key: bytes):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._size -= entry[1]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
 
-  def __init__(self):
-    self.lock = threading.Lock()
+  def __len__(self) -> int:
+    return len(self._entries)
 
-  def acquire(self, *args, **kwargs):
-    return self.lock.acquire(*args, **kwargs)
+  @property
+  def size(self) -> int:
+    """Total size of the cached entries."""
+    return self._size
 
-  def release(self):
-    self.lock.release()
 
-  def __enter__(self):
-    return self.lock.__enter__()
+class CacheWaitTimeoutError(RuntimeError):
+  """Raised when a concurrent call with the same arguments didn't complete in
+  time (see wait_timeout()).
 
-  def __exit__(self, exc_type, exc_val, exc_tb):
-    return self.lock.__exit__(exc_type, exc_val, exc_tb)
+  This is a RuntimeError, like the error of the lock it replaces, so that rules
+  are skipped rather than the whole execution aborted. It must not be a
+  TimeoutError, which is also concurrent.futures.TimeoutError since Python
+  3.11.
+  """
 
 
-class LockDict:
-  """Thread-safe dict of thread locks for cache synchronization.
+# Outcome of a call of SingleFlight whose leader was cancelled.
+_CANCELLED = object()
 
-  Uses weak references (WeakValueDictionary) to store locks, ensuring that
-  lock objects are garbage-collected when no longer in use. This prevents
-  the dictionary from growing unboundedly if cached functions are called
-  with many different keys over time.
+
+class _Flight:
+  """A call in progress in SingleFlight."""
+
+  def __init__(self, name: str):
+    self.name = name
+    self.future: concurrent.futures.Future = concurrent.futures.Future()
+    self.waiting = 0
+
+
+class SingleFlight:
+  """Deduplicates concurrent calls with the same key.
+
+  The first caller of a key (the leader) executes the call and publishes the
+  outcome in a Future; callers arriving while the call is in flight wait for
+  that Future instead of executing the call again. Exceptions raised by the
+  call are re-raised in all of the waiting callers, except the cancellation
+  of the leader's task (executor.TaskCancelledError): one of the waiters then
+  executes the call again. Every waiter has its own
+  deadline: if the result isn't available in time, that waiter gets a
+  CacheWaitTimeoutError, while the call itself and the other waiters are unaffected.
+
+  Entries are removed as soon as the call completes, so results are not
+  retained (that's what the caches are for).
   """
 
   def __init__(self):
-    self._locks = weakref.WeakValueDictionary()
-    self._dict_lock = threading.Lock()
+    self._flights: Dict[Any, _Flight] = {}
+    self._lock = threading.Lock()
+
+  def do(
+    self,
+    key,
+    fn: Callable[[], Any],
+    name: str = '',
+    timeout: Optional[float] = None,
+    on_wait: Optional[Callable[[float], None]] = None,
+  ):
+    """Returns fn(), or the result of the call of fn() in flight for `key`.
 
-  def __getitem__(self, key):
-    with self._dict_lock:
-      lock = self._locks.get(key)
-      if lock is None:
-        lock = RefLock()
-        self._locks[key] = lock
-      return lock
+    Args:
+      key: hashable key identifying the call.
+      fn: function to call if no call for `key` is in flight.
+      name: name of the call, used for diagnostics.
+      timeout: number of seconds to wait for a call in flight (None means
+        wait forever).
+      on_wait: called with the number of seconds waited, if this caller
+        waited for a call in flight.
+    """
+    deadline = time.perf_counter() + timeout if timeout is not None else None
+    while True:
+      with self._lock:
+        flight = self._flights.get(key)
+        if flight is None:
+          flight = self._flights[key] = _Flight(name)
+          leader = True
+        else:
+          flight.waiting += 1
+          leader = False
+      if leader:
+        return self._lead(key, flight, fn)
+      start = time.perf_counter()
+      try:
+        logging.debug('waiting for concurrent call of %s', name)
+        result = flight.future.result(max(deadline - start, 0) if deadline is not None else None)
+      except concurrent.futures.TimeoutError:
+        raise CacheWaitTimeoutError(
+          f'timed out after {timeout}s waiting for concurrent call of {name}'
+        ) from None
+      finally:
+        with self._lock:
+          flight.waiting -= 1
+        if on_wait:
+          on_wait(time.perf_counter() - start)
+      if result is not _CANCELLED:
+        return result
+      logging.debug('concurrent call of %s was cancelled, retrying', name)
+
+  def _lead(self, key, flight: _Flight, fn: Callable[[], Any]):
+    try:
+      result = fn()
+    except executor.TaskCancelledError:
+      # The task of the leader was cancelled, but the waiters may belong to
+      # other cancellation scopes: they retry the call instead of failing.
+      self._remove(key, flight)
+      flight.future.set_result(_CANCELLED)
+      raise
+    except BaseException as err:
+      flight.future.set_exception(err)
+      raise
+    else:
+      flight.future.set_result(result)
+      return result
+    finally:
+      self._remove(key, flight)
 
-  def __len__(self) -> int:
-    with self._dict_lock:
-      return len(self._locks)
+  def _remove(self, key, flight: _Flight):
+    with self._lock:
+      if self._flights.get(key) is flight:
+        del self._flights[key]
+
+  def in_flight(self) -> Dict[str, int]:
+    """Returns the number of calls in flight per name."""
+    with self._lock:
+      return dict(collections.Counter(f.name for f in self._flights.values()))
+
+  def stats(self) -> Dict[str, int]:
+    """Returns the number of calls in flight and of callers waiting for them."""
+    with self._lock:
+      return {
+        'in_flight': len(self._flights),
+        'waiting': sum(f.waiting for f in self._flights.values()),
+      }
+
+
+# Concurrent calls of cached_api_call functions in progress.
+_flights = SingleFlight()
+
+
+def get_flight_stats() -> Dict[str, int]:
+  """Return the number of cached API calls in flight and of callers waiting."""
+  return _flights.stats()
+
+
+class SharedFlight:
+  """Deduplicates calls with the same key across processes sharing a cache.
+
+  This complements SingleFlight, which only works within a process: before
+  executing a call, the process takes a lease on the key in the SQLite
+  cache. Other processes find the lease taken and poll the cache until the
+  result is stored there, or until the lease is released or expires, in which
+  case they try to take it over.
+
+  Leases are renewed by a heartbeat thread while the call is in progress, so
+  that `lease_seconds` only bounds how long the other processes wait for a
+  process that died, not the duration of the call.
+
+  If the leases can't be read or written (e.g. the database is locked for too
+  long), calls are executed without deduplication.
+  """
+
+  def __init__(
+    self,
+    lease_seconds: float = config.CACHE_LEASE_SECONDS,
+    poll_interval: float = 0.1,
+    max_poll_interval: float = 1.0,
+  ):
+    self.owner = f'{os.getpid()}-{os.urandom(8).hex()}'
+    self.lease_seconds = lease_seconds
+    self.poll_interval = poll_interval
+    self.max_poll_interval = max_poll_interval
+    self._held: Dict[Tuple[str, bytes], int] = collections.Counter()
+    self._caches: Dict[str, SQLiteCache] = {}
+    self._lock = threading.Lock()
+    self._heartbeat: Optional[threading.Thread] = None
+
+  def do(
+    self,
+    cache: 'SQLiteCache',
+    key: bytes,
+    fn: Callable[[], Any],
+    from_entry: Callable[[Tuple[Any, int, Optional[float]]], Any],
+    name: str = '',
+    timeout: Optional[float] = None,
+    on_wait: Optional[Callable[[float], None]] = None,
+  ):
+    """Returns fn(), or from_entry() of the entry stored by another process.
+
+    Args:
+      cache: the cache where fn() stores its result.
+      key: cache key of the call.
+      fn: function computing and storing the result.
+      from_entry: called with the cache entry (see SQLiteCache.get_entry) if
+        another process stored it.
+      name: name of the call, used for diagnostics.
+      timeout: number of seconds to wait for other processes, after which
+        fn() is called anyway (None means wait forever).
+      on_wait: called with the number of seconds waited, if the result was
+        stored by another process.
+    """
+    start = time.perf_counter()
+    interval = self.poll_interval
+    while True:
+      acquired = self._acquire(cache, key)
+      if acquired is None:
+        return fn()
+      if acquired:
+        break
+      entry = cache.get_entry(key)
+      if entry is not None:
+        if on_wait:
+          on_wait(time.perf_counter() - start)
+        return from_entry(entry)
+      if timeout is not None and time.perf_counter() - start > timeout:
+        logging.debug('timed out waiting for another process to call %s', name)
+        return fn()
+      time.sleep(interval)
+      interval = min(interval * 2, self.max_poll_interval)
+    # The lease might have been released right after the result was stored.
+    entry = cache.get_entry(key)
+    if entry is not None:
+      self._release_lease(cache, key)
+      if on_wait:
+        on_wait(time.perf_counter() - start)
+      return from_entry(entry)
+    return self._call_leased(cache, key, fn)
+
+  def try_do(self, cache: 'SQLiteCache', key: bytes, fn: Callable[[], Any]) -> bool:
+    """Calls fn() unless another process holds the lease of `key`.
+
+    Returns:
+      Whether fn() was called.
+    """
+    acquired = self._acquire(cache, key)
+    if acquired is None:
+      fn()
+      return True
+    if not acquired:
+      return False
+    self._call_leased(cache, key, fn)
+    return True
+
+  def _acquire(self, cache: 'SQLiteCache', key: bytes) -> Optional[bool]:
+    """Returns whether the lease of `key` was acquired, or None if the leases
+    can't be used."""
+    try:
+      return cache.acquire_lease(key, self.owner, self.lease_seconds)
+    except sqlite3.Error as err:
+      logging.debug("can't acquire cache lease, calling without it: %s", err)
+      return None
+
+  def _release_lease(self, cache: 'SQLiteCache', key: bytes):
+    try:
+      cache.release_lease(key, self.owner)
+    except sqlite3.Error as err:
+      logging.debug("can't release cache lease: %s", err)
+
+  def _call_leased(self, cache: 'SQLiteCache', key: bytes, fn: Callable[[], Any]):
+    self._hold(cache, key)
+    try:
+      return fn()
+    finally:
+      self._release(cache, key)
+
+  def _hold(self, cache: 'SQLiteCache', key: bytes):
+    with self._lock:
+      self._held[(cache.db_path, key)] += 1
+      self._caches[cache.db_path] = cache
+      if self._heartbeat is None:
+        self._heartbeat = threading.Thread(
+          target=self._renew_leases, name='cache-lease-heartbeat', daemon=True
+        )
+        self._heartbeat.start()
+
+  def _release(self, cache: 'SQLiteCache', key: bytes):
+    with self._lock:
+      self._held[(cache.db_path, key)] -= 1
+      if self._held[(cache.db_path, key)] <= 0:
+        del self._held[(cache.db_path, key)]
+    self._release_lease(cache, key)
+
+  def _renew_leases(self):
+    while True:
+      time.sleep(self.lease_seconds / 3)
+      with self._lock:
+        caches = [self._caches[db_path] for db_path in {db_path for db_path, _ in self._held}]
+      for cache in caches:
+        try:
+          cache.renew_leases(self.owner, self.lease_seconds)
+        except sqlite3.Error as err:
+          logging.debug("can't renew cache leases: %s", err)
+
+
+# Cached API calls in progress in all processes using the same cache directory.
+_shared_flights = SharedFlight()
+
+
+def _share_calls() -> bool:
+  return bool(config.get('cache_share_calls'))
 
 
 def _set_bypass_cache(value: bool):
@@ -332,6 +1543,58 @@ def bypass_cache():
     _set_bypass_cache(original_value)
 
 
+def _get_wait_timeout() -> float:
+  """Gets the timeout of the current thread for waiting on concurrent calls."""
+  return getattr(threading.current_thread(), '_cache_wait_timeout', config.CACHE_LOCK_TIMEOUT)
+
+
+@contextlib.contextmanager
+def wait_timeout(seconds: Optional[float]):
+  """Context manager to set how long cached_api_call functions called by the
+  current thread wait for a concurrent call with the same arguments (None:
+  wait forever) before raising CacheWaitTimeoutError. The default is
+  config.CACHE_LOCK_TIMEOUT.
+  """
+  thread = threading.current_thread()
+  original_value = _get_wait_timeout()
+  setattr(thread, '_cache_wait_timeout', seconds)
+  try:
+    yield
+  finally:
+    setattr(thread, '_cache_wait_timeout', original_value)
+
+
+def configure_session(
+  project_id: Union[str, Iterable[str], None], record: bool = False, readonly: bool = False
+):
+  """Configures how the cache is used by this execution.
+
+  Args:
+    project_id: the project inspected by this execution, or the projects when
+      linting multiple projects.
+    record: retain the results of all cached API calls at exit, so that they
+      can be exported with `gcpdiag cache export`. This also stores the results
+      of in_memory functions in the disk cache. With multiple projects, the
+      snapshot of each project contains the results of the whole execution.
+    readonly: replay a recorded or imported snapshot: results are only read
+      from the cache, including expired and snapshot entries, and a cache miss
+      raises GcpApiError instead of calling the API. The in_memory functions
+      whose results couldn't be recorded (e.g. API clients) are executed
+      again. Nothing is written to the cache.
+  """
+  global _session_projects, _session_record, _readonly
+  # options that weren't given are None (see config.get)
+  readonly = bool(readonly)
+  if _cache is not None and _cache.readonly != readonly:
+    raise RuntimeError('configure_session() must be called before the cache is used')
+  if isinstance(project_id, str):
+    _session_projects = [project_id]
+  else:
+    _session_projects = list(project_id or [])
+  _session_record = bool(record) and bool(_session_projects) and not readonly
+  _readonly = readonly
+
+
 def _clean_cache():
   """Remove all cached items with tag 'tmp'.
 
@@ -347,6 +1610,9 @@ def _clean_cache():
 
 def _close_cache():
   if _cache:
+    if _session_record:
+      for project_id in _session_projects:
+        _cache.retain_snapshot(project_id, _session_keys)
     _clean_cache()
     _cache.close()
 
@@ -355,7 +1621,18 @@ def get_disk_cache() -> Optional[SQLiteCache]:
   """Get a SQLiteCache object that can be used to cache data."""
   global _cache
   if _use_cache and not _cache:
-    _cache = SQLiteCache(config.get_cache_dir(), tag_index=True)
+    _cache = SQLiteCache(
+      config.get_cache_dir(),
+      tag_index=True,
+      max_size_bytes=(config.get('cache_max_size_mb') or 0) * 1024 * 1024,
+      max_entries=config.get('cache_max_entries'),
+      eviction_policy=config.get('cache_eviction_policy'),
+      compression=config.get('cache_compression'),
+      compression_min_bytes=config.get('cache_compression_min_bytes'),
+      serializer=config.get('cache_serializer'),
+      write_batch_size=_WRITE_BATCH_SIZE,
+      readonly=_readonly,
+    )
     # Make sure that we remove any data that wasn't cleaned up correctly for
     # some reason.
     _clean_cache()
@@ -364,12 +1641,181 @@ def get_disk_cache() -> Optional[SQLiteCache]:
   return _cache
 
 
+def get_memory_cache() -> Optional[MemoryCache]:
+  """Get the process-wide MemoryCache used by cached_api_call(tiered=True)."""
+  global _memory_cache
+  if _use_cache and not _memory_cache:
+    _memory_cache = MemoryCache(
+      max_size_bytes=(config.get('cache_memory_max_size_mb') or 0) * 1024 * 1024,
+      max_entries=config.get('cache_memory_max_entries'),
+    )
+  return _memory_cache
+
+
+# Hit/miss counters of the cache tiers used by cached_api_call:
+# ('memory' or 'disk', 'hits' or 'misses') -> count
+_tier_counters: 'collections.Counter[Tuple[str, str]]' = collections.Counter()
+_tier_counters_lock = threading.Lock()
+
+
+def _count_tier(tier: str, hit: bool):
+  with _tier_counters_lock:
+    _tier_counters[(tier, 'hits' if hit else 'misses')] += 1
+
+
+def get_tier_stats() -> Dict[str, Dict[str, int]]:
+  """Return the number of hits and misses per cache tier ('memory', 'disk')."""
+  with _tier_counters_lock:
+    return {
+      tier: {
+        'hits': _tier_counters[(tier, 'hits')],
+        'misses': _tier_counters[(tier, 'misses')],
+      }
+      for tier in ('memory', 'disk')
+    }
+
+
+class CacheStats:
+  """Per-function counters of the cached_api_call functions.
+
+  Counters:
+  - calls: number of calls.
+  - executions: number of calls of the underlying function.
+  - bypasses: executions because the cache was bypassed.
+  - negative_hits: hits returning a cached API error.
+  - stale_hits, refreshes: hits returning an expired value while it is
+    refreshed in the background (see stale_while_revalidate), and the
+    executions done to refresh them.
+  - waits, wait_time: calls that waited for a concurrent call with the same
+    arguments, and total seconds waited.
+  - call_time: total seconds spent in the underlying function.
+  - size: total serialized size of the results stored in the disk cache.
+  """
+
+  COUNTERS = (
+    'calls',
+    'executions',
+    'bypasses',
+    'negative_hits',
+    'stale_hits',
+    'refreshes',
+    'waits',
+    'wait_time',
+    'call_time',
+    'size',
+  )
+
+  def __init__(self):
+    self._counters: Dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+    self._lock = threading.Lock()
+
+  def record(self, name: str, **increments: float):
+    with self._lock:
+      self._counters[name].update(increments)
+
+  def snapshot(self) -> Dict[str, Dict[str, float]]:
+    """Returns the counters per function, including the derived hits and
+    misses (executions that were not bypasses or background refreshes)."""
+    with self._lock:
+      result = {
+        name: {c: counters[c] for c in self.COUNTERS} for name, counters in self._counters.items()
+      }
+    for counters in result.values():
+      foreground = counters['executions'] - counters['refreshes']
+      counters['hits'] = counters['calls'] - foreground - counters['waits']
+      counters['misses'] = foreground - counters['bypasses']
+    return result
+
+  def clear(self):
+    with self._lock:
+      self._counters.clear()
+
+
+_stats = CacheStats()
+
+
+def get_stats() -> Dict[str, Dict[str, float]]:
+  """Return the per-function counters of the cached_api_call functions."""
+  return _stats.snapshot()
+
+
+def format_stats(stats: Dict[str, Dict[str, float]]) -> str:
+  """Format per-function counters as a table, sorted by time spent."""
+  header = (
+    f'{"function":<50} {"calls":>6} {"hits":>6} {"neg":>6} {"misses":>6} {"bypass":>6}'
+    f' {"waits":>6}'
+    f' {"wait s":>8} {"call s":>8} {"avg ms":>8} {"size KB":>9}'
+  )
+  lines = [header, '-' * len(header)]
+  for name, c in sorted(
+    stats.items(), key=lambda item: item[1]['call_time'] + item[1]['wait_time'], reverse=True
+  ):
+    avg_ms = c['call_time'] / c['executions'] * 1000 if c['executions'] else 0
+    lines.append(
+      f'{name.replace("gcpdiag.queries.", ""):<50} {c["calls"]:>6} {c["hits"]:>6}'
+      f' {c["negative_hits"]:>6}'
+      f' {c["misses"]:>6} {c["bypasses"]:>6} {c["waits"]:>6} {c["wait_time"]:>8.2f}'
+      f' {c["call_time"]:>8.2f} {avg_ms:>8.1f} {c["size"] / 1024:>9.1f}'
+    )
+  tiers = get_tier_stats()
+  lines.append('')
+  lines.append(
+    'memory tier: {hits} hits, {misses} misses'.format(**tiers['memory'])
+    + '; disk tier: {hits} hits, {misses} misses'.format(**tiers['disk'])
+  )
+  return '\n'.join(lines)
+
+
+def _report_stats(destination: str):
+  stats = get_stats()
+  services = executor.get_service_stats()
+  limits = executor.get_concurrency_limits()
+  scheduling = executor.get_scheduling_stats()
+  if destination == '-':
+    print(format_stats(stats), file=sys.stderr)
+    if services:
+      print('\n' + executor.format_service_stats(services), file=sys.stderr)
+    if limits:
+      print(
+        '\nconcurrency limits: ' + ', '.join(f'{s}={n}' for s, n in sorted(limits.items())),
+        file=sys.stderr,
+      )
+    if scheduling:
+      print(
+        f'promoted tasks: {scheduling["promotions"]}'
+        f' (overtook {scheduling["overtaken"]} tasks,'
+        f' reordering {scheduling["reorder_time"] * 1e6:.0f} us)',
+        file=sys.stderr,
+      )
+    return
+  with open(destination, 'w', encoding='utf-8') as f:
+    json.dump(
+      {
+        'functions': stats,
+        'tiers': get_tier_stats(),
+        'services': services,
+        'concurrency_limits': limits,
+        'scheduling': scheduling,
+      },
+      f,
+      indent=2,
+      sort_keys=True,
+    )
+
+
+def report_stats_at_exit(destination: str):
+  """Print the cache statistics at exit as a table on stderr if destination is
+  '-', otherwise write them as JSON to the file `destination`."""
+  atexit.register(_report_stats, destination)
+
+
 deque_tmpdirs: List[str] = []
 
 
 def _clean_tmp_deque():
   for d in deque_tmpdirs:
     logging.debug('deleting dequeue tempdir: %s', d)
+    _connections.close(pathlib.Path(d) / 'sqlite_deque.db')
     shutil.rmtree(d, ignore_errors=True)
 
 
@@ -390,102 +1836,324 @@ def get_tmp_deque(prefix='tmp-deque-') -> SQLiteDeque:
 # Write our own implementation instead of using private function
 # functtools._make_key, so that there is no breakage if that
 # private function changes with a newer Python version.
+#
+# Arguments implementing the __cache_key__ protocol (a method returning bytes
+# that identify the object, see e.g. models.Context and models.Resource) are
+# represented by that value instead of being pickled, which is faster and
+# doesn't depend on state that isn't part of their identity.
+_CACHE_KEY_MARKER = '__cache_key__'
+_KEY_SCALAR_TYPES = frozenset([str, int, float, bool, bytes, type(None)])
+
+
+def _key_part(value):
+  cache_key = getattr(type(value), '__cache_key__', None)
+  if cache_key is None:
+    return value
+  return (_CACHE_KEY_MARKER, cache_key(value))
+
+
 def _make_key(func, args, kwargs):
   h = hashlib.sha256()
   func_name = bytes(func.__module__ + '.' + func.__name__ + ':', 'utf-8')
-  h.update(pickle.dumps(args))
-  h.update(pickle.dumps(kwargs))
+  if all(type(a) in _KEY_SCALAR_TYPES for a in args):
+    h.update(pickle.dumps(args))
+  else:
+    h.update(pickle.dumps(tuple(map(_key_part, args))))
+  if kwargs:
+    h.update(pickle.dumps({k: _key_part(v) for k, v in kwargs.items()}))
   # we don't hash the function name so that it's easier to debug
   key = func_name + h.digest()
   return key
 
 
-@contextlib.contextmanager
-def _acquire_timeout(lock, timeout, name):
-  thread = threading.current_thread()
-  orig_thread_name = thread.name
-  thread.name = orig_thread_name + f'(waiting:{name})'
-  result = lock.acquire(timeout=timeout)
-  if not result:
-    raise RuntimeError(f"Couldn't acquire lock for {name}.")
-  try:
-    thread.name = orig_thread_name + f'(lock:{name})'
-    yield
-  finally:
-    thread.name = orig_thread_name
-    if result:
-      lock.release()
+# HTTP status codes of errors that won't go away by retrying (e.g. disabled
+# APIs, missing permissions or resources), and of errors that probably will.
+_PERMANENT_ERROR_STATUSES = frozenset([403, 404])
+_RETRYABLE_ERROR_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def _error_expire(err: googleapiclient.errors.HttpError, expire: Optional[int]) -> Optional[int]:
+  """Returns for how long an API error should be cached.
+
+  Permanent errors are cached for cache_negative_ttl_seconds across executions
+  (0: until the end of the execution, whatever `expire` is), retryable errors
+  for cache_retryable_error_ttl_seconds (0: not cached), and other errors like
+  successful results: for `expire` seconds, or until the end of the execution
+  if None.
+  """
+  if err.status_code in _RETRYABLE_ERROR_STATUSES:
+    return config.get('cache_retryable_error_ttl_seconds') or 0
+  if err.status_code in _PERMANENT_ERROR_STATUSES:
+    return config.get('cache_negative_ttl_seconds') or None
+  return expire
 
 
-def cached_api_call(expire=None, in_memory=False):
+# Stored instead of the results of in_memory functions that can't be recorded
+# (e.g. API clients), which are executed again when replaying.
+_NOT_RECORDED = '__gcpdiag_not_recorded__'
+
+
+def _cache_miss_error(name: str) -> utils.GcpApiError:
+  return utils.GcpApiError(
+    response=f'no cached result for {name} (cache is read-only)', reason='CACHE_MISS'
+  )
+
+
+def cached_api_call(expire=None, in_memory=False, tiered=False, stale_while_revalidate=None):
   """Caching decorator optimized for API calls.
 
   This is very similar to functools.lru_cache, with the following differences:
   - uses SQLite persistent cache so that the memory footprint doesn't grow
     uncontrollably (the API results might be big).
-  - uses a lock so that if the function is called from two threads
-    simultaneously, only one API call will be done and the other will wait until
-    the result is available in the cache.
+  - if the function is called from multiple threads simultaneously with the
+    same arguments, only one API call will be done and the other callers will
+    wait for its result (see SingleFlight and wait_timeout).
 
   Parameters:
   - expire: number of seconds until the key expires (default: expire when the
-    process ends)
+    process ends). API errors (HttpError) are cached according to their HTTP
+    status, see _error_expire.
   - in_memory: if true the result will be kept in memory, similarly to
     lru_cache (but with the locking).
+  - tiered: if true the result is stored in the SQLite cache and additionally
+    kept decoded in a size-bounded in-memory LRU cache shared by all tiered
+    functions (see MemoryCache). Use this for functions that are called very
+    often with the same arguments, but whose results are too big to be kept in
+    memory unconditionally.
+  - stale_while_revalidate: number of seconds after `expire` during which an
+    expired result is still returned, while it is refreshed in the background
+    (see executor.submit_background). Results older than that are fetched
+    again synchronously. Use this for big documents that rarely change, so
+    that the execution hitting the expiration doesn't wait for them.
   """
+  if stale_while_revalidate and not isinstance(expire, int):
+    raise ValueError('stale_while_revalidate requires expire')
 
   def _cached_api_call_decorator(func):
-    lockdict = LockDict()
-    if in_memory:
-      lru_cached_func = functools.lru_cache()(func)
+    stats_name = f'{func.__module__}.{func.__qualname__}'
 
-    @functools.wraps(func)
-    def _cached_api_call_wrapper(*args, **kwargs):
-      key = None
-      if _use_cache:
-        logging.debug('looking up cache for %s', func.__name__)
-        key = _make_key(func, args, kwargs)
-        lock = lockdict[key]
-        with _acquire_timeout(lock, config.CACHE_LOCK_TIMEOUT, func.__name__):
-          if in_memory:
-            if _get_bypass_cache():
-              logging.debug('bypassing cache for %s, fetching fresh data.', func.__name__)
-              lru_cached_func.cache_clear()
-            return lru_cached_func(*args, **kwargs)
-          else:
-            api_cache = get_disk_cache()
-            if _get_bypass_cache():
-              logging.debug('bypassing cache for %s, fetching fresh data.', func.__name__)
-            else:
-              # We use 'no data' to be able to cache calls that returned None.
-              cached_result = api_cache.get(key, default='no data')
-              if cached_result != 'no data':
-                logging.debug('returning cached result for %s', func.__name__)
-                if isinstance(cached_result, Exception):
-                  raise cached_result
-                return cached_result
+    def _execute(*args, **kwargs):
+      profiling.count_api_call(miss=True)
+      start = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        _stats.record(
+          stats_name,
+          executions=1,
+          bypasses=int(_get_bypass_cache()),
+          call_time=time.perf_counter() - start,
+        )
+
+    def _replay(key, args, kwargs):
+      entry = get_disk_cache().get_entry(key)
+      if entry is None:
+        raise _cache_miss_error(func.__name__)
+      if isinstance(entry[0], str) and entry[0] == _NOT_RECORDED:
+        return _execute(*args, **kwargs)
+      if isinstance(entry[0], Exception):
+        _stats.record(stats_name, negative_hits=1)
+        raise entry[0]
+      return entry[0]
+
+    def _execute_in_memory(*args, **kwargs):
+      if not _readonly and not _session_record:
+        return _execute(*args, **kwargs)
+      key = _make_key(func, args, kwargs)
+      if _readonly:
+        return _replay(key, args, kwargs)
+      # Store the result in the disk cache too, so that it is part of the
+      # snapshot of this execution.
+      try:
+        result = _execute(*args, **kwargs)
+      except googleapiclient.errors.HttpError as err:
+        result = err
+      try:
+        get_disk_cache().set(key, result, tag='tmp')
+      except Exception as err:  # pylint: disable=broad-exception-caught
+        logging.debug("can't store result of %s in the cache: %s", func.__name__, err)
+        get_disk_cache().set(key, _NOT_RECORDED, tag='tmp')
+      if isinstance(result, Exception):
+        raise result
+      return result
+
+    if in_memory:
+      lru_cached_func = functools.lru_cache()(_execute_in_memory)
+
+    def _record_wait(seconds: float):
+      _stats.record(stats_name, waits=1, wait_time=seconds)
+
+    # Keys being refreshed in the background (stale_while_revalidate).
+    refreshing: Set[bytes] = set()
+    refreshing_lock = threading.Lock()
+
+    def _fresh_until(entry) -> Optional[float]:
+      # With stale_while_revalidate, results are stored with an expiration
+      # extended by the staleness period (errors are not).
+      if entry[2] is None or not stale_while_revalidate or isinstance(entry[0], Exception):
+        return entry[2]
+      return entry[2] - stale_while_revalidate
+
+    def _is_stale(entry) -> bool:
+      if not stale_while_revalidate or _readonly:
+        return False
+      fresh_until = _fresh_until(entry)
+      return fresh_until is not None and fresh_until < time.time()
+
+    def _refresh(key, args, kwargs):
+      # Share the execution with concurrent callers bypassing the cache.
+      refresh = functools.partial(
+        _flights.do,
+        (key, True),
+        functools.partial(_call, key, args, kwargs, refresh=True),
+        name=func.__name__,
+      )
+      try:
+        if _share_calls():
+          if not _shared_flights.try_do(get_disk_cache(), key, refresh):
+            logging.debug('%s is refreshed by another process', func.__name__)
+            return
+        else:
+          refresh()
+        logging.debug('refreshed stale result of %s', func.__name__)
+      except Exception as err:  # pylint: disable=broad-exception-caught
+        logging.debug('background refresh of %s failed: %s', func.__name__, err)
+      finally:
+        with refreshing_lock:
+          refreshing.discard(key)
+
+    def _revalidate(key, args, kwargs):
+      _stats.record(stats_name, stale_hits=1)
+      with refreshing_lock:
+        if key in refreshing:
+          return
+        refreshing.add(key)
+      logging.debug('returning stale result for %s, refreshing it', func.__name__)
+      executor.submit_background(_refresh, key, args, kwargs)
+
+    def _call(key, args, kwargs, refresh=False):
+      bypass = (_get_bypass_cache() or refresh) and not _readonly
+      if in_memory:
+        if bypass:
+          logging.debug('bypassing cache for %s, fetching fresh data.', func.__name__)
+          lru_cached_func.cache_clear()
+        return lru_cached_func(*args, **kwargs)
+      api_cache = get_disk_cache()
+      memory_cache = get_memory_cache() if tiered else None
+      if bypass:
+        logging.debug('bypassing cache for %s, fetching fresh data.', func.__name__)
       else:
-        logging.debug('caching is disabled for %s', func.__name__)
-      # Call the function
+        # We use 'no data' to be able to cache calls that returned None.
+        cached_result = 'no data'
+        if memory_cache is not None:
+          cached_result = memory_cache.get(key, default='no data')
+          _count_tier('memory', cached_result != 'no data')
+        if cached_result == 'no data':
+          entry = api_cache.get_entry(key)
+          _count_tier('disk', entry is not None)
+          if entry is not None:
+            cached_result = entry[0]
+            if _is_stale(entry):
+              _revalidate(key, args, kwargs)
+            elif memory_cache is not None:
+              # Expired entries are only returned in read-only mode.
+              memory_cache.set(key, entry[0], entry[1], None if _readonly else _fresh_until(entry))
+        if cached_result != 'no data':
+          logging.debug('returning cached result for %s', func.__name__)
+          return _return_cached(cached_result)
+      if _readonly:
+        raise _cache_miss_error(func.__name__)
+      execute = functools.partial(
+        _execute_and_store, key, args, kwargs, api_cache, memory_cache, refresh
+      )
+      if expire and not bypass and _share_calls():
+        # Results that expire are reused by the other processes using the
+        # cache, so only one of them needs to call the API.
+        return _shared_flights.do(
+          api_cache,
+          key,
+          execute,
+          lambda entry: _return_cached(entry[0]),
+          name=func.__name__,
+          timeout=_get_wait_timeout(),
+          on_wait=_record_wait,
+        )
+      return execute()
+
+    def _return_cached(cached_result):
+      if isinstance(cached_result, Exception):
+        _stats.record(stats_name, negative_hits=1)
+        raise cached_result
+      return cached_result
+
+    def _execute_and_store(key, args, kwargs, api_cache, memory_cache, refresh):
       logging.debug('calling function %s (expire=%s, key=%s)', func.__name__, str(expire), str(key))
-      result = None
       try:
-        result = func(*args, **kwargs)
+        result = _execute(*args, **kwargs)
         logging.debug(
           'DONE calling function %s (expire=%s, key=%s)', func.__name__, str(expire), str(key)
         )
       except googleapiclient.errors.HttpError as err:
-        # cache API errors as well
+        # cache API errors as well (see _error_expire)
         result = err
-      if _use_cache:
-        if expire:
-          api_cache.set(key, result, expire=expire)
+      finally:
+        if refresh:
+          _stats.record(stats_name, refreshes=1)
+      result_expire = expire
+      if isinstance(result, googleapiclient.errors.HttpError):
+        result_expire = _error_expire(result, expire)
+      if refresh and isinstance(result, Exception):
+        # Keep serving the stale result until stale_while_revalidate is over.
+        logging.debug('not caching error of %s refresh', func.__name__)
+      elif result_expire is not None and result_expire <= 0:
+        logging.debug('not caching %s error of %s', result.status_code, func.__name__)
+      else:
+        if result_expire and stale_while_revalidate and not isinstance(result, Exception):
+          size = api_cache.set(key, result, expire=result_expire + stale_while_revalidate)
+        elif result_expire:
+          size = api_cache.set(key, result, expire=result_expire)
         else:
-          api_cache.set(key, result, tag='tmp')
+          size = api_cache.set(key, result, tag='tmp')
+        _stats.record(stats_name, size=size)
+        if memory_cache is not None:
+          memory_cache.set(
+            key, result, size, time.time() + result_expire if result_expire else None
+          )
       if isinstance(result, Exception):
         raise result
       return result
 
+    @functools.wraps(func)
+    def _cached_api_call_wrapper(*args, **kwargs):
+      if not _use_cache:
+        logging.debug('caching is disabled for %s', func.__name__)
+        return func(*args, **kwargs)
+      logging.debug('looking up cache for %s', func.__name__)
+      _stats.record(stats_name, calls=1)
+      profiling.count_api_call()
+      key = _make_key(func, args, kwargs)
+      if _session_record:
+        _session_keys.add(key)
+      # Callers bypassing the cache must not get the result of a concurrent
+      # call that was served from the cache.
+      recording = fingerprints.begin_call()
+      try:
+        with tracing.span(func.__name__, 'cache'):
+          result = _flights.do(
+            (key, _get_bypass_cache()),
+            functools.partial(_call, key, args, kwargs),
+            name=func.__name__,
+            timeout=_get_wait_timeout(),
+            on_wait=_record_wait,
+          )
+      except Exception as err:
+        fingerprints.record_call(recording, func, args, kwargs, err)
+        raise
+      finally:
+        fingerprints.end_call(recording)
+      fingerprints.record_call(recording, func, args, kwargs, result)
+      return result
+
     return _cached_api_call_wrapper
 
   # Decorator without parens -> called with function as first parameter
@@ -495,3 +2163,101 @@ def cached_api_call(expire=None, in_memory=False):
     return _cached_api_call_decorator(func)
   else:
     return _cached_api_call_decorator
+
+
+def async_cached_api_call(expire=None):
+  """Caching decorator for coroutine functions, e.g. of async_queries gateways.
+
+  This is the equivalent of cached_api_call for coroutines, using the same
+  SQLite cache, cache keys and statistics, so that results are shared by all
+  callers and across executions (with `expire`):
+  - concurrent calls with the same arguments in an event loop are executed
+    only once: the call runs in a task, and the other callers await it. A
+    caller being cancelled doesn't cancel the call for the others.
+  - the disk cache is accessed in the I/O thread pool (see
+    executor.submit_io), so that the event loop never blocks on disk I/O, and
+    lookups don't wait for the tasks queued in the shared thread pool.
+  - exceptions are not cached.
+
+  Arguments that aren't plain values should implement __cache_key__ (see
+  _make_key), e.g. to identify a gateway by the project it queries and not by
+  the API client it uses.
+
+  Parameters:
+  - expire: number of seconds until the key expires (default: expire when the
+    process ends)
+  """
+
+  def _async_cached_api_call_decorator(func):
+    stats_name = f'{func.__module__}.{func.__qualname__}'
+    # Calls in progress, per event loop.
+    tasks: Dict[Tuple[asyncio.AbstractEventLoop, bytes, bool], asyncio.Task] = {}
+
+    def _in_executor(fn, *args):
+      return asyncio.wrap_future(executor.submit_io(fn, *args))
+
+    def _lookup(key):
+      return get_disk_cache().get_entry(key)
+
+    def _store(key, result):
+      if expire:
+        return get_disk_cache().set(key, result, expire=expire)
+      return get_disk_cache().set(key, result, tag='tmp')
+
+    async def _call(key, bypass, args, kwargs):
+      if bypass:
+        logging.debug('bypassing cache for %s, fetching fresh data.', func.__name__)
+      else:
+        entry = await _in_executor(_lookup, key)
+        if entry is not None:
+          logging.debug('returning cached result for %s', func.__name__)
+          if isinstance(entry[0], Exception):
+            _stats.record(stats_name, negative_hits=1)
+            raise entry[0]
+          return entry[0]
+      if _readonly:
+        raise _cache_miss_error(func.__name__)
+      start = time.perf_counter()
+      try:
+        result = await func(*args, **kwargs)
+      finally:
+        _stats.record(
+          stats_name,
+          executions=1,
+          bypasses=int(bypass),
+          call_time=time.perf_counter() - start,
+        )
+      size = await _in_executor(_store, key, result)
+      _stats.record(stats_name, size=size)
+      return result
+
+    @functools.wraps(func)
+    async def _async_cached_api_call_wrapper(*args, **kwargs):
+      if not _use_cache:
+        return await func(*args, **kwargs)
+      _stats.record(stats_name, calls=1)
+      key = _make_key(func, args, kwargs)
+      if _session_record:
+        _session_keys.add(key)
+      bypass = _get_bypass_cache() and not _readonly
+      loop = asyncio.get_running_loop()
+      task_key = (loop, key, bypass)
+      task = tasks.get(task_key)
+      if task is None:
+        task = tasks[task_key] = loop.create_task(_call(key, bypass, args, kwargs))
+        task.add_done_callback(lambda _: tasks.pop(task_key, None))
+        return await asyncio.shield(task)
+      start = time.perf_counter()
+      try:
+        return await asyncio.shield(task)
+      finally:
+        _stats.record(stats_name, waits=1, wait_time=time.perf_counter() - start)
+
+    return _async_cached_api_call_wrapper
+
+  # Decorator without parens -> called with function as first parameter
+  if callable(expire):
+    func = expire
+    expire = None
+    return _async_cached_api_call_decorator(func)
+  return _async_cached_api_call_decorator
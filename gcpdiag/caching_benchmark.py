@@ -0,0 +1,279 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmarks for caching.py.
+
+Usage: python -m gcpdiag.caching_benchmark [BENCHMARK ...]
+
+Without arguments all benchmarks are executed. The benchmarks use a temporary
+directory and never touch the user cache.
+"""
+
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from gcpdiag import caching
+
+# Number of operations per benchmark run.
+OPS = 2000
+THREADS = 20
+
+TEST_DATA_DIR = pathlib.Path(__file__).parent.parent / 'test-data'
+
+
+class _ConnectPerCallCache(caching.SQLiteCache):
+  """SQLiteCache that opens a new connection for every operation (old behavior)."""
+
+  def _conn(self) -> sqlite3.Connection:
+    return sqlite3.connect(self.db_path, timeout=30.0)
+
+
+def _ops_per_sec(fn: Callable[[int], None], ops: int, threads: int) -> float:
+  start = time.perf_counter()
+  if threads == 1:
+    for i in range(ops):
+      fn(i)
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+      list(pool.map(fn, range(ops)))
+  return ops / (time.perf_counter() - start)
+
+
+def bench_get_set():
+  """SQLiteCache get/set throughput, with and without connection reuse."""
+  value = {'items': [{'name': f'instance-{i}', 'status': 'RUNNING'} for i in range(20)]}
+  print(f'{"cache":<18} {"threads":>7} {"set/s":>10} {"get/s":>10}')
+  for name, cls in [('connect-per-call', _ConnectPerCallCache), ('pooled', caching.SQLiteCache)]:
+    for threads in [1, THREADS]:
+      with tempfile.TemporaryDirectory() as d:
+        cache = cls(d)
+        set_rate = _ops_per_sec(
+          lambda i, c=cache: c.set(b'key-%d' % i, value, tag='tmp'), OPS, threads
+        )
+        get_rate = _ops_per_sec(lambda i, c=cache: c.get(b'key-%d' % i), OPS, threads)
+        cache.close()
+      print(f'{name:<18} {threads:>7} {set_rate:>10.0f} {get_rate:>10.0f}')
+
+
+def _load_json_dumps() -> List[Any]:
+  values = []
+  for path in sorted(glob.glob(str(TEST_DATA_DIR / '*' / 'json-dumps' / '*.json'))):
+    with open(path, encoding='utf-8') as f:
+      try:
+        values.append(json.load(f))
+      except json.JSONDecodeError:
+        continue
+  return values
+
+
+def bench_compression():
+  """Cache size and read latency per compression codec (test-data json-dumps)."""
+  values = _load_json_dumps()
+  print(f'{len(values)} API responses from {TEST_DATA_DIR}')
+  print(f'{"codec":<8} {"min bytes":>9} {"values MB":>10} {"db MB":>8} {"set us":>8} {"get us":>8}')
+  for codec in [''] + sorted(c for c in caching._CODECS if c):
+    for min_bytes in [0, 4096]:
+      if not codec and min_bytes:
+        continue
+      with tempfile.TemporaryDirectory() as d:
+        cache = caching.SQLiteCache(d, compression=codec, compression_min_bytes=min_bytes)
+        start = time.perf_counter()
+        for i, value in enumerate(values):
+          cache.set(b'key-%d' % i, value, tag='tmp')
+        set_us = (time.perf_counter() - start) / len(values) * 1e6
+        start = time.perf_counter()
+        for i in range(len(values)):
+          cache.get(b'key-%d' % i)
+        get_us = (time.perf_counter() - start) / len(values) * 1e6
+        _, size = cache.totals()
+        with cache._conn() as conn:
+          conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        cache.close()
+        db_size = os.path.getsize(cache.db_path)
+      print(
+        f'{codec or "none":<8} {min_bytes:>9} {size / 2**20:>10.2f} {db_size / 2**20:>8.2f}'
+        f' {set_us:>8.0f} {get_us:>8.0f}'
+      )
+
+
+def _time_us(fn: Callable[[], Any], repeat: int = 5) -> float:
+  start = time.perf_counter()
+  for _ in range(repeat):
+    fn()
+  return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench_serializer():
+  """Encode/decode time and size per serializer (test-data json-dumps)."""
+  # pylint: disable=import-outside-toplevel
+  from gcpdiag.queries import gce
+
+  values = _load_json_dumps()
+  instances = [
+    {i['name']: gce.Instance(i.get('zone', 'p'), i) for i in v.get('items', [])}
+    for v in values
+    if isinstance(v, dict) and v.get('kind') == 'compute#instanceList'
+  ]
+  print(f'{"values":<20} {"serializer":<10} {"KB":>8} {"dumps us":>9} {"loads us":>9}')
+  for label, dataset in [('api responses', values), ('gce.Instance dicts', instances)]:
+    for serializer, (dumps, loads) in caching._SERIALIZERS.items():
+      encoded = [dumps(v) for v in dataset]
+      size = sum(len(e) for e in encoded if e) / 1024
+      dumps_us = _time_us(lambda d=dumps, ds=dataset: [d(v) for v in ds])
+      loads_us = _time_us(lambda ld=loads, es=encoded: [ld(e) for e in es if e])
+      print(f'{label:<20} {serializer:<10} {size:>8.0f} {dumps_us:>9.0f} {loads_us:>9.0f}')
+
+
+INGEST_ENTRIES = 10000
+
+
+def bench_ingest():
+  """SQLiteDeque.appendleft ingestion of 10k log entries (test-data logging-entries)."""
+  entries = _load_log_entries(INGEST_ENTRIES)
+  print(f'{"write batch size":<18} {"entries/s":>10}')
+  for batch_size in [1, 100, caching._WRITE_BATCH_SIZE]:
+    with tempfile.TemporaryDirectory() as d:
+      deque = caching.SQLiteDeque(d, write_batch_size=batch_size)
+      start = time.perf_counter()
+      for e in entries:
+        deque.appendleft(e)
+      deque.flush()
+      rate = len(entries) / (time.perf_counter() - start)
+      assert len(deque) == len(entries)
+      caching._connections.close(deque.db_path)
+    print(f'{batch_size:<18} {rate:>10.0f}')
+
+
+class _FetchAllDeque(caching.SQLiteDeque):
+  """SQLiteDeque that reads all rows before iterating and counts rows (old behavior)."""
+
+  def __len__(self) -> int:
+    self.flush()
+    with self._conn() as conn:
+      return conn.execute('SELECT COUNT(*) FROM deque').fetchone()[0]
+
+  def __iter__(self):
+    self.flush()
+    with self._conn() as conn:
+      rows = conn.execute('SELECT value FROM deque ORDER BY id DESC').fetchall()
+    for row in rows:
+      yield pickle.loads(row[0])
+
+
+def _load_log_entries(count: int) -> List[Any]:
+  with open(
+    TEST_DATA_DIR / 'gce5' / 'json-dumps' / 'logging-entries-1.json', encoding='utf-8'
+  ) as f:
+    fixture = json.load(f)['entries']
+  return [fixture[i % len(fixture)] for i in range(count)]
+
+
+def bench_deque_iter():
+  """SQLiteDeque memory peak and time iterating over a 10k entries log job."""
+  entries = _load_log_entries(INGEST_ENTRIES)
+  print(f'{"deque":<10} {"peak MB":>8} {"iter ms":>8} {"len us":>8}')
+  for name, cls in [('fetchall', _FetchAllDeque), ('streaming', caching.SQLiteDeque)]:
+    with tempfile.TemporaryDirectory() as d:
+      deque = cls(d)
+      deque.extendleft(entries)
+      tracemalloc.start()
+      start = time.perf_counter()
+      for _ in deque:
+        pass
+      iter_ms = (time.perf_counter() - start) * 1000
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      len_us = _time_us(lambda dq=deque: len(dq), repeat=100)
+      caching._connections.close(deque.db_path)
+    print(f'{name:<10} {peak / 2**20:>8.1f} {iter_ms:>8.0f} {len_us:>8.1f}')
+
+
+def _pickle_make_key(func, args, kwargs):
+  """_make_key() before the __cache_key__ protocol."""
+  h = hashlib.sha256()
+  func_name = bytes(func.__module__ + '.' + func.__name__ + ':', 'utf-8')
+  h.update(pickle.dumps(args))
+  h.update(pickle.dumps(kwargs))
+  return func_name + h.digest()
+
+
+def bench_make_key():
+  """Cache key generation time for typical call signatures."""
+  # pylint: disable=import-outside-toplevel
+  from gcpdiag import models
+  from gcpdiag.queries import gce
+
+  with open(
+    TEST_DATA_DIR / 'gce1' / 'json-dumps' / 'compute-instances-europe-west1-b-2.json',
+    encoding='utf-8',
+  ) as f:
+    instance = gce.Instance('gcpdiag-gce1-aaaa', json.load(f)['items'][0])
+  context = models.Context(
+    project_id='gcpdiag-gce1-aaaa',
+    locations=['us-central1', 'europe-west4-a'],
+    labels={'env': 'prod'},
+    resources=['gce1', 'gke-*'],
+  )
+  signatures = [
+    ('project_id', ('gcpdiag-gce1-aaaa',), {}),
+    ('project_id, zone, name', ('gcpdiag-gce1-aaaa', 'us-central1-a', 'vm1'), {}),
+    ('context', (models.Context(project_id='gcpdiag-gce1-aaaa'),), {}),
+    ('scoped context', (context,), {}),
+    ('context, kwarg', (context,), {'raise_error_if_fails': False}),
+    ('gce.Instance', (instance,), {}),
+  ]
+  print(f'{"signature":<24} {"pickle us":>10} {"protocol us":>12}')
+  for label, args, kwargs in signatures:
+    times = []
+    for make_key in [_pickle_make_key, caching._make_key]:
+      start = time.perf_counter()
+      for _ in range(OPS):
+        make_key(bench_make_key, args, kwargs)
+      times.append((time.perf_counter() - start) / OPS * 1e6)
+    print(f'{label:<24} {times[0]:>10.2f} {times[1]:>12.2f}')
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+  'get_set': bench_get_set,
+  'compression': bench_compression,
+  'serializer': bench_serializer,
+  'ingest': bench_ingest,
+  'deque_iter': bench_deque_iter,
+  'make_key': bench_make_key,
+}
+
+
+def main(argv):
+  names = argv[1:] or list(BENCHMARKS)
+  for name in names:
+    if name not in BENCHMARKS:
+      print(f'ERROR: unknown benchmark {name}. Available: {", ".join(BENCHMARKS)}', file=sys.stderr)
+      return 1
+    print(f'== {name}: {BENCHMARKS[name].__doc__}')
+    BENCHMARKS[name]()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -13,15 +13,27 @@
 # limitations under the License.
 """Test code in caching.py."""
 
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import json
+import pathlib
+import pickle
 import secrets
+import sqlite3
 import string
+import tempfile
 import threading
+import time
 import unittest
 from unittest import mock
 
+import httplib2
 from googleapiclient import errors
 
-from gcpdiag import caching
+from gcpdiag import caching, config, models, utils
+from gcpdiag.executor import TaskCancelledError
 
 
 def simple_function(mixer_arg):
@@ -32,6 +44,15 @@ def simple_function(mixer_arg):
 # Decorated versions of the simple_function for in-memory and disk cache testing
 cached_in_memory = caching.cached_api_call(in_memory=True)(simple_function)
 cached_on_disk = caching.cached_api_call(simple_function)
+cached_tiered = caching.cached_api_call(tiered=True)(simple_function)
+
+
+def _enable_global_cache(test_case: unittest.TestCase):
+  """Enables the cache for `test_case`, whatever previous tests configured
+  (see UseCacheTests)."""
+  enabled = caching._use_cache
+  caching.configure_global_cache(enabled=True)
+  test_case.addCleanup(caching.configure_global_cache, enabled=enabled)
 
 
 class CacheBypassTests(unittest.TestCase):
@@ -131,3 +152,1168 @@ class UseCacheTests(unittest.TestCase):
 
     with self.assertRaises(errors.HttpError):
       failing_function()
+
+
+class MemoryCacheTests(unittest.TestCase):
+  """Testing the in-memory LRU tier"""
+
+  def test_lru_max_entries(self):
+    cache = caching.MemoryCache(max_entries=2)
+    cache.set(b'a', 1, 10)
+    cache.set(b'b', 2, 10)
+    cache.get(b'a')
+    cache.set(b'c', 3, 10)
+    self.assertEqual(cache.get(b'a'), 1)
+    self.assertIsNone(cache.get(b'b'))
+    self.assertEqual(cache.get(b'c'), 3)
+    self.assertEqual(cache.size, 20)
+
+  def test_max_size(self):
+    cache = caching.MemoryCache(max_size_bytes=100)
+    cache.set(b'a', 1, 60)
+    cache.set(b'b', 2, 60)
+    self.assertIsNone(cache.get(b'a'))
+    self.assertEqual(cache.get(b'b'), 2)
+    # values bigger than the whole budget are not stored
+    cache.set(b'c', 3, 200)
+    self.assertIsNone(cache.get(b'c'))
+    self.assertEqual((len(cache), cache.size), (1, 60))
+
+  def test_expired(self):
+    cache = caching.MemoryCache()
+    cache.set(b'a', 1, 10, expire_time=1)
+    self.assertEqual(cache.get(b'a', default='no data'), 'no data')
+    self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class TieredCacheTests(unittest.TestCase):
+  """Testing cached_api_call(tiered=True)"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.disk_cache = caching.SQLiteCache(self.temp_dir.name)
+    self.memory_cache = caching.MemoryCache(max_entries=10)
+    for patcher in [
+      mock.patch('gcpdiag.caching.get_disk_cache', return_value=self.disk_cache),
+      mock.patch('gcpdiag.caching.get_memory_cache', return_value=self.memory_cache),
+      mock.patch('gcpdiag.caching._tier_counters', caching.collections.Counter()),
+    ]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def tearDown(self):
+    self.disk_cache.close()
+    self.temp_dir.cleanup()
+
+  def test_memory_hit_returns_same_object(self):
+    result = cached_tiered('same-arg')
+    self.assertIs(cached_tiered('same-arg'), result)
+    self.assertEqual(
+      caching.get_tier_stats(),
+      {'memory': {'hits': 1, 'misses': 1}, 'disk': {'hits': 0, 'misses': 1}},
+    )
+
+  def test_disk_hit_fills_memory(self):
+    result = cached_tiered('same-arg')
+    self.memory_cache.clear()
+    self.assertEqual(cached_tiered('same-arg'), result)
+    self.assertEqual(len(self.memory_cache), 1)
+    self.assertEqual(cached_tiered('same-arg'), result)
+    self.assertEqual(
+      caching.get_tier_stats(),
+      {'memory': {'hits': 1, 'misses': 2}, 'disk': {'hits': 1, 'misses': 1}},
+    )
+
+  def test_bypass(self):
+    result = cached_tiered('same-arg')
+    with caching.bypass_cache():
+      result_bypass = cached_tiered('same-arg')
+    self.assertNotEqual(result, result_bypass)
+    self.assertEqual(cached_tiered('same-arg'), result_bypass)
+
+
+class SingleFlightTests(unittest.TestCase):
+  """Testing deduplication of concurrent calls"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.flights = caching.SingleFlight()
+    self.started = threading.Event()
+    self.release = threading.Event()
+    self.calls = 0
+
+  def _slow_call(self, result=None, exception=None):
+    self.calls += 1
+    self.started.set()
+    self.release.wait(10)
+    if exception:
+      raise exception
+    return result
+
+  def _start_leader(self, **kwargs):
+    outcome = {}
+
+    def run():
+      try:
+        outcome['result'] = self.flights.do(
+          'key', functools.partial(self._slow_call, **kwargs), name='slow'
+        )
+      except ValueError as err:
+        outcome['error'] = err
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    self.started.wait(10)
+    return thread, outcome
+
+  def _wait_for_waiters(self, count):
+    while self.flights.stats()['waiting'] < count:
+      time.sleep(0.001)
+
+  def test_concurrent_calls_deduplicated(self):
+    leader, outcome = self._start_leader(result='value')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+      waiters = [
+        executor.submit(self.flights.do, 'key', self._slow_call, 'slow', 10) for _ in range(3)
+      ]
+      self._wait_for_waiters(3)
+      self.assertEqual(self.flights.stats(), {'in_flight': 1, 'waiting': 3})
+      self.assertEqual(self.flights.in_flight(), {'slow': 1})
+      self.release.set()
+      self.assertEqual([w.result() for w in waiters], ['value'] * 3)
+    leader.join()
+    self.assertEqual(outcome['result'], 'value')
+    self.assertEqual(self.calls, 1)
+    self.assertEqual(self.flights.stats(), {'in_flight': 0, 'waiting': 0})
+
+  def test_exception_shared(self):
+    error = ValueError('boom')
+    leader, outcome = self._start_leader(exception=error)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      waiter = executor.submit(self.flights.do, 'key', self._slow_call, 'slow', 10)
+      self._wait_for_waiters(1)
+      self.release.set()
+      self.assertIs(waiter.exception(), error)
+    leader.join()
+    self.assertIs(outcome['error'], error)
+    self.assertEqual(self.calls, 1)
+
+  def test_cancelled_leader(self):
+    error = TaskCancelledError('executor shut down')
+    outcome = {}
+
+    def run_leader():
+      try:
+        self.flights.do('key', functools.partial(self._slow_call, exception=error), name='slow')
+      except TaskCancelledError as err:
+        outcome['error'] = err
+
+    leader = threading.Thread(target=run_leader)
+    leader.start()
+    self.started.wait(10)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+      waiter = pool.submit(
+        self.flights.do, 'key', functools.partial(self._slow_call, result='value'), 'slow', 10
+      )
+      self._wait_for_waiters(1)
+      self.release.set()
+      # the waiter isn't cancelled: it executes the call instead
+      self.assertEqual(waiter.result(10), 'value')
+    leader.join()
+    self.assertIs(outcome['error'], error)
+    self.assertEqual(self.calls, 2)
+    self.assertEqual(self.flights.stats(), {'in_flight': 0, 'waiting': 0})
+
+  def test_waiter_timeout(self):
+    leader, outcome = self._start_leader(result='value')
+    with self.assertRaises(caching.CacheWaitTimeoutError):
+      self.flights.do('key', self._slow_call, 'slow', timeout=0.01)
+    # the call in flight isn't affected by the waiter giving up
+    self.assertEqual(self.flights.stats(), {'in_flight': 1, 'waiting': 0})
+    self.release.set()
+    leader.join()
+    self.assertEqual(outcome['result'], 'value')
+
+  def test_cached_api_call_wait_timeout(self):
+    started = threading.Event()
+    release = threading.Event()
+
+    @caching.cached_api_call
+    def slow_function(arg):
+      started.set()
+      release.wait(10)
+      return arg
+
+    leader = threading.Thread(target=slow_function, args=('a',))
+    leader.start()
+    started.wait(10)
+    with caching.wait_timeout(0.01), self.assertRaises(caching.CacheWaitTimeoutError):
+      slow_function('a')
+    release.set()
+    leader.join()
+    self.assertEqual(slow_function('a'), 'a')
+
+
+class CacheStatsTests(unittest.TestCase):
+  """Testing the per-function cache statistics"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    patcher = mock.patch('gcpdiag.caching._stats', caching.CacheStats())
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_disk_cached_function(self):
+    name = 'gcpdiag.caching_test.simple_function'
+    cached_on_disk('stats-arg')
+    cached_on_disk('stats-arg')
+    with caching.bypass_cache():
+      cached_on_disk('stats-arg')
+    stats = caching.get_stats()[name]
+    self.assertEqual(
+      {k: stats[k] for k in ['calls', 'hits', 'misses', 'bypasses', 'executions', 'waits']},
+      {'calls': 3, 'hits': 1, 'misses': 1, 'bypasses': 1, 'executions': 2, 'waits': 0},
+    )
+    self.assertGreater(stats['size'], 0)
+    self.assertGreater(stats['call_time'], 0)
+    self.assertIn('caching_test.simple_function', caching.format_stats(caching.get_stats()))
+
+  def test_in_memory_function(self):
+    cached_in_memory('stats-arg')
+    cached_in_memory('stats-arg')
+    stats = caching.get_stats()['gcpdiag.caching_test.simple_function']
+    self.assertEqual((stats['calls'], stats['hits'], stats['misses']), (2, 1, 1))
+
+  def test_report_json(self):
+    cached_on_disk('stats-arg')
+    with tempfile.TemporaryDirectory() as d:
+      path = pathlib.Path(d) / 'stats.json'
+      caching._report_stats(str(path))
+      report = json.loads(path.read_text(encoding='utf-8'))
+    self.assertEqual(report['functions']['gcpdiag.caching_test.simple_function']['calls'], 1)
+    self.assertIn('memory', report['tiers'])
+    self.assertIn('concurrency_limits', report)
+
+
+class NegativeCacheTests(unittest.TestCase):
+  """Testing the caching of API errors per HTTP status"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.disk_cache = caching.SQLiteCache(self.temp_dir.name)
+    for patcher in [
+      mock.patch('gcpdiag.caching.get_disk_cache', return_value=self.disk_cache),
+      mock.patch('gcpdiag.caching._stats', caching.CacheStats()),
+    ]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.calls = 0
+
+  def tearDown(self):
+    self.disk_cache.close()
+    self.temp_dir.cleanup()
+
+  def _failing_function(self, status, expire=None):
+    @caching.cached_api_call(expire=expire)
+    def failing_function():
+      self.calls += 1
+      raise errors.HttpError(httplib2.Response({'status': status}), b'error')
+
+    return failing_function
+
+  def test_permanent_error_cached_for_execution(self):
+    failing_function = self._failing_function(403)
+    for _ in range(2):
+      with self.assertRaises(errors.HttpError):
+        failing_function()
+    self.assertEqual(self.calls, 1)
+    with self.disk_cache._conn() as conn:
+      (expire,) = conn.execute('SELECT expire FROM cache').fetchone()
+    self.assertIsNone(expire)
+
+  def test_permanent_error_of_expiring_function_cached_for_execution(self):
+    # the expiration of the results doesn't apply to permanent errors
+    failing_function = self._failing_function(404, expire=3600)
+    for _ in range(2):
+      with self.assertRaises(errors.HttpError):
+        failing_function()
+    self.assertEqual(self.calls, 1)
+    with self.disk_cache._conn() as conn:
+      row = conn.execute('SELECT expire, tag FROM cache').fetchone()
+    self.assertEqual(tuple(row), (None, 'tmp'))
+
+  def test_permanent_error_cached_with_ttl(self):
+    failing_function = self._failing_function(404)
+    with mock.patch.dict(caching.config._defaults, {'cache_negative_ttl_seconds': 600}):
+      for _ in range(2):
+        with self.assertRaises(errors.HttpError):
+          failing_function()
+    self.assertEqual(self.calls, 1)
+    with self.disk_cache._conn() as conn:
+      (expire,) = conn.execute('SELECT expire FROM cache').fetchone()
+    self.assertAlmostEqual(expire, time.time() + 600, delta=60)
+    (stats,) = caching.get_stats().values()
+    self.assertEqual((stats['hits'], stats['negative_hits']), (1, 1))
+
+  def test_retryable_error_not_cached(self):
+    failing_function = self._failing_function(503)
+    for _ in range(2):
+      with self.assertRaises(errors.HttpError):
+        failing_function()
+    self.assertEqual(self.calls, 2)
+    self.assertEqual(self.disk_cache.totals()[0], 0)
+
+  def test_retryable_error_ttl(self):
+    failing_function = self._failing_function(429)
+    with mock.patch.dict(caching.config._defaults, {'cache_retryable_error_ttl_seconds': 5}):
+      for _ in range(2):
+        with self.assertRaises(errors.HttpError):
+          failing_function()
+    self.assertEqual(self.calls, 1)
+
+  def test_other_error_cached_for_execution(self):
+    failing_function = self._failing_function(400)
+    for _ in range(2):
+      with self.assertRaises(errors.HttpError):
+        failing_function()
+    self.assertEqual(self.calls, 1)
+    with self.disk_cache._conn() as conn:
+      self.assertEqual(conn.execute('SELECT tag FROM cache').fetchone(), ('tmp',))
+
+
+class StaleWhileRevalidateTests(unittest.TestCase):
+  """Testing cached_api_call(stale_while_revalidate=...)"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.disk_cache = caching.SQLiteCache(self.temp_dir.name)
+    self.refreshes = []
+
+    def submit_background(fn, *args):
+      future = concurrent.futures.Future()
+      future.set_result(None)
+      self.refreshes.append(functools.partial(fn, *args))
+      return future
+
+    for patcher in [
+      mock.patch('gcpdiag.caching.get_disk_cache', return_value=self.disk_cache),
+      mock.patch('gcpdiag.caching._stats', caching.CacheStats()),
+      mock.patch('gcpdiag.executor.submit_background', side_effect=submit_background),
+    ]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.results = ['first', 'second']
+
+    @caching.cached_api_call(expire=60, stale_while_revalidate=3600)
+    def document():
+      result = self.results.pop(0)
+      if isinstance(result, Exception):
+        raise result
+      return result
+
+    self.document = document
+
+  def tearDown(self):
+    self.disk_cache.close()
+    self.temp_dir.cleanup()
+
+  def _age(self, seconds):
+    with self.disk_cache._conn() as conn:
+      conn.execute('UPDATE cache SET expire = expire - ?', (seconds,))
+
+  def test_fresh(self):
+    self.assertEqual(self.document(), 'first')
+    self.assertEqual(self.document(), 'first')
+    self.assertEqual(self.refreshes, [])
+
+  def test_stale_refreshed_in_background(self):
+    self.assertEqual(self.document(), 'first')
+    self._age(120)
+    self.assertEqual(self.document(), 'first')
+    # only one refresh for concurrent stale hits
+    self.assertEqual(self.document(), 'first')
+    self.assertEqual(len(self.refreshes), 1)
+    self.refreshes.pop()()
+    self.assertEqual(self.document(), 'second')
+    (stats,) = caching.get_stats().values()
+    self.assertEqual(
+      {k: stats[k] for k in ['calls', 'hits', 'misses', 'stale_hits', 'refreshes']},
+      {'calls': 4, 'hits': 3, 'misses': 1, 'stale_hits': 2, 'refreshes': 1},
+    )
+
+  def test_max_staleness(self):
+    self.assertEqual(self.document(), 'first')
+    self._age(60 + 3600)
+    self.assertEqual(self.document(), 'second')
+    self.assertEqual(self.refreshes, [])
+
+  def test_failed_refresh_keeps_stale_result(self):
+    self.results = ['first', errors.HttpError(httplib2.Response({'status': 404}), b'')]
+    self.document()
+    self._age(120)
+    self.document()
+    self.refreshes.pop()()
+    self.assertEqual(self.document(), 'first')
+    self.assertEqual(len(self.refreshes), 1)
+
+  def test_requires_expire(self):
+    with self.assertRaises(ValueError):
+      caching.cached_api_call(stale_while_revalidate=60)
+
+
+class SharedFlightTests(unittest.TestCase):
+  """Testing the deduplication of calls across processes"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.cache = caching.SQLiteCache(self.temp_dir.name)
+    self.flight = caching.SharedFlight(lease_seconds=0.3, poll_interval=0.01)
+
+  def tearDown(self):
+    self.cache.close()
+    self.temp_dir.cleanup()
+
+  def _other_process_stores(self, value):
+    """Simulates another process holding the lease and storing `value`."""
+    self.assertTrue(self.cache.acquire_lease(b'key', 'other', 10))
+
+    def store():
+      time.sleep(0.05)
+      if value is not None:
+        self.cache.set(b'key', value, expire=60)
+      self.cache.release_lease(b'key', 'other')
+
+    thread = threading.Thread(target=store)
+    thread.start()
+    self.addCleanup(thread.join)
+
+  def test_leases(self):
+    self.assertTrue(self.cache.acquire_lease(b'key', 'a', 10))
+    self.assertTrue(self.cache.acquire_lease(b'key', 'a', 10))
+    self.assertFalse(self.cache.acquire_lease(b'key', 'b', 10))
+    self.assertEqual(self.cache.renew_leases('a', -1), 1)
+    # expired
+    self.assertTrue(self.cache.acquire_lease(b'key', 'b', 10))
+    self.cache.release_lease(b'key', 'b')
+    self.assertTrue(self.cache.acquire_lease(b'key', 'a', 10))
+
+  def test_result_of_other_process(self):
+    self._other_process_stores('other result')
+    waits = []
+    fn = mock.Mock()
+    result = self.flight.do(self.cache, b'key', fn, lambda e: e[0], on_wait=waits.append)
+    self.assertEqual(result, 'other result')
+    fn.assert_not_called()
+    self.assertEqual(len(waits), 1)
+
+  def test_lease_released_without_result(self):
+    self._other_process_stores(None)
+    self.assertEqual(self.flight.do(self.cache, b'key', lambda: 'mine', lambda e: e[0]), 'mine')
+    # the lease is released after the call
+    self.assertTrue(self.cache.acquire_lease(b'key', 'other', 10))
+
+  def test_heartbeat(self):
+    def slow():
+      time.sleep(0.6)
+      return self.cache.acquire_lease(b'key', 'other', 10)
+
+    self.assertFalse(self.flight.do(self.cache, b'key', slow, lambda e: e[0]))
+
+  def test_try_do(self):
+    self.assertTrue(self.cache.acquire_lease(b'key', 'other', 10))
+    fn = mock.Mock()
+    self.assertFalse(self.flight.try_do(self.cache, b'key', fn))
+    fn.assert_not_called()
+
+  def test_database_errors(self):
+    # calls are executed without leases if the database is locked
+    error = sqlite3.OperationalError('database is locked')
+    with mock.patch.object(self.cache, 'acquire_lease', side_effect=error):
+      self.assertEqual(self.flight.do(self.cache, b'key', lambda: 'mine', lambda e: e[0]), 'mine')
+      fn = mock.Mock()
+      self.assertTrue(self.flight.try_do(self.cache, b'key', fn))
+      fn.assert_called_once()
+    with mock.patch.object(self.cache, 'release_lease', side_effect=error):
+      self.assertEqual(self.flight.do(self.cache, b'key', lambda: 'mine', lambda e: e[0]), 'mine')
+      self.cache.set(b'key', 'stored', expire=60)
+      self.assertEqual(self.flight.do(self.cache, b'key', mock.Mock(), lambda e: e[0]), 'stored')
+
+  def test_cached_api_call(self):
+    @caching.cached_api_call(expire=60)
+    def fetch():
+      return 'mine'
+
+    key = caching._make_key(fetch.__wrapped__, (), {})
+    self.assertTrue(self.cache.acquire_lease(key, 'other', 10))
+    threading.Timer(0.05, self.cache.set, (key, 'other result'), {'expire': 60}).start()
+    for patcher in [
+      mock.patch('gcpdiag.caching.get_disk_cache', return_value=self.cache),
+      mock.patch('gcpdiag.caching._shared_flights', self.flight),
+      mock.patch.dict(caching.config._defaults, {'cache_share_calls': True}),
+    ]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.assertEqual(fetch(), 'other result')
+
+
+class AsyncCacheTests(unittest.IsolatedAsyncioTestCase):
+  """Testing async_cached_api_call"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.disk_cache = caching.SQLiteCache(self.temp_dir.name)
+    self.addCleanup(self.disk_cache.close)
+    for patcher in [
+      mock.patch('gcpdiag.caching.get_disk_cache', return_value=self.disk_cache),
+      mock.patch('gcpdiag.caching._stats', caching.CacheStats()),
+    ]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.calls = []
+    self.release = asyncio.Event()
+
+    @caching.async_cached_api_call(expire=60)
+    async def fetch(arg):
+      self.calls.append(arg)
+      await self.release.wait()
+      if arg == 'error':
+        raise RuntimeError(arg)
+      return arg.upper()
+
+    self.fetch = fetch
+
+  async def test_concurrent_calls_deduplicated(self):
+    self.release.set()
+    results = await asyncio.gather(self.fetch('a'), self.fetch('a'), self.fetch('b'))
+    self.assertEqual(results, ['A', 'A', 'B'])
+    self.assertEqual(sorted(self.calls), ['a', 'b'])
+    (stats,) = caching.get_stats().values()
+    self.assertEqual((stats['calls'], stats['executions'], stats['waits']), (3, 2, 1))
+
+  async def test_cached_on_disk(self):
+    self.release.set()
+    await self.fetch('a')
+    self.assertEqual(await self.fetch('a'), 'A')
+    self.assertEqual(self.calls, ['a'])
+    self.assertEqual(
+      self.disk_cache.get(caching._make_key(self.fetch.__wrapped__, ('a',), {})), 'A'
+    )
+
+  async def test_disk_io_outside_event_loop(self):
+    self.release.set()
+    loop_thread = threading.current_thread()
+    with mock.patch.object(self.disk_cache, 'get_entry', return_value=None) as get_entry:
+      get_entry.side_effect = lambda key: self.assertIsNot(threading.current_thread(), loop_thread)
+      await self.fetch('a')
+    get_entry.assert_called_once()
+
+  async def test_cancelled_caller(self):
+    first = asyncio.ensure_future(self.fetch('a'))
+    second = asyncio.ensure_future(self.fetch('a'))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    self.release.set()
+    self.assertEqual(await second, 'A')
+    self.assertEqual(self.calls, ['a'])
+
+  async def test_exceptions_not_cached(self):
+    self.release.set()
+    for _ in range(2):
+      with self.assertRaises(RuntimeError):
+        await self.fetch('error')
+    self.assertEqual(self.calls, ['error', 'error'])
+
+
+class WriteBehindTests(unittest.TestCase):
+  """Testing batched writes"""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+
+  def _rows(self, db_path, table):
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+      return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+  def test_cache_writes_batched(self):
+    cache = caching.SQLiteCache(self.temp_dir.name, write_batch_size=3)
+    self.addCleanup(cache.close)
+    cache.set(b'a', 1)
+    cache.set(b'b', 2)
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 0)
+    cache.set(b'c', 3)
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 3)
+
+  def test_cache_flushed_before_read(self):
+    cache = caching.SQLiteCache(self.temp_dir.name, write_batch_size=10)
+    self.addCleanup(cache.close)
+    cache.set(b'a', 1)
+    cache.set(b'a', 2)
+    cache.set(b'b', 3)
+    self.assertEqual(cache.get(b'a'), 2)
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 2)
+    cache.set(b'c', 4)
+    self.assertEqual(cache.totals()[0], 3)
+
+  def test_cache_flushed_by_age(self):
+    cache = caching.SQLiteCache(self.temp_dir.name, write_batch_size=10)
+    self.addCleanup(cache.close)
+    cache._writes.max_age = 0
+    cache.set(b'a', 1)
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 1)
+
+  def test_cache_flushed_by_age_without_writes(self):
+    cache = caching.SQLiteCache(self.temp_dir.name, write_batch_size=10)
+    self.addCleanup(cache.close)
+    cache._writes.max_age = 0.05
+    cache.set(b'a', 1)
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 0)
+    # visible to other connections (e.g. of other processes) without
+    # further writes or reads
+    deadline = time.monotonic() + 10
+    while not self._rows(cache.db_path, 'cache') and time.monotonic() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 1)
+
+  def test_cache_flushed_on_close(self):
+    cache = caching.SQLiteCache(self.temp_dir.name, write_batch_size=10)
+    cache.set(b'a', 1)
+    cache.close()
+    self.assertEqual(self._rows(cache.db_path, 'cache'), 1)
+
+  def test_deque_appends_batched(self):
+    deque = caching.SQLiteDeque(self.temp_dir.name, write_batch_size=3)
+    self.addCleanup(caching._connections.close, deque.db_path)
+    deque.appendleft(1)
+    deque.appendleft(2)
+    self.assertEqual(self._rows(deque.db_path, 'deque'), 0)
+    deque.appendleft(3)
+    self.assertEqual(self._rows(deque.db_path, 'deque'), 3)
+    deque.appendleft(4)
+    self.assertEqual(list(deque), [4, 3, 2, 1])
+    deque.appendleft(5)
+    self.assertEqual((len(deque), deque[0], deque[-1]), (5, 5, 1))
+
+  def test_deque_pickle(self):
+    deque = caching.SQLiteDeque(self.temp_dir.name)
+    self.addCleanup(caching._connections.close, deque.db_path)
+    deque.appendleft('a')
+    copy = pickle.loads(pickle.dumps(deque))
+    copy.appendleft('b')
+    self.assertEqual(list(copy), ['b', 'a'])
+    self.assertEqual(list(deque), ['b', 'a'])
+
+
+class DequeTests(unittest.TestCase):
+  """Testing SQLiteDeque"""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.deque = caching.SQLiteDeque(self.temp_dir.name, write_batch_size=4)
+    self.addCleanup(caching._connections.close, self.deque.db_path)
+    # read in several pages
+    patcher = mock.patch('gcpdiag.caching._DEQUE_PAGE_SIZE', 3)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_empty(self):
+    self.assertEqual((len(self.deque), list(self.deque), self.deque[:]), (0, [], []))
+    with self.assertRaises(IndexError):
+      _ = self.deque[0]
+
+  def test_iteration(self):
+    self.deque.appendleft(0)
+    self.deque.extendleft(range(1, 10))
+    self.deque.appendleft(10)
+    expected = list(range(10, -1, -1))
+    self.assertEqual(len(self.deque), 11)
+    self.assertEqual(list(self.deque), expected)
+    self.assertEqual(list(reversed(self.deque)), expected[::-1])
+
+  def test_indexing(self):
+    self.deque.extendleft(range(10))
+    expected = list(range(9, -1, -1))
+    for index in [0, 1, 9, -1, -10]:
+      self.assertEqual(self.deque[index], expected[index])
+    for index in [10, -11]:
+      with self.assertRaises(IndexError):
+        _ = self.deque[index]
+    for s in [
+      slice(None),
+      slice(2, 7),
+      slice(-3, None),
+      slice(None, None, 3),
+      slice(8, 1, -2),
+      slice(None, None, -1),
+      slice(5, 20),
+      slice(7, 2),
+    ]:
+      self.assertEqual(self.deque[s], expected[s], s)
+
+  def test_iteration_is_lazy(self):
+    self.deque.extendleft(range(10))
+    with mock.patch('gcpdiag.caching.pickle.loads', wraps=pickle.loads) as loads:
+      values = iter(self.deque)
+      self.assertEqual(next(values), 9)
+      self.assertEqual(loads.call_count, 1)
+      self.assertEqual(list(values), list(range(8, -1, -1)))
+
+
+class SnapshotTests(unittest.TestCase):
+  """Testing cache snapshots and the read-only mode"""
+
+  def setUp(self):
+    _enable_global_cache(self)
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.cache = self._cache('source')
+
+  def _cache(self, name, **kwargs):
+    cache = caching.SQLiteCache(pathlib.Path(self.temp_dir.name) / name, **kwargs)
+    self.addCleanup(cache.close)
+    return cache
+
+  def _patch(self, target, value):
+    patcher = mock.patch(target, value)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_retain_export_import(self):
+    self.cache.set(b'tmp', 'tmp value', tag='tmp')
+    self.cache.set(b'expire', 'expire value', expire=-1)
+    self.cache.set(b'other', 'other value', tag='tmp')
+    self.cache.retain_snapshot('p1', [b'tmp', b'expire'])
+    self.cache.evict('tmp')
+    # snapshot entries are only visible in read-only mode
+    self.assertIsNone(self.cache.get(b'tmp'))
+    readonly = self._cache('source', readonly=True)
+    self.assertEqual(readonly.get(b'tmp'), 'tmp value')
+    self.assertEqual(readonly.get(b'expire'), 'expire value')
+    self.assertIsNone(readonly.get(b'other'))
+
+    path = pathlib.Path(self.temp_dir.name) / 'p1.db'
+    self.assertEqual(self.cache.export_snapshot('p1', str(path)), 2)
+    with self.assertRaises(FileExistsError):
+      self.cache.export_snapshot('p1', str(path))
+    target = self._cache('target')
+    # the values were serialized with pickle
+    with self.assertRaises(ValueError):
+      target.import_snapshot(str(path))
+    self.assertEqual(target.import_snapshot(str(path), allow_pickle=True), ('p1', 2))
+    self.assertIsNone(target.get(b'tmp'))
+    readonly = self._cache('target', readonly=True)
+    self.assertEqual(readonly.get(b'tmp'), 'tmp value')
+    self.assertEqual(readonly.get(b'expire'), 'expire value')
+    # read-only caches don't write
+    readonly.set(b'new', 'value')
+    self.assertEqual(readonly.evict('tmp'), 0)
+    self.assertIsNone(target.get(b'new'))
+
+  def test_snapshot_pinned_until_export(self):
+    cache = self._cache('pinned', max_entries=2)
+    cache.set(b'tmp', 'tmp value', tag='tmp')
+    cache.set(b'expire', 'expire value', expire=-1)
+    cache.retain_snapshot('p1', [b'tmp', b'expire'])
+    # neither expired nor evicted to make room for new entries
+    self.assertEqual(cache.expire(), 0)
+    for n in range(4):
+      cache.set(b'new%d' % n, 'new value')
+    self.assertIsNone(cache.get(b'new0'))
+    path = pathlib.Path(self.temp_dir.name) / 'p1.db'
+    self.assertEqual(cache.export_snapshot('p1', str(path)), 2)
+    # exported entries are expired and evicted again
+    self.assertEqual(cache.expire(), 1)
+    for n in range(4, 6):
+      cache.set(b'new%d' % n, 'new value')
+    self.assertIsNone(self._cache('pinned', readonly=True).get(b'tmp'))
+    self.assertEqual(
+      self._cache('imported').import_snapshot(str(path), allow_pickle=True), ('p1', 2)
+    )
+
+  def test_import_json_snapshot(self):
+    cache = self._cache('json-source', serializer='json')
+    cache.set(b'key', {'items': ['value']}, tag='tmp')
+    cache.retain_snapshot('p1', [b'key'])
+    path = pathlib.Path(self.temp_dir.name) / 'p1.db'
+    cache.export_snapshot('p1', str(path))
+    target = self._cache('target')
+    self.assertEqual(target.import_snapshot(str(path)), ('p1', 1))
+    self.assertEqual(self._cache('target', readonly=True).get(b'key'), {'items': ['value']})
+
+  def test_record_in_memory_function(self):
+    self._patch('gcpdiag.caching.get_disk_cache', lambda: self.cache)
+    self._patch('gcpdiag.caching._session_record', True)
+    self._patch('gcpdiag.caching._session_keys', set())
+    result = caching.cached_api_call(in_memory=True)(simple_function)('record-arg')
+    key = caching._make_key(simple_function, ('record-arg',), {})
+    self.assertEqual(caching._session_keys, {key})
+    self.assertEqual(self.cache.get(key), result)
+
+  def test_replay_unrecorded_in_memory_function(self):
+    self._patch('gcpdiag.caching.get_disk_cache', lambda: self.cache)
+    self._patch('gcpdiag.caching._session_record', True)
+    self._patch('gcpdiag.caching._session_keys', set())
+    calls = []
+
+    def get_client(name):
+      # e.g. apis.get_api(), whose results can't be serialized
+      calls.append(name)
+      return threading.Lock()
+
+    caching.cached_api_call(in_memory=True)(get_client)('client')
+    self.cache.retain_snapshot('p1', caching._session_keys)
+    readonly = self._cache('source', readonly=True)
+    self._patch('gcpdiag.caching.get_disk_cache', lambda: readonly)
+    self._patch('gcpdiag.caching._readonly', True)
+    self._patch('gcpdiag.caching._session_record', False)
+    # a new process replaying the snapshot executes the function again
+    replayed = caching.cached_api_call(in_memory=True)(get_client)
+    self.assertIsInstance(replayed('client'), type(threading.Lock()))
+    self.assertEqual(calls, ['client', 'client'])
+    with self.assertRaises(utils.GcpApiError):
+      replayed('not recorded')
+
+  def test_configure_session_multiple_projects(self):
+    self._patch('gcpdiag.caching._cache', None)
+    self._patch('gcpdiag.caching._session_projects', [])
+    self._patch('gcpdiag.caching._session_record', False)
+    self._patch('gcpdiag.caching._readonly', False)
+    caching.configure_session(['p1', 'p2'], record=True)
+    self.assertEqual(caching._session_projects, ['p1', 'p2'])
+    self.assertTrue(caching._session_record)
+    caching.configure_session('p1', record=True, readonly=True)
+    self.assertEqual(caching._session_projects, ['p1'])
+    self.assertFalse(caching._session_record)
+
+  def test_configure_session_options_not_given(self):
+    self._patch('gcpdiag.caching._cache', self.cache)
+    self._patch('gcpdiag.caching._session_projects', [])
+    self._patch('gcpdiag.caching._session_record', False)
+    self._patch('gcpdiag.caching._readonly', False)
+    # config.get() returns None for the options that weren't given
+    caching.configure_session('p1', record=None, readonly=None)
+    self.assertIs(caching._session_record, False)
+    self.assertIs(caching._readonly, False)
+
+  def test_readonly_cached_api_call(self):
+    readonly = self._cache('source', readonly=True)
+    self._patch('gcpdiag.caching.get_disk_cache', lambda: readonly)
+    self._patch('gcpdiag.caching._readonly', True)
+    self.cache.set(caching._make_key(simple_function, ('cached',), {}), 'cached value', expire=-1)
+    for cached_func in [cached_on_disk, cached_in_memory]:
+      self.assertEqual(cached_func('cached'), 'cached value')
+      with caching.bypass_cache():
+        self.assertEqual(cached_func('cached'), 'cached value')
+      with self.assertRaises(utils.GcpApiError) as cm:
+        cached_func('not cached')
+      self.assertEqual(cm.exception.reason, 'CACHE_MISS')
+
+
+class MakeKeyTests(unittest.TestCase):
+  """Testing cache key generation"""
+
+  def test_cache_key_protocol(self):
+    context = models.Context(project_id='p1', locations=['us-central1'])
+    same_context = models.Context(project_id='p1', locations=['us-central1'])
+    other_context = models.Context(project_id='p1', locations=['us-west1'])
+    key = caching._make_key(simple_function, (context,), {})
+    self.assertEqual(key, caching._make_key(simple_function, (same_context,), {}))
+    self.assertNotEqual(key, caching._make_key(simple_function, (other_context,), {}))
+    self.assertNotEqual(key, caching._make_key(simple_function, (context.__cache_key__(),), {}))
+    self.assertNotEqual(key, caching._make_key(simple_function, (), {'context': context}))
+
+  def test_protocol_not_used_for_plain_values(self):
+    self.assertNotEqual(
+      caching._make_key(simple_function, ('a', 1), {}),
+      caching._make_key(simple_function, ('a', 1), {'x': None}),
+    )
+    self.assertEqual(
+      caching._make_key(simple_function, ('a', [1, 2]), {}),
+      caching._make_key(simple_function, ('a', [1, 2]), {}),
+    )
+
+
+class ConnectionManagerTests(unittest.TestCase):
+  """Testing reuse of SQLite connections"""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.cache = caching.SQLiteCache(self.temp_dir.name)
+
+  def tearDown(self):
+    self.cache.close()
+    self.temp_dir.cleanup()
+
+  def test_connection_reused_in_same_thread(self):
+    self.cache.set(b'key', 'value')
+    self.assertEqual(self.cache.get(b'key'), 'value')
+    self.assertIs(self.cache._conn(), self.cache._conn())
+
+  def test_connection_per_thread(self):
+    conns = []
+    t = threading.Thread(target=lambda: conns.append(self.cache._conn()))
+    t.start()
+    t.join()
+    self.assertIsNot(conns[0], self.cache._conn())
+
+  def test_close_reconnects(self):
+    self.cache.set(b'key', 'value')
+    conn = self.cache._conn()
+    self.cache.close()
+    self.assertIsNot(conn, self.cache._conn())
+    self.assertEqual(self.cache.get(b'key'), 'value')
+
+  def test_deque_uses_pooled_connection(self):
+    deque = caching.SQLiteDeque(self.temp_dir.name)
+    deque.appendleft(1)
+    deque.appendleft(2)
+    self.assertEqual(list(deque), [2, 1])
+    self.assertIs(deque._conn(), deque._conn())
+
+
+class EvictionTests(unittest.TestCase):
+  """Testing the size-bounded eviction policy"""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _cache(self, **kwargs):
+    cache = caching.SQLiteCache(self.temp_dir.name, **kwargs)
+    self.addCleanup(cache.close)
+    return cache
+
+  def test_totals_tracked(self):
+    cache = self._cache()
+    cache.set(b'a', 'x' * 100)
+    cache.set(b'b', 'x' * 100)
+    cache.set(b'a', 'x' * 10)
+    entries, size = cache.totals()
+    self.assertEqual(entries, 2)
+    cache.evict('tmp')
+    cache.set(b'c', 'x', tag='tmp')
+    cache.evict('tmp')
+    self.assertEqual(cache.totals(), (2, size))
+
+  def test_lru_max_entries(self):
+    cache = self._cache(max_entries=2)
+    with mock.patch('time.time', side_effect=[1, 2, 3, 4, 5, 6, 7, 8]):
+      cache.set(b'a', 1)
+      cache.set(b'b', 2)
+      self.assertEqual(cache.get(b'a'), 1)
+      cache.set(b'c', 3)
+    self.assertEqual(cache.get(b'a'), 1)
+    self.assertIsNone(cache.get(b'b'))
+    self.assertEqual(cache.get(b'c'), 3)
+
+  def test_lfu_max_entries(self):
+    cache = self._cache(max_entries=2, eviction_policy='lfu')
+    cache.set(b'a', 1)
+    cache.set(b'b', 2)
+    for _ in range(3):
+      cache.get(b'b')
+    cache.set(b'c', 3)
+    self.assertIsNone(cache.get(b'a'))
+    self.assertEqual(cache.get(b'b'), 2)
+
+  def test_max_size_evicts_incrementally(self):
+    cache = self._cache()
+    for i in range(100):
+      cache.set(b'key-%d' % i, 'x' * 1000)
+    cache.max_size_bytes = 10000
+    cache.set(b'new', 'x')
+    entries, _ = cache.totals()
+    # a single write evicts at most one batch of entries
+    self.assertEqual(entries, 101 - caching._EVICTION_BATCH)
+    for _ in range(5):
+      cache.set(b'new', 'x')
+    entries, size = cache.totals()
+    self.assertLessEqual(size, 10000)
+    self.assertEqual(cache.get(b'new'), 'x')
+
+  def test_expired_entries_evicted_first(self):
+    cache = self._cache(max_entries=2)
+    cache.set(b'expired', 1, expire=-10)
+    cache.set(b'a', 1)
+    cache.set(b'b', 2)
+    self.assertEqual(cache.get(b'a'), 1)
+    self.assertEqual(cache.totals()[0], 2)
+
+  def test_migrate_old_schema(self):
+    db_path = pathlib.Path(self.temp_dir.name) / 'sqlite_cache.db'
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+      with conn:
+        conn.execute('CREATE TABLE cache (key BLOB PRIMARY KEY, value BLOB, expire REAL, tag TEXT)')
+        conn.execute(
+          'INSERT INTO cache VALUES (?, ?, NULL, NULL)', (b'old', pickle.dumps('old value'))
+        )
+    cache = self._cache()
+    self.assertEqual(cache.get(b'old'), 'old value')
+    self.assertEqual(cache.totals(), (1, len(pickle.dumps('old value'))))
+
+  def test_invalid_policy(self):
+    with self.assertRaises(ValueError):
+      self._cache(eviction_policy='random')
+
+
+class CompressionTests(unittest.TestCase):
+  """Testing compression of cached values"""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.value = {'items': [{'name': f'vm-{i}', 'status': 'RUNNING'} for i in range(100)]}
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _cache(self, **kwargs):
+    cache = caching.SQLiteCache(self.temp_dir.name, **kwargs)
+    self.addCleanup(cache.close)
+    return cache
+
+  def _codec(self, cache, key):
+    with cache._conn() as conn:
+      return conn.execute('SELECT codec FROM cache WHERE key = ?', (key,)).fetchone()[0]
+
+  def test_legacy_rows_with_default_settings(self):
+    # caches written before compression and eviction were added
+    db_path = pathlib.Path(self.temp_dir.name) / 'sqlite_cache.db'
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+      with conn:
+        conn.execute('CREATE TABLE cache (key BLOB PRIMARY KEY, value BLOB, expire REAL, tag TEXT)')
+        conn.executemany(
+          'INSERT INTO cache VALUES (?, ?, ?, ?)',
+          [
+            (b'small', pickle.dumps('old value'), None, None),
+            (b'big', pickle.dumps(self.value), None, 'tmp'),
+            (b'expired', pickle.dumps('old value'), time.time() - 10, None),
+          ],
+        )
+    defaults = config._defaults
+    cache = self._cache(
+      max_size_bytes=defaults['cache_max_size_mb'] * 1024 * 1024,
+      max_entries=defaults['cache_max_entries'],
+      eviction_policy=defaults['cache_eviction_policy'],
+      compression=defaults['cache_compression'],
+      compression_min_bytes=defaults['cache_compression_min_bytes'],
+      serializer=defaults['cache_serializer'],
+    )
+    self.assertEqual(cache.get(b'small'), 'old value')
+    self.assertEqual(cache.get(b'big'), self.value)
+    self.assertIsNone(cache.get(b'expired'))
+    # legacy rows are left uncompressed, new ones are compressed
+    self.assertEqual(self._codec(cache, b'big'), '')
+    cache.set(b'new', self.value)
+    self.assertEqual(self._codec(cache, b'new'), 'zlib')
+    self.assertEqual(cache.get(b'new'), self.value)
+    self.assertEqual(cache.evict('tmp'), 1)
+    self.assertEqual(cache.expire(), 1)
+    self.assertEqual(cache.totals()[0], 2)
+
+  def test_compressed_round_trip(self):
+    for codec in ['zlib', 'lzma']:
+      cache = self._cache(compression=codec)
+      cache.set(b'key', self.value)
+      self.assertEqual(self._codec(cache, b'key'), codec)
+      self.assertEqual(cache.get(b'key'), self.value)
+      self.assertLess(cache.totals()[1], len(pickle.dumps(self.value)))
+
+  def test_small_values_not_compressed(self):
+    cache = self._cache(compression='zlib', compression_min_bytes=1024)
+    cache.set(b'small', 'x')
+    self.assertEqual(self._codec(cache, b'small'), '')
+    self.assertEqual(cache.get(b'small'), 'x')
+
+  def test_rows_readable_after_codec_change(self):
+    self._cache(compression='lzma').set(b'key', self.value)
+    self.assertEqual(self._cache(compression='').get(b'key'), self.value)
+
+  def test_unsupported_codec_is_a_miss(self):
+    cache = self._cache(compression='zlib')
+    cache.set(b'key', self.value)
+    with cache._conn() as conn:
+      conn.execute("UPDATE cache SET codec = 'brotli'")
+    self.assertEqual(cache.get(b'key', default='miss'), 'miss')
+
+  def test_unknown_compression(self):
+    with self.assertRaises(ValueError):
+      self._cache(compression='brotli')
+
+
+class _FakeResource(models.Resource):
+  """Resource wrapper used to test JSON serialization"""
+
+  def __init__(self, project_id, resource_data):
+    super().__init__(project_id)
+    self._resource_data = resource_data
+
+  @property
+  def full_path(self) -> str:
+    return self._resource_data['selfLink']
+
+  @functools.cached_property
+  def name(self) -> str:
+    return self._resource_data['name']
+
+
+class SerializerTests(unittest.TestCase):
+  """Testing JSON serialization of cached values"""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.cache = caching.SQLiteCache(self.temp_dir.name, serializer='json')
+
+  def tearDown(self):
+    self.cache.close()
+    self.temp_dir.cleanup()
+
+  def _serializer(self, key):
+    with self.cache._conn() as conn:
+      return conn.execute('SELECT serializer FROM cache WHERE key = ?', (key,)).fetchone()[0]
+
+  def test_json_values(self):
+    value = {'items': [{'name': 'a', 'size': 10, 'ratio': 0.5, 'ok': True, 'x': None}]}
+    self.cache.set(b'key', value)
+    self.assertEqual(self._serializer(b'key'), 'json')
+    self.assertEqual(self.cache.get(b'key'), value)
+
+  def test_resources_rebuilt(self):
+    resource = _FakeResource('p1', {'selfLink': 'projects/p1/vm1', 'name': 'vm1'})
+    self.assertEqual(resource.name, 'vm1')
+    self.cache.set(b'key', {'vm1': resource})
+    self.assertEqual(self._serializer(b'key'), 'json')
+    loaded = self.cache.get(b'key')['vm1']
+    self.assertIsInstance(loaded, _FakeResource)
+    self.assertEqual(loaded, resource)
+    self.assertEqual(loaded.project_id, 'p1')
+    self.assertNotIn('name', vars(loaded))
+    self.assertEqual(loaded.name, 'vm1')
+
+  def test_stdlib_json(self):
+    resource = _FakeResource('p1', {'selfLink': 'projects/p1/vm1', 'name': 'vm\u00e9'})
+    with mock.patch.object(caching, '_orjson', None):
+      self.cache.set(b'key', [resource, {'a': [1, 2.5]}])
+      self.assertEqual(self._serializer(b'key'), 'json')
+      self.assertEqual(self.cache.get(b'key'), [resource, {'a': [1, 2.5]}])
+
+  def test_pickle_fallback(self):
+    for value in [('a', 'tuple'), {1: 'int key'}, {'a': {'nested', 'set'}}, [float('inf')]]:
+      self.cache.set(b'key', value)
+      self.assertEqual(self._serializer(b'key'), 'pickle')
+      loaded = self.cache.get(b'key')
+      self.assertEqual(loaded, value)
+      self.assertIs(type(loaded), type(value))
+
+  def test_only_gcpdiag_resources_rebuilt(self):
+    data = json.dumps({caching._JSON_RESOURCE_MARKER: 'os:system', 'state': {}}).encode()
+    with self.assertRaises(ValueError):
+      caching._json_loads(data)
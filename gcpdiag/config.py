@@ -81,15 +81,32 @@ def get_cache_dir():
   return _cache_dir
 
 
-# Number of seconds to wait for the gcpdiag.cache API cache lock to be freed.
+# Number of seconds to wait for a concurrent cached API call with the same
+# arguments to complete.
 CACHE_LOCK_TIMEOUT = 120
 
+# Number of seconds after which a process waiting for another process to call
+# a cached API takes over, if that process stopped renewing its lease.
+CACHE_LEASE_SECONDS = 30
+
 # How long to cache documents that rarely change (e.g. predefined IAM roles).
 STATIC_DOCUMENTS_EXPIRY_SECONDS = 3600 * 24
+# For how long such documents can still be used after their expiration, while
+# they are refreshed in the background.
+STATIC_DOCUMENTS_MAX_STALENESS_SECONDS = 3600 * 24 * 7
 
 # Prefetch worker threads
 MAX_WORKERS = 20
 
+# Threads doing the short blocking I/O of coroutines (see executor.submit_io),
+# e.g. the disk cache lookups of async_cached_api_call functions.
+IO_WORKERS = 4
+
+# Initial and maximum number of concurrent requests per API service, adapted
+# to the throttling of the service (see executor.AdaptiveLimit).
+API_CONCURRENCY_INITIAL = 100
+API_CONCURRENCY_MAX = 1000
+
 _args: Dict[str, Any] = {}
 _config: Dict[str, Any] = {}
 _project_id: str = ''
@@ -135,6 +152,39 @@ _defaults: Dict[str, Any] = {
   'interface': 'cli',
   'universe_domain': 'googleapis.com',
   'reason': None,
+  # Budget of the persistent API cache (0 means unlimited), and policy used to
+  # evict entries when it is exceeded: 'lru' or 'lfu'.
+  'cache_max_size_mb': 512,
+  'cache_max_entries': 0,
+  'cache_eviction_policy': 'lru',
+  # Compression of cached values bigger than cache_compression_min_bytes:
+  # 'zlib', 'lzma', 'zstd' (requires the zstandard module) or '' to disable.
+  'cache_compression': 'zlib',
+  'cache_compression_min_bytes': 1024,
+  # Serialization of cached values: 'pickle', or 'json' (for JSON-shaped
+  # values, pickle for anything else).
+  'cache_serializer': 'pickle',
+  # Budget of the in-memory cache of decoded values used in front of the
+  # persistent cache by the most frequently called queries (0 means unlimited).
+  'cache_memory_max_size_mb': 64,
+  'cache_memory_max_entries': 1000,
+  # API errors that won't go away by retrying (403, 404) are cached for this
+  # many seconds, also across executions (0: only for the current execution,
+  # so that a permission granted or an API enabled is seen by the next one).
+  'cache_negative_ttl_seconds': 0,
+  # API errors that are likely transient (429, 5xx) are cached for this many
+  # seconds (0: never cached, so that the next call retries).
+  'cache_retryable_error_ttl_seconds': 0,
+  # Coordinate with the other gcpdiag processes using the same cache
+  # directory, so that only one of them calls an API with given arguments.
+  'cache_share_calls': False,
+  # Maximum number of tasks per service running at the same time in the
+  # shared thread pool (MAX_WORKERS threads), so that slow services like
+  # logging can't occupy all of it. Services are the APIs called by the tasks
+  # (logging, compute, container...), see also lint.PRODUCT_API_SERVICES.
+  'executor_service_limits': {'logging': 4},
+  # Number of lint rules executed in parallel (run_rule functions).
+  'rule_workers': 1,
 }
 
 #
@@ -13,12 +13,21 @@
 # limitations under the License.
 """ThreadPoolExecutor instance that can be used to run tasks in parallel"""
 
+import collections
 import concurrent.futures
-from typing import Any, Callable, Iterable, Optional
+import contextlib
+import functools
+import heapq
+import itertools
+import math
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
-from gcpdiag import config, models
+from gcpdiag import config, fingerprints, models, tracing
 
 _real_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_io_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
 
 def _get_real_executor() -> concurrent.futures.ThreadPoolExecutor:
@@ -28,6 +37,492 @@ def _get_real_executor() -> concurrent.futures.ThreadPoolExecutor:
   return _real_executor
 
 
+def _get_io_executor() -> concurrent.futures.ThreadPoolExecutor:
+  global _io_executor
+  if _io_executor is None:
+    _io_executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=config.IO_WORKERS, thread_name_prefix='io'
+    )
+  return _io_executor
+
+
+class TaskCancelledError(RuntimeError):
+  """Raised by check_cancelled() in a task whose result is no longer needed."""
+
+
+class CancellationToken:
+  """Cooperative cancellation of a group of tasks.
+
+  Tokens form a tree: a token is cancelled when it or one of its parents is
+  cancelled, or when the deadline of one of them (time.monotonic() value) has
+  passed. The root token has the deadline of the whole run (see
+  set_run_deadline()). Tasks of a ContextAwareExecutor run with the token of
+  the executor, and long-running loops (e.g. over the pages of an API list
+  call) call check_cancelled() to stop when the token is cancelled.
+  """
+
+  def __init__(
+    self, parent: Optional['CancellationToken'] = None, deadline: Optional[float] = None
+  ):
+    self.parent = parent
+    self.deadline = deadline
+    self._reason: Optional[str] = None
+
+  def cancel(self, reason: str = 'cancelled'):
+    if self._reason is None:
+      self._reason = reason
+
+  def reason(self) -> Optional[str]:
+    """Returns why the token is cancelled, or None if it isn't."""
+    now = None
+    token: Optional[CancellationToken] = self
+    while token is not None:
+      if token._reason is not None:
+        return token._reason
+      if token.deadline is not None:
+        now = now or time.monotonic()
+        if now >= token.deadline:
+          return 'deadline exceeded'
+      token = token.parent
+    return None
+
+  @property
+  def cancelled(self) -> bool:
+    return self.reason() is not None
+
+  def check(self):
+    """Raises TaskCancelledError if the token is cancelled."""
+    reason = self.reason()
+    if reason is not None:
+      raise TaskCancelledError(reason)
+
+
+_run_token = CancellationToken()
+_local = threading.local()
+
+
+def current_token() -> CancellationToken:
+  """Returns the cancellation token of the current task (the token of the run
+  outside of tasks)."""
+  return getattr(_local, 'token', None) or _run_token
+
+
+def check_cancelled():
+  """Raises TaskCancelledError if the results of the current task are no
+  longer needed, e.g. because the run deadline was exceeded."""
+  current_token().check()
+
+
+def set_run_deadline(seconds: Optional[float]):
+  """Sets the deadline of the whole run, `seconds` from now."""
+  _run_token.deadline = time.monotonic() + seconds if seconds else None
+
+
+@contextlib.contextmanager
+def cancellation_scope():
+  """Runs the block with a new cancellation token, which is cancelled when the
+  block exits: tasks of the executors created within the block are cancelled
+  once their results can't be used anymore."""
+  previous = getattr(_local, 'token', None)
+  token = CancellationToken(current_token())
+  _local.token = token
+  try:
+    yield token
+  finally:
+    _local.token = previous
+    token.cancel('cancellation scope exited')
+
+
+# Priorities of the tasks in the shared thread pool (lowest first).
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+
+class _Scheduler:
+  """Dispatches the tasks to the shared thread pool by priority.
+
+  Tasks wait in a heap outside of the pool until one of its workers is free,
+  and are started by priority and then in submission order. A queued task
+  that the main thread is waiting for can be moved ahead of the other tasks
+  with promote(). The cost of the promotions is recorded: the number of tasks
+  that they overtook, and the time spent reordering the queues.
+  """
+
+  def __init__(self, max_running: int = config.MAX_WORKERS):
+    self._max_running = max_running
+    self._lock = threading.Lock()
+    # heap of [priority, sequence number, future, fn], the future and fn of
+    # promoted entries are set to None (the promoted task is pushed again).
+    self._heap: List[list] = []
+    self._queued: Dict[concurrent.futures.Future, list] = {}
+    self._running = 0
+    self._sequence = itertools.count()
+    self._stats: Dict[str, float] = collections.Counter()
+
+  def submit(self, fn: Callable[[], Any], priority: int = PRIORITY_NORMAL):
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    entry = [priority, next(self._sequence), future, fn]
+    with self._lock:
+      heapq.heappush(self._heap, entry)
+      self._queued[future] = entry
+    self._dispatch()
+    return future
+
+  def promote(self, future: concurrent.futures.Future) -> Optional[int]:
+    """Moves the task of `future` to the front of the queue, and returns the
+    number of tasks that it overtook, or None if it isn't queued."""
+    with self._lock:
+      entry = self._queued.get(future)
+      if entry is None:
+        return None
+      overtaken = sum(
+        1 for e in self._heap if e[2] is not None and e[0] > PRIORITY_URGENT and e[:2] < entry[:2]
+      )
+      promoted = [PRIORITY_URGENT, next(self._sequence), future, entry[3]]
+      entry[2] = entry[3] = None
+      heapq.heappush(self._heap, promoted)
+      self._queued[future] = promoted
+      return overtaken
+
+  def cancel(self, future: concurrent.futures.Future) -> bool:
+    """Cancels the task of `future` if it isn't running yet."""
+    with self._lock:
+      entry = self._queued.pop(future, None)
+      if entry is not None:
+        entry[2] = entry[3] = None
+    # The done callbacks of the future may submit tasks, so it is cancelled
+    # without holding the lock.
+    if entry is None:
+      # Either running, or dispatched and cancelled when _run() starts.
+      return future.cancel()
+    future.cancel()
+    # wake up the callers of concurrent.futures.wait()
+    future.set_running_or_notify_cancel()
+    return True
+
+  def record_promotion(self, overtaken: int, duration: float):
+    with self._lock:
+      self._stats['promotions'] += 1
+      self._stats['overtaken'] += overtaken
+      self._stats['reorder_time'] += duration
+      self._stats['max_reorder_time'] = max(self._stats['max_reorder_time'], duration)
+
+  def stats(self) -> Dict[str, float]:
+    with self._lock:
+      return dict(self._stats)
+
+  def _dispatch(self):
+    while True:
+      with self._lock:
+        if self._running >= self._max_running:
+          return
+        while self._heap and self._heap[0][2] is None:
+          heapq.heappop(self._heap)
+        if not self._heap:
+          return
+        _, _, future, fn = heapq.heappop(self._heap)
+        del self._queued[future]
+        self._running += 1
+      _get_real_executor().submit(self._run, future, fn)
+
+  def _run(self, future: concurrent.futures.Future, fn: Callable[[], Any]):
+    try:
+      if not future.set_running_or_notify_cancel():
+        return
+      try:
+        result = fn()
+      except BaseException as err:  # pylint: disable=broad-exception-caught
+        future.set_exception(err)
+      else:
+        future.set_result(result)
+    finally:
+      with self._lock:
+        self._running -= 1
+      self._dispatch()
+
+
+_scheduler = _Scheduler()
+
+
+class AdaptiveLimit:
+  """Concurrency limit of an API service, adapted to its throttling signals.
+
+  The limit follows AIMD (additive increase, multiplicative decrease): it
+  grows by one every `limit` successful requests whose latency is stable (at
+  most `latency_tolerance` times the lowest smoothed latency seen), and is
+  multiplied by `backoff` when a request is throttled (HTTP 429 or 503). The
+  limit is cut at most once per `cooldown` seconds, because a wave of
+  concurrent requests usually gets throttled together.
+
+  Callers either hold a slot while a request is in flight (see slot()), or
+  use `limit` to size a batch of requests.
+  """
+
+  def __init__(
+    self,
+    initial: int = config.API_CONCURRENCY_INITIAL,
+    minimum: int = 1,
+    maximum: int = config.API_CONCURRENCY_MAX,
+    backoff: float = 0.5,
+    latency_tolerance: float = 2.0,
+    cooldown: float = 1.0,
+  ):
+    self.minimum = minimum
+    self.maximum = maximum
+    self.backoff = backoff
+    self.latency_tolerance = latency_tolerance
+    self.cooldown = cooldown
+    self._limit = float(initial)
+    self._in_flight = 0
+    self._successes = 0
+    self._latency: Optional[float] = None
+    self._min_latency: Optional[float] = None
+    self._last_decrease = -math.inf
+    self._cond = threading.Condition()
+
+  @property
+  def limit(self) -> int:
+    return int(self._limit)
+
+  @contextlib.contextmanager
+  def slot(self):
+    """Waits until less than `limit` requests are in flight, and holds a slot
+    for one request. The outcome should be reported with record()."""
+    with self._cond:
+      self._cond.wait_for(lambda: self._in_flight < self.limit)
+      self._in_flight += 1
+    try:
+      yield
+    finally:
+      with self._cond:
+        self._in_flight -= 1
+        self._cond.notify()
+
+  def record(self, count: int = 1, throttled: bool = False, latency: Optional[float] = None):
+    """Records the outcome of `count` requests.
+
+    Args:
+      count: number of requests.
+      throttled: whether (some of) the requests were throttled.
+      latency: latency of the requests in seconds, if comparable between
+        requests of the service.
+    """
+    with self._cond:
+      if throttled:
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+          self._last_decrease = now
+          self._limit = max(self.minimum, self._limit * self.backoff)
+          self._successes = 0
+        return
+      if latency is not None:
+        self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+        if self._min_latency is None or self._latency < self._min_latency:
+          self._min_latency = self._latency
+        if self._latency > self._min_latency * self.latency_tolerance:
+          return
+      self._successes += count
+      while self._successes >= self._limit and self._limit < self.maximum:
+        self._successes -= int(self._limit)
+        self._limit = min(self.maximum, self._limit + 1)
+      self._cond.notify_all()
+
+
+_adaptive_limits: Dict[str, AdaptiveLimit] = {}
+_adaptive_limits_lock = threading.Lock()
+
+
+def get_adaptive_limit(service: str) -> AdaptiveLimit:
+  """Returns the adaptive concurrency limit of the API `service`."""
+  with _adaptive_limits_lock:
+    if service not in _adaptive_limits:
+      _adaptive_limits[service] = AdaptiveLimit()
+    return _adaptive_limits[service]
+
+
+def get_concurrency_limits() -> Dict[str, int]:
+  """Returns the current adaptive concurrency limit per API service."""
+  with _adaptive_limits_lock:
+    return {service: limit.limit for service, limit in _adaptive_limits.items()}
+
+
+class _ServiceLimiter:
+  """Limits the number of tasks per service running in the shared thread pool.
+
+  Tasks are tagged with the name of the service that they mostly call (e.g.
+  'logging'). Tasks over the limit of their service (see the
+  executor_service_limits configuration, and the AdaptiveLimit of the
+  service once it has been throttled) wait in a queue outside of the pool,
+  so that they don't occupy workers that tasks of other services could use.
+  The time from submission to the start of the execution (queueing delay) is
+  recorded per service.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._running: Dict[str, int] = collections.Counter()
+    self._queued: Dict[
+      str, Deque[Tuple[Any, Callable[[], Any], concurrent.futures.Future, float]]
+    ] = collections.defaultdict(collections.deque)
+    self._stats: Dict[str, Dict[str, float]] = collections.defaultdict(collections.Counter)
+    # started tasks: future returned by submit() -> future of the pool
+    self._started: Dict[concurrent.futures.Future, concurrent.futures.Future] = {}
+    self._promoted: set = set()
+
+  def submit(
+    self, pool: concurrent.futures.Executor, service: str, fn: Callable[[], Any]
+  ) -> concurrent.futures.Future:
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    # The queues are iterated by promote() and emptied by _start_queued() in
+    # other threads.
+    with self._lock:
+      self._queued[service].append((pool, fn, future, time.perf_counter()))
+    self._start_queued(service)
+    return future
+
+  def promote(
+    self, future: concurrent.futures.Future
+  ) -> Tuple[Optional[int], Optional[concurrent.futures.Future]]:
+    """Moves the task of `future` to the front of its service queue, so that it
+    is started (and promoted in the pool) next.
+
+    Returns the number of tasks that it overtook if it was queued, and the
+    future of the pool if it was already started.
+    """
+    with self._lock:
+      if future in self._started:
+        return None, self._started[future]
+      for queue in self._queued.values():
+        for position, task in enumerate(queue):
+          if task[2] is future:
+            del queue[position]
+            queue.appendleft(task)
+            self._promoted.add(future)
+            return position, None
+    return None, None
+
+  def _limit(self, service: str) -> Optional[int]:
+    limits = [(config.get('executor_service_limits') or {}).get(service)]
+    with _adaptive_limits_lock:
+      if service in _adaptive_limits:
+        limits.append(_adaptive_limits[service].limit)
+    return min((limit for limit in limits if limit), default=None)
+
+  def _start_queued(self, service: str):
+    limit = self._limit(service)
+    while True:
+      with self._lock:
+        if not self._queued[service] or (limit and self._running[service] >= limit):
+          return
+        task = self._queued[service].popleft()
+        self._running[service] += 1
+      self._start(service, *task)
+
+  def _start(self, service, pool, fn, future, submitted):
+    def run():
+      try:
+        self._record(service, time.perf_counter() - submitted)
+        if not future.set_running_or_notify_cancel():
+          return
+        try:
+          result = fn()
+        except BaseException as err:  # pylint: disable=broad-exception-caught
+          future.set_exception(err)
+        else:
+          future.set_result(result)
+      finally:
+        with self._lock:
+          self._running[service] -= 1
+          self._started.pop(future, None)
+        self._start_queued(service)
+
+    pool_future = pool.submit(run)
+    if pool_future.cancelled():
+      # The executor was cancelled, _start_queued() continues with the next task.
+      self._cancel_started(service, future)
+      return
+    pool_future.add_done_callback(functools.partial(self._on_pool_done, service, future))
+    with self._lock:
+      if future.done():
+        return
+      self._started[future] = pool_future
+      if future not in self._promoted:
+        return
+      self._promoted.discard(future)
+    _scheduler.promote(pool_future)
+
+  def _on_pool_done(self, service, future, pool_future):
+    # run() is never called if the task was cancelled while queued in the pool.
+    if pool_future.cancelled():
+      self._cancel_started(service, future)
+      self._start_queued(service)
+
+  def _cancel_started(self, service, future):
+    if future.cancel():
+      future.set_running_or_notify_cancel()
+    with self._lock:
+      self._running[service] -= 1
+      self._started.pop(future, None)
+
+  def _record(self, service: str, queue_time: float):
+    with self._lock:
+      stats = self._stats[service]
+      stats['tasks'] += 1
+      stats['queue_time'] += queue_time
+      stats['max_queue_time'] = max(stats['max_queue_time'], queue_time)
+
+  def stats(self) -> Dict[str, Dict[str, float]]:
+    with self._lock:
+      return {service: dict(stats) for service, stats in self._stats.items()}
+
+
+_limiter = _ServiceLimiter()
+
+
+def get_service_stats() -> Dict[str, Dict[str, float]]:
+  """Returns the number of tasks and their queueing delay (total and maximum,
+  in seconds) per service."""
+  return _limiter.stats()
+
+
+def promote(future: concurrent.futures.Future) -> bool:
+  """Starts the queued task of `future` (returned by submit_for_service() or
+  by an executor of this module) before the other queued tasks.
+
+  This is meant for tasks that the caller is about to wait for, e.g. the
+  prefetch function of the lint rule that runs next. Returns whether the
+  task was still queued.
+  """
+  start = time.perf_counter()
+  overtaken, pool_future = _limiter.promote(future)
+  if overtaken is None:
+    overtaken = _scheduler.promote(pool_future or future)
+  if overtaken is None:
+    return False
+  _scheduler.record_promotion(overtaken, time.perf_counter() - start)
+  return True
+
+
+def get_scheduling_stats() -> Dict[str, float]:
+  """Returns the number of promoted tasks, the number of tasks that they
+  overtook, and the time spent reordering the queues (total and maximum, in
+  seconds)."""
+  return _scheduler.stats()
+
+
+def format_service_stats(stats: Dict[str, Dict[str, float]]) -> str:
+  """Format the per-service task counters as a table."""
+  header = f'{"service":<20} {"tasks":>6} {"queue s":>8} {"avg ms":>8} {"max ms":>8}'
+  lines = [header, '-' * len(header)]
+  for service, s in sorted(stats.items()):
+    lines.append(
+      f'{service:<20} {s["tasks"]:>6} {s["queue_time"]:>8.2f}'
+      f' {s["queue_time"] / s["tasks"] * 1000:>8.1f} {s["max_queue_time"] * 1000:>8.1f}'
+    )
+  return '\n'.join(lines)
+
+
 def _context_wrapper(fn, context: models.Context):
   def wrapped(*args, **kwargs):
     provider = context.context_provider
@@ -42,22 +537,92 @@ def _context_wrapper(fn, context: models.Context):
   return wrapped
 
 
+def _token_wrapper(fn, token: CancellationToken):
+  def wrapped(*args, **kwargs):
+    previous = getattr(_local, 'token', None)
+    _local.token = token
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      _local.token = previous
+
+  return wrapped
+
+
+def _traced(fn: Callable[..., Any]) -> Callable[..., Any]:
+  """Records the execution of fn as a span, with the time it was queued."""
+  name = getattr(fn, '__qualname__', type(fn).__name__)
+  submitted = time.perf_counter()
+
+  def traced(*args, **kwargs):
+    with tracing.span(name, 'task', queued_ms=round((time.perf_counter() - submitted) * 1e3, 3)):
+      return fn(*args, **kwargs)
+
+  return traced
+
+
 class ContextAwareExecutor:
   """A ThreadPoolExecutor wrapper that propagates the gcpdiag context.
 
   This executor ensures that the thread-local context (e.g., for API clients)
   is properly set up and torn down for each task executed in the thread pool.
+
+  The executor is also a group of tasks that can be cancelled together, e.g.
+  when their results are no longer needed: queued tasks are cancelled, and
+  running tasks stop at their next check_cancelled() call. The cancellation
+  token of the executor is a child of the token current at its creation, with
+  an optional deadline.
   """
 
-  def __init__(self, context: models.Context):
+  def __init__(
+    self,
+    context: models.Context,
+    timeout: Optional[float] = None,
+    max_workers: Optional[int] = None,
+  ):
     self._context = context
-    self._executor = _get_real_executor()
+    # Tasks that wait for tasks of the shared pool (e.g. lint rules waiting for
+    # their prefetch functions) run in dedicated threads, so that they can't
+    # occupy all the workers of the shared pool and deadlock it.
+    self._pool = (
+      concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) if max_workers else None
+    )
+    self.token = CancellationToken(
+      current_token(), time.monotonic() + timeout if timeout is not None else None
+    )
+    self._lock = threading.Lock()
+    self._futures: Set[concurrent.futures.Future] = set()
 
   def submit(
     self, fn: Callable[..., Any], *args: Any, **kwargs: Any
   ) -> concurrent.futures.Future[Any]:
-    wrapped_fn = _context_wrapper(fn, self._context)
-    return self._executor.submit(wrapped_fn, *args, **kwargs)
+    if tracing.enabled():
+      fn = _traced(fn)
+    fn = fingerprints.propagate(fn)
+    wrapped_fn = _token_wrapper(_context_wrapper(fn, self._context), self.token)
+    if self._pool:
+      future = self._pool.submit(wrapped_fn, *args, **kwargs)
+    else:
+      future = _scheduler.submit(functools.partial(wrapped_fn, *args, **kwargs))
+    with self._lock:
+      self._futures.add(future)
+    future.add_done_callback(self._discard)
+    if self.token.cancelled:
+      _scheduler.cancel(future)
+    return future
+
+  def _discard(self, future: concurrent.futures.Future):
+    with self._lock:
+      self._futures.discard(future)
+
+  def cancel(self, reason: str = 'cancelled'):
+    """Cancels the tasks of this executor, including the tasks submitted
+    later."""
+    self.token.cancel(reason)
+    with self._lock:
+      futures = list(self._futures)
+    for future in futures:
+      _scheduler.cancel(future)
 
   def map(
     self,
@@ -66,19 +631,63 @@ class ContextAwareExecutor:
     timeout: Optional[float] = None,
     chunksize: int = 1,
   ):
-    wrapped_fn = _context_wrapper(fn, self._context)
-    return self._executor.map(wrapped_fn, *iterables, timeout=timeout, chunksize=chunksize)
+    # Executor.map() submits the calls with self.submit()
+    return concurrent.futures.Executor.map(
+      self, fn, *iterables, timeout=timeout, chunksize=chunksize
+    )  # type: ignore[arg-type]
 
-  def shutdown(self, wait: bool = True):
-    # We don't shut down the underlying global executor here
-    pass
+  def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+    # We don't shut down the underlying global executor here, only the tasks
+    # of this executor are waited for or cancelled.
+    if cancel_futures:
+      self.cancel('executor shut down')
+    if wait:
+      with self._lock:
+        futures = list(self._futures)
+      concurrent.futures.wait(futures)
+    if self._pool:
+      self._pool.shutdown(wait=wait)
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_val, exc_tb):
-    self.shutdown(wait=True)
+    # The results of the tasks are lost if the block raised an exception.
+    self.shutdown(wait=True, cancel_futures=exc_type is not None)
+
+
+def get_executor(
+  context: models.Context, max_workers: Optional[int] = None
+) -> ContextAwareExecutor:
+  return ContextAwareExecutor(context, max_workers=max_workers)
+
 
+def submit_for_service(
+  pool: Any, service: str, fn: Callable[..., Any], *args: Any, **kwargs: Any
+) -> concurrent.futures.Future:
+  """Submits fn to `pool` (e.g. a ContextAwareExecutor) within the concurrency
+  limit of `service`, the API mostly called by fn (see _ServiceLimiter)."""
+  return _limiter.submit(pool, service, functools.partial(fn, *args, **kwargs))
 
-def get_executor(context: models.Context) -> ContextAwareExecutor:
-  return ContextAwareExecutor(context)
+
+def submit_background(
+  fn: Callable[..., Any], *args: Any, **kwargs: Any
+) -> concurrent.futures.Future:
+  """Runs fn in the shared thread pool, outside of any gcpdiag context.
+
+  This is meant for work that doesn't belong to a lint rule or runbook step,
+  like refreshing cached documents in the background. The tasks are started
+  after the queued tasks of lint rules and runbook steps.
+  """
+  return _scheduler.submit(functools.partial(fn, *args, **kwargs), PRIORITY_BACKGROUND)
+
+
+def submit_io(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> concurrent.futures.Future:
+  """Runs fn, a short blocking I/O operation (e.g. a disk cache lookup), in a
+  small thread pool of its own.
+
+  This is meant for coroutines that must not block their event loop: the
+  operations don't wait behind the tasks queued in the shared thread pool
+  (prefetch functions, logs queries).
+  """
+  return _get_io_executor().submit(fn, *args, **kwargs)
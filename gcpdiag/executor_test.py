@@ -15,10 +15,13 @@
 # Lint as: python3
 """Unit tests for executor.py."""
 
+import concurrent.futures
+import threading
+import time
 import unittest
 from unittest import mock
 
-from gcpdiag import executor, models
+from gcpdiag import config, executor, models
 
 
 class ContextAwareExecutorTest(unittest.TestCase):
@@ -48,6 +51,276 @@ class ContextAwareExecutorTest(unittest.TestCase):
     mock_provider.setup_thread_context.assert_called_once()
     mock_provider.teardown_thread_context.assert_called_once()
 
+  def test_submit_background(self):
+    self.assertEqual(executor.submit_background(lambda x: x * 2, 21).result(), 42)
+
+  def test_submit_io(self):
+    # I/O operations don't wait for the tasks queued in the shared pool
+    release = threading.Event()
+    self.addCleanup(release.set)
+    with mock.patch.object(executor, '_scheduler', executor._Scheduler(max_running=1)):
+      executor.submit_background(release.wait, 10)
+      executor.submit_background(release.wait, 10)
+      self.assertEqual(executor.submit_io(lambda x: x * 2, 21).result(10), 42)
+
+
+class ServiceLimitsTest(unittest.TestCase):
+  """Test the per-service concurrency limits."""
+
+  def setUp(self):
+    for patcher in [
+      mock.patch('gcpdiag.executor._limiter', executor._ServiceLimiter()),
+      mock.patch.dict(config._defaults, {'executor_service_limits': {'slow': 2}}),
+    ]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.executor = executor.ContextAwareExecutor(context=mock.Mock(spec=models.Context))
+
+  def test_limit(self):
+    release = threading.Event()
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def slow_task():
+      with lock:
+        running.append(1)
+        max_running.append(len(running))
+      release.wait(10)
+      with lock:
+        running.pop()
+
+    futures = [executor.submit_for_service(self.executor, 'slow', slow_task) for _ in range(5)]
+    # other services are not blocked by the queued tasks
+    fast = executor.submit_for_service(self.executor, 'fast', lambda: 'done')
+    self.assertEqual(fast.result(10), 'done')
+    release.set()
+    for f in futures:
+      f.result(10)
+    self.assertEqual(max(max_running), 2)
+    stats = executor.get_service_stats()
+    self.assertEqual((stats['slow']['tasks'], stats['fast']['tasks']), (5, 1))
+    self.assertGreater(stats['slow']['max_queue_time'], 0)
+    self.assertIn('slow', executor.format_service_stats(stats))
+
+  def test_exceptions(self):
+    with self.assertRaises(ValueError):
+      executor.submit_for_service(self.executor, 'slow', int, 'x').result(10)
+    # the failed task released its slot
+    self.assertEqual(executor.submit_for_service(self.executor, 'slow', int, '1').result(10), 1)
+
+  def test_concurrent_submit_and_promote(self):
+    release = threading.Event()
+    blockers = [
+      executor.submit_for_service(self.executor, 'slow', release.wait, 10) for _ in range(2)
+    ]
+    futures = []
+    futures_lock = threading.Lock()
+
+    def submit(service):
+      for _ in range(200):
+        future = executor.submit_for_service(self.executor, service, int, '1')
+        with futures_lock:
+          futures.append(future)
+        executor._limiter.promote(future)
+
+    threads = [threading.Thread(target=submit, args=(s,)) for s in ['slow', 'slow', 's1', 's2']]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join(10)
+    release.set()
+    done, _ = concurrent.futures.wait(futures + blockers, timeout=10)
+    self.assertEqual(len(done), 802)
+    self.assertEqual(sum(f.result() for f in futures), 800)
+
+
+class SchedulerTest(unittest.TestCase):
+  """Test the priority scheduling of the tasks."""
+
+  def setUp(self):
+    patcher = mock.patch('gcpdiag.executor._scheduler', executor._Scheduler(max_running=1))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.started = []
+    self.release = threading.Event()
+    # occupy the only worker
+    self.blocker = executor._scheduler.submit(lambda: self.release.wait(10))
+
+  def task(self, name):
+    return lambda: self.started.append(name)
+
+  def test_priorities(self):
+    futures = [
+      executor.submit_background(self.task('background')),
+      executor._scheduler.submit(self.task('a')),
+      executor._scheduler.submit(self.task('b')),
+    ]
+    self.release.set()
+    concurrent.futures.wait(futures, timeout=10)
+    self.assertEqual(self.started, ['a', 'b', 'background'])
+
+  def test_promote(self):
+    futures = [executor._scheduler.submit(self.task(name)) for name in 'abc']
+    self.assertTrue(executor.promote(futures[2]))
+    self.release.set()
+    concurrent.futures.wait(futures, timeout=10)
+    self.assertEqual(self.started, ['c', 'a', 'b'])
+    # started tasks can't be promoted
+    self.assertFalse(executor.promote(futures[2]))
+    self.assertFalse(executor.promote(self.blocker))
+    stats = executor.get_scheduling_stats()
+    self.assertEqual((stats['promotions'], stats['overtaken']), (1, 2))
+    self.assertGreater(stats['reorder_time'], 0)
+
+  @mock.patch('gcpdiag.executor._limiter', executor._ServiceLimiter())
+  @mock.patch.dict(config._defaults, {'executor_service_limits': {'slow': 1}})
+  def test_promote_service_task(self):
+    pool = executor.ContextAwareExecutor(context=mock.Mock(spec=models.Context))
+    futures = [executor.submit_for_service(pool, 'slow', self.task(n)) for n in 'abc']
+    other = executor._scheduler.submit(self.task('other'))
+    # 'a' is queued in the pool, 'c' is first in the service queue and then
+    # promoted in the pool when 'a' completes.
+    self.assertTrue(executor.promote(futures[0]))
+    self.assertTrue(executor.promote(futures[2]))
+    self.release.set()
+    concurrent.futures.wait(futures + [other], timeout=10)
+    self.assertEqual(self.started, ['a', 'c', 'other', 'b'])
+
+
+class CancellationTest(unittest.TestCase):
+  """Test the cooperative cancellation of tasks."""
+
+  def setUp(self):
+    patcher = mock.patch('gcpdiag.executor._scheduler', executor._Scheduler(max_running=1))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.executor = executor.ContextAwareExecutor(context=mock.Mock(spec=models.Context))
+
+  def test_token(self):
+    parent = executor.CancellationToken()
+    child = executor.CancellationToken(parent)
+    self.assertFalse(child.cancelled)
+    parent.cancel('stop')
+    with self.assertRaisesRegex(executor.TaskCancelledError, 'stop'):
+      child.check()
+    expired = executor.CancellationToken(executor.CancellationToken(deadline=0))
+    self.assertEqual(expired.reason(), 'deadline exceeded')
+
+  def test_run_deadline(self):
+    self.addCleanup(executor.set_run_deadline, None)
+    executor.check_cancelled()
+    executor.set_run_deadline(0.001)
+    time.sleep(0.01)
+    with self.assertRaises(executor.TaskCancelledError):
+      executor.check_cancelled()
+
+  def test_cancel(self):
+    started = threading.Event()
+    release = threading.Event()
+
+    def paging_task():
+      started.set()
+      release.wait(10)
+      executor.check_cancelled()
+
+    running = self.executor.submit(paging_task)
+    queued = self.executor.submit(lambda: 'never')
+    self.assertTrue(started.wait(10))
+    self.executor.shutdown(wait=False, cancel_futures=True)
+    release.set()
+    with self.assertRaisesRegex(executor.TaskCancelledError, 'executor shut down'):
+      running.result(10)
+    self.assertTrue(queued.cancelled())
+    self.assertTrue(self.executor.submit(lambda: 'later').cancelled())
+    # other executors are not affected
+    other = executor.ContextAwareExecutor(context=mock.Mock(spec=models.Context))
+    self.assertEqual(other.submit(lambda: 'done').result(10), 'done')
+
+  @mock.patch('gcpdiag.executor._limiter', executor._ServiceLimiter())
+  @mock.patch.dict(config._defaults, {'executor_service_limits': {'slow': 1}})
+  def test_cancel_service_tasks(self):
+    release = threading.Event()
+    futures = [
+      executor.submit_for_service(self.executor, 'slow', release.wait, 10) for _ in range(3)
+    ]
+    self.executor.cancel()
+    release.set()
+    concurrent.futures.wait(futures, timeout=10)
+    self.assertTrue(futures[2].cancelled())
+    # the slots of the cancelled tasks are released
+    self.assertEqual(executor._limiter._running['slow'], 0)
+
+  def test_context_manager(self):
+    with self.assertRaises(KeyError):
+      with self.executor as pool:
+        future = pool.submit(time.sleep, 0.01)
+        queued = pool.submit(lambda: 'never')
+        raise KeyError()
+    self.assertTrue(future.done())
+    self.assertTrue(queued.cancelled())
+
+  def test_cancellation_scope(self):
+    with executor.cancellation_scope() as token:
+      pool = executor.ContextAwareExecutor(context=mock.Mock(spec=models.Context))
+      self.assertIs(pool.token.parent, token)
+    self.assertTrue(pool.token.cancelled)
+    self.assertFalse(executor.current_token().cancelled)
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+  """Test the AIMD concurrency limit."""
+
+  def test_additive_increase(self):
+    limit = executor.AdaptiveLimit(initial=4, maximum=6)
+    limit.record(count=3)
+    self.assertEqual(limit.limit, 4)
+    limit.record(count=1)
+    self.assertEqual(limit.limit, 5)
+    limit.record(count=100)
+    self.assertEqual(limit.limit, 6)
+
+  def test_no_increase_with_unstable_latency(self):
+    limit = executor.AdaptiveLimit(initial=2)
+    limit.record(latency=0.1)
+    for _ in range(10):
+      limit.record(latency=1.0)
+    self.assertEqual(limit.limit, 2)
+
+  def test_multiplicative_decrease(self):
+    limit = executor.AdaptiveLimit(initial=16, cooldown=3600)
+    limit.record(throttled=True)
+    self.assertEqual(limit.limit, 8)
+    # requests throttled in the same wave only cut the limit once
+    limit.record(throttled=True)
+    self.assertEqual(limit.limit, 8)
+    limit = executor.AdaptiveLimit(initial=3, cooldown=0)
+    for _ in range(5):
+      limit.record(throttled=True)
+    self.assertEqual(limit.limit, 1)
+
+  def test_slot(self):
+    limit = executor.AdaptiveLimit(initial=1)
+    entered = threading.Event()
+    with limit.slot():
+      thread = threading.Thread(target=self._enter_slot, args=(limit, entered))
+      thread.start()
+      self.assertFalse(entered.wait(0.1))
+    self.assertTrue(entered.wait(10))
+    thread.join()
+
+  def _enter_slot(self, limit, entered):
+    with limit.slot():
+      entered.set()
+
+  @mock.patch('gcpdiag.executor._adaptive_limits', {})
+  def test_service_limiter(self):
+    executor.get_adaptive_limit('slow').record(throttled=True)
+    self.assertEqual(executor.get_concurrency_limits(), {'slow': 50})
+    with mock.patch.dict(config._defaults, {'executor_service_limits': {'slow': 100}}):
+      self.assertEqual(executor._ServiceLimiter()._limit('slow'), 50)
+      self.assertIsNone(executor._ServiceLimiter()._limit('fast'))
+
 
 if __name__ == '__main__':
   unittest.main()
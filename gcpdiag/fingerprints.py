@@ -0,0 +1,259 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fingerprints of the inputs of lint rules, for incremental lint.
+
+An InputRecorder records the calls of cached_api_call functions done by a rule
+(directly, the calls done by these functions are covered by the outer call),
+with a digest of their results. The calls can be repeated later with probe()
+to check whether the inputs of the rule changed: the results come from the
+cache if they are still cached, or else from the APIs, and each call is done
+only once for all rules. This isn't cheaper than the calls of the rule, and
+there is no cheaper freshness check: the APIs used by the queries don't
+support conditional requests (etags) and the fingerprints of the resources
+are only returned with the resources themselves, and the results of most
+calls are only cached for one execution. It saves the execution of the rules
+whose inputs didn't change, and the rules that do run reuse the results of
+the probe. The API requests sent by the probes are counted (see
+get_probe_requests) so that the savings can be reported.
+
+A recorder is incomplete, and the rule can't be reused, if the rule sends API
+requests that don't go through cached_api_call (e.g. logs or monitoring
+queries), or if the arguments or results of a call can't be serialized.
+Query functions that memoize the results of cached_api_call functions must
+themselves be cached_api_call functions (with in_memory=True) rather than
+functools.lru_cache: the calls hidden by an lru_cache hit would not be
+recorded for the rules after the first one.
+
+Contexts are not serialized: they are replaced by their identity (see
+Context.__cache_key__), and by the context of the execution doing the probe,
+which must be equivalent to the one of the recording. The calls of different
+contexts (e.g. the projects of a multi-project execution) therefore have
+different digests.
+"""
+
+import contextlib
+import hashlib
+import importlib
+import io
+import logging
+import pickle
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from gcpdiag import models
+
+_local = threading.local()
+# Digests of the results of the calls recorded or probed by this execution.
+_digests: Dict[bytes, str] = {}
+_digests_lock = threading.Lock()
+# Number of API requests sent by probe() in this execution.
+_probe_requests = 0
+
+
+class _Pickler(pickle.Pickler):
+  def persistent_id(self, obj):
+    if isinstance(obj, models.Context):
+      return ('context', obj.__cache_key__())
+    return None
+
+
+class _Unpickler(pickle.Unpickler):
+  def __init__(self, file, context: models.Context):
+    super().__init__(file)
+    self._context = context
+
+  def persistent_load(self, pid):
+    if pid[0] == 'context' and pid[1] == self._context.__cache_key__():
+      return self._context
+    raise pickle.UnpicklingError(f'unsupported persistent id: {pid}')
+
+
+def dumps(obj: Any) -> bytes:
+  """Serializes `obj`, replacing the contexts it references by their identity."""
+  f = io.BytesIO()
+  _Pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+  return f.getvalue()
+
+
+def loads(data: bytes, context: models.Context) -> Any:
+  """Deserializes `data`, referencing `context` instead of the contexts of the
+  serialized objects, which must be equivalent to it."""
+  return _Unpickler(io.BytesIO(data), context).load()
+
+
+class InputRecorder:
+  """Inputs of a rule: the calls of cached_api_call functions and the digest of
+  their results."""
+
+  inputs: Dict[bytes, str]
+  complete: bool
+
+  def __init__(self) -> None:
+    # serialized call -> digest of its result
+    self.inputs = {}
+    self.complete = True
+    self._lock = threading.Lock()
+
+  def add(self, func: Callable, args: tuple, kwargs: dict, result: Any) -> None:
+    if not self.complete:
+      return
+    try:
+      call = dumps((func.__module__, func.__qualname__, args, kwargs))
+      digest = _digest(call, result)
+    except (pickle.PicklingError, TypeError, AttributeError, RecursionError) as err:
+      logging.debug("can't fingerprint call of %s: %s", func.__qualname__, err)
+      self.complete = False
+      return
+    with self._lock:
+      self.inputs[call] = digest
+
+
+def _digest(call: bytes, result: Any) -> str:
+  with _digests_lock:
+    digest = _digests.get(call)
+  if digest is None:
+    if isinstance(result, Exception):
+      # rules usually handle API errors, but the errors can't be serialized
+      result = ('error', type(result).__qualname__, str(result))
+    digest = hashlib.sha256(dumps(result)).hexdigest()
+    with _digests_lock:
+      _digests[call] = digest
+  return digest
+
+
+def recording(recorder: Optional[InputRecorder]):
+  """Context manager recording the inputs of the current thread with
+  `recorder` (no-op if None)."""
+  if recorder is None:
+    return contextlib.nullcontext()
+  return _recording(recorder)
+
+
+@contextlib.contextmanager
+def _recording(recorder: InputRecorder):
+  previous = getattr(_local, 'state', None)
+  _local.state = (recorder, 0)
+  try:
+    yield recorder
+  finally:
+    _local.state = previous
+
+
+def begin_call() -> Optional[Tuple[InputRecorder, int]]:
+  """Called by cached_api_call before a call, returns the recording state to be
+  passed to record_call() and end_call()."""
+  state = getattr(_local, 'state', None)
+  if state is not None:
+    # the calls done by this call are not inputs of the rule
+    _local.state = (state[0], state[1] + 1)
+  return state
+
+
+def record_call(
+  state: Optional[Tuple[InputRecorder, int]], func: Callable, args, kwargs, result: Any
+) -> None:
+  if state is not None and state[1] == 0:
+    state[0].add(func, args, kwargs, result)
+
+
+def end_call(state: Optional[Tuple[InputRecorder, int]]) -> None:
+  if state is not None:
+    _local.state = state
+
+
+def record_request() -> None:
+  """Called for every API request: requests sent by a rule outside of a
+  cached_api_call function make its inputs incomplete."""
+  global _probe_requests
+  state = getattr(_local, 'state', None)
+  if state is not None and state[1] == 0:
+    state[0].complete = False
+  if getattr(_local, 'probing', False):
+    with _digests_lock:
+      _probe_requests += 1
+
+
+def get_probe_requests() -> int:
+  """Returns the number of API requests sent by probe() in this execution."""
+  with _digests_lock:
+    return _probe_requests
+
+
+def propagate(fn: Callable) -> Callable:
+  """Returns `fn` recording its inputs with the recorder of the current thread,
+  and counting its requests if it is probing, for tasks submitted to an
+  executor."""
+  state = getattr(_local, 'state', None)
+  probing = getattr(_local, 'probing', False)
+  if state is None and not probing:
+    return fn
+
+  def wrapped(*args, **kwargs):
+    previous = (getattr(_local, 'state', None), getattr(_local, 'probing', False))
+    _local.state, _local.probing = state, probing
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      _local.state, _local.probing = previous
+
+  return wrapped
+
+
+@contextlib.contextmanager
+def _probing():
+  previous = getattr(_local, 'probing', False)
+  _local.probing = True
+  try:
+    yield
+  finally:
+    _local.probing = previous
+
+
+def _resolve(module_name: str, qualname: str) -> Callable:
+  obj: Any = importlib.import_module(module_name)
+  for name in qualname.split('.'):
+    obj = getattr(obj, name)
+  return obj
+
+
+def probe(inputs: Dict[bytes, str], context: models.Context) -> bool:
+  """Repeats the recorded calls and returns True if all of them return results
+  with the same digest.
+
+  The calls go through the cache like the calls of the rule (see the module
+  docstring), so a probe costs as many API requests as an execution of the
+  rule. They are counted by get_probe_requests().
+  """
+  for call, digest in inputs.items():
+    try:
+      module_name, qualname, args, kwargs = loads(call, context)
+      func = _resolve(module_name, qualname)
+    except (pickle.UnpicklingError, ImportError, AttributeError, EOFError) as err:
+      logging.debug("can't repeat recorded call: %s", err)
+      return False
+    with _digests_lock:
+      known_digest = _digests.get(call)
+    if known_digest is None:
+      try:
+        with _probing():
+          result = func(*args, **kwargs)
+      except Exception as err:  # pylint: disable=broad-except
+        result = err
+      try:
+        known_digest = _digest(call, result)
+      except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+        return False
+    if known_digest != digest:
+      return False
+  return True
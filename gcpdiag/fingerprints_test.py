@@ -0,0 +1,123 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test code in fingerprints.py."""
+
+import threading
+import unittest
+from unittest import mock
+
+from gcpdiag import caching, executor, fingerprints, models
+from gcpdiag.queries import apis_stub, iam
+
+_values = {'a': 1, 'b': 2}
+_project_values = {'project-a': 'a', 'project-b': 'b'}
+
+
+@caching.cached_api_call(in_memory=True)
+def _get_value(context: models.Context, name: str):
+  del context
+  fingerprints.record_request()
+  return _values[name]
+
+
+@caching.cached_api_call(in_memory=True)
+def _get_sum(context: models.Context):
+  return _get_value(context, 'a') + _get_value(context, 'b')
+
+
+@caching.cached_api_call(in_memory=True)
+def _get_project_value(context: models.Context):
+  return _project_values[context.project_id]
+
+
+@caching.cached_api_call(in_memory=True)
+def _get_lock():
+  return threading.Lock()
+
+
+@mock.patch.object(caching, '_use_cache', True)
+class FingerprintsTest(unittest.TestCase):
+  """Test the recording and probing of rule inputs."""
+
+  def setUp(self):
+    self.context = models.Context(project_id='fingerprints-project')
+    self.addCleanup(fingerprints._digests.clear)
+
+  def test_record_direct_calls(self):
+    recorder = fingerprints.InputRecorder()
+    with fingerprints.recording(recorder):
+      _get_sum(self.context)
+      _get_value(self.context, 'a')
+    self.assertTrue(recorder.complete)
+    calls = [fingerprints.loads(call, self.context)[1:3] for call in recorder.inputs]
+    # the calls done by _get_sum are not recorded
+    self.assertEqual(calls, [('_get_sum', (self.context,)), ('_get_value', (self.context, 'a'))])
+
+  def test_record_executor_tasks(self):
+    recorder = fingerprints.InputRecorder()
+    with fingerprints.recording(recorder):
+      with executor.get_executor(self.context) as e:
+        e.submit(_get_value, self.context, 'b').result()
+    self.assertEqual(len(recorder.inputs), 1)
+
+  def test_incomplete(self):
+    recorder = fingerprints.InputRecorder()
+    with fingerprints.recording(recorder):
+      _get_lock()
+    self.assertFalse(recorder.complete)
+    recorder = fingerprints.InputRecorder()
+    with fingerprints.recording(recorder):
+      fingerprints.record_request()
+    self.assertFalse(recorder.complete)
+
+  def test_probe(self):
+    recorder = fingerprints.InputRecorder()
+    with fingerprints.recording(recorder):
+      _get_sum(self.context)
+    fingerprints._digests.clear()
+    self.assertTrue(fingerprints.probe(recorder.inputs, self.context))
+    fingerprints._digests.clear()
+    _values['b'] = 3
+    self.addCleanup(_values.__setitem__, 'b', 2)
+    requests = fingerprints.get_probe_requests()
+    with caching.bypass_cache():
+      self.assertFalse(fingerprints.probe(recorder.inputs, self.context))
+    # the results of _get_sum were cached, until the cache was bypassed
+    self.assertEqual(fingerprints.get_probe_requests() - requests, 2)
+
+  def test_multiple_contexts(self):
+    contexts = [models.Context(project_id=p) for p in _project_values]
+    recorders = [fingerprints.InputRecorder() for _ in contexts]
+    for context, recorder in zip(contexts, recorders):
+      with fingerprints.recording(recorder):
+        _get_project_value(context)
+    # the same call in different projects has different digests
+    self.assertNotEqual(*[list(r.inputs.values()) for r in recorders])
+    self.assertTrue(fingerprints.probe(recorders[1].inputs, contexts[1]))
+    # the inputs of a project can't be probed in another project
+    self.assertFalse(fingerprints.probe(recorders[1].inputs, contexts[0]))
+
+  @mock.patch('gcpdiag.queries.apis.get_api', new=apis_stub.get_api_stub)
+  def test_memoized_queries(self):
+    # the results of memoized queries are inputs of all the rules using them
+    recorders = [fingerprints.InputRecorder() for _ in range(2)]
+    for recorder in recorders:
+      with fingerprints.recording(recorder):
+        iam._get_iam_role('roles/owner', 'gcpdiag-iam1-aaaa')
+    self.assertEqual(recorders[0].inputs, recorders[1].inputs)
+    self.assertEqual(len(recorders[1].inputs), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
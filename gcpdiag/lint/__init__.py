@@ -31,12 +31,20 @@ import threading
 import time
 import types
 from collections.abc import Callable
-from typing import Any, Dict, Iterable, Iterator, List, Optional, Protocol, Set
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Protocol, Set, Tuple
 
 import googleapiclient.errors
 
-from gcpdiag import config, models, utils
-from gcpdiag.executor import get_executor
+from gcpdiag import config, fingerprints, models, profiling, tracing, utils
+from gcpdiag.executor import (
+  TaskCancelledError,
+  check_cancelled,
+  current_token,
+  get_executor,
+  promote,
+  submit_for_service,
+)
+from gcpdiag.lint import incremental
 
 # to avoid confusion with gcpdiag.lint.gce
 from gcpdiag.queries import gce as gce_mod
@@ -76,6 +84,10 @@ class LintRule:
   prepare_rule_f: Optional[Callable] = None
   prefetch_rule_f: Optional[Callable] = None
   prefetch_rule_future: Optional[concurrent.futures.Future] = None
+  # logs queries created by prepare_rule_f
+  logs_queries: List[logs.LogsQuery] = dataclasses.field(default_factory=list)
+  # inputs recorded for incremental lint (see incremental.py)
+  inputs: Optional[fingerprints.InputRecorder] = None
 
   def __post_init__(self):
     if self.tags:
@@ -166,10 +178,16 @@ class LintResults:
 
   _result_handlers: List[LintResultsHandler]
   _rule_reports: List[LintReportRuleInterface]
+  _lock: threading.Lock
+  # why the run was stopped (e.g. 'deadline exceeded'), if it was
+  cancelled: Optional[str]
 
   def __init__(self) -> None:
     self._result_handlers = []
     self._rule_reports = []
+    self.cancelled = None
+    # rules can finish in parallel threads
+    self._lock = threading.Lock()
 
   def get_rule_reports(self) -> List[LintReportRuleInterface]:
     return self._rule_reports
@@ -188,8 +206,9 @@ class LintResults:
     return LintReportRuleInterface(rule=rule, lint_result=self)
 
   def register_finished_rule_report(self, rule_report: LintReportRuleInterface) -> None:
-    self._rule_reports.append(rule_report)
-    self._notify_result_handlers(rule_report)
+    with self._lock:
+      self._rule_reports.append(rule_report)
+      self._notify_result_handlers(rule_report)
 
   def _notify_result_handlers(self, rule_report: LintReportRuleInterface) -> None:
     for handler in self._result_handlers:
@@ -289,6 +308,32 @@ def get_module_function_or_none(module: types.ModuleType, name: str) -> Optional
   return None if len(members) < 1 else members[0][1]
 
 
+def parse_rule_module_name(name: str) -> Optional[Tuple[str, str, str]]:
+  """Returns the (product, class prefix, id) of a lint rule module name, e.g.
+  ('gke', 'bp', '2021_001') for gcpdiag.lint.gke.bp_2021_001_cloudops_enabled,
+  or None if the module isn't a lint rule."""
+  # Skip code tests
+  if name.endswith('_test'):
+    return None
+
+  # Determine Lint Rule parameters based on the module name.
+  m = re.search(
+    r"""
+       \.
+       (?P<product>[^\.]+)                 # product path, e.g.: .gke.
+       \.
+       (?P<class_prefix>[a-z]+(?:_ext)?)   # class prefix, e.g.: 'err_' or 'err_ext'
+       _
+       (?P<rule_id>\d+_\d+)                # id: 2020_001
+    """,
+    name,
+    re.VERBOSE,
+  )
+  if not m:
+    return None
+  return m.group('product', 'class_prefix', 'rule_id')
+
+
 class ExecutionStrategy(Protocol):
   def run_rules(
     self, context: models.Context, result: LintResults, rules: Iterable[LintRule]
@@ -409,11 +454,14 @@ class LintRuleRepository:
     return self.execution_strategy.filter_runnable_rules(rules_filtered)
 
   def _rules_filtered(self) -> Iterator[LintRule]:
+    return self._filter_rules(self._loaded_rules)
+
+  def _filter_rules(self, rules: Iterable[LintRule]) -> Iterator[LintRule]:
     exclude = self._exclude
     include = self._include
     include_tags = self._include_tags
     exclude_tags = self._exclude_tags
-    for rule in self._loaded_rules:
+    for rule in rules:
       if include:
         if not any(x.match_rule(rule) for x in include):
           continue
@@ -429,28 +477,12 @@ class LintRuleRepository:
       yield rule
 
   def get_rule_by_module_name(self, name: str) -> LintRule:
-    # Skip code tests
-    if name.endswith('_test'):
+    parsed = parse_rule_module_name(name)
+    if not parsed:
+      # Assume this is not a rule (e.g. could be a "utility" module or a test)
       raise NotLintRuleError()
 
-    # Determine Lint Rule parameters based on the module name.
-    m = re.search(
-      r"""
-         \.
-         (?P<product>[^\.]+)                 # product path, e.g.: .gke.
-         \.
-         (?P<class_prefix>[a-z]+(?:_ext)?)   # class prefix, e.g.: 'err_' or 'err_ext'
-         _
-         (?P<rule_id>\d+_\d+)                # id: 2020_001
-      """,
-      name,
-      re.VERBOSE,
-    )
-    if not m:
-      # Assume this is not a rule (e.g. could be a "utility" module)
-      raise NotLintRuleError()
-
-    product, rule_class, rule_id = m.group('product', 'class_prefix', 'rule_id')
+    product, rule_class, rule_id = parsed
 
     module = self.modules_gateway.get_module(name)
 
@@ -515,14 +547,37 @@ class LintRuleRepository:
 
       self._register_rule(rule)
 
+  def load_rules_from_manifest(self, manifest: Iterable[Dict[str, Any]]) -> None:
+    """Loads the rules described by a rules manifest (see manifest.py).
+
+    The include/exclude filters are applied to the manifest entries, so that
+    only the modules of the rules that will run are imported."""
+    for entry in manifest:
+      if '_ext_' in entry['module'] and not self.load_extended:
+        continue
+      described_rule = LintRule(
+        product=entry['product'],
+        rule_class=LintRuleClass(entry['class']),
+        rule_id=entry['id'],
+        short_desc=entry['short_desc'],
+        long_desc=entry['long_desc'],
+        keywords=entry['keywords'],
+        tags=entry['tags'],
+      )
+      if not any(self._filter_rules([described_rule])):
+        continue
+      self._register_rule(self.get_rule_by_module_name(entry['module']))
+
   def _register_rule(self, rule: LintRule):
     self._loaded_rules.append(rule)
 
-  def run_rules(self, context: models.Context) -> None:
+  def run_rules(self, context: models.Context, result: Optional[LintResults] = None) -> None:
+    """Runs the rules for `context` and adds their reports to `result` (default:
+    self.result). The repository can be used for multiple contexts in turn."""
     # Make sure the rules are sorted alphabetically
     self._loaded_rules.sort(key=str)
     rules_to_run = self.rules_to_run
-    self.execution_strategy.run_rules(context, self.result, rules_to_run)
+    self.execution_strategy.run_rules(context, result or self.result, rules_to_run)
 
 
 class AsyncRunner:
@@ -560,15 +615,49 @@ class AsyncExecutionStrategy:
     return [r for r in rules if r.async_run_rule_f]
 
 
+# API service mostly called by the prefetch functions of the rules of each
+# product, whose concurrency limits apply to them (see executor_service_limits
+# and executor.AdaptiveLimit). The other products call the API of their name.
+PRODUCT_API_SERVICES = {
+  'asm': 'container',
+  'billing': 'cloudbilling',
+  'cloudrun': 'run',
+  'cloudsql': 'sqladmin',
+  'gae': 'appengine',
+  'gcb': 'cloudbuild',
+  'gce': 'compute',
+  'gcf': 'cloudfunctions',
+  'gcs': 'storage',
+  'gke': 'container',
+  'interconnect': 'compute',
+  'lb': 'compute',
+  'vertex': 'aiplatform',
+  'vpc': 'compute',
+}
+
+
+def get_api_service(rule: LintRule) -> str:
+  """Returns the API service mostly called by the prefetch function of `rule`."""
+  return PRODUCT_API_SERVICES.get(rule.product, rule.product)
+
+
 def wrap_prefetch_rule_f(rule_name, prefetch_rule_f, context):
   logging.debug('prefetch_rule_f: %s', rule_name)
   thread = threading.current_thread()
   thread.name = f'prefetch_rule_f:{rule_name}'
-  prefetch_rule_f(context)
+  with tracing.span(rule_name, 'prefetch'), profiling.span(rule_name, 'prefetch'):
+    prefetch_rule_f(context)
 
 
 class SyncExecutionStrategy:
-  """Execute rules using thread pool"""
+  """Execute rules using thread pool
+
+  The run_rule functions are executed in the main thread, or by
+  `rule_workers` threads in parallel (see --rule-workers).
+  """
+
+  _last_threads_dump: float
+  _incremental: Optional[incremental.IncrementalLint] = None
 
   def filter_runnable_rules(self, rules: Iterable[LintRule]) -> List[LintRule]:
     return [r for r in rules if r.run_rule_f]
@@ -582,7 +671,9 @@ class SyncExecutionStrategy:
     for rule in rules_to_run:
       if rule.prepare_rule_f:
         logging.debug('prepare_rule_f: %s', rule)
-        rule.prepare_rule_f(context)
+        with logs.record_queries() as rule.logs_queries, tracing.span(str(rule), 'prepare'):
+          with profiling.span(str(rule), 'prepare'):
+            rule.prepare_rule_f(context)
 
     # Start multiple threads for logs fetching and prefetch functions.
     executor = get_executor(context)
@@ -596,45 +687,129 @@ class SyncExecutionStrategy:
       gce_mod.execute_fetch_serial_port_outputs(executor)
 
     # Run the "prefetch_rule" functions with multiple worker threads to speed up
-    # execution of the "run_rule" executions later.
+    # execution of the "run_rule" executions later. With --incremental, the
+    # inputs of the rules are probed first, and their previous results are
+    # replayed if the inputs didn't change.
+    self._incremental = incremental.IncrementalLint(context) if incremental.enabled() else None
     for rule in rules_to_run:
-      if rule.prefetch_rule_f:
-        rule.prefetch_rule_future = executor.submit(
-          wrap_prefetch_rule_f, str(rule), rule.prefetch_rule_f, context
+      rule.inputs = None
+      if self._incremental and self._incremental.is_reusable(rule):
+        rule.inputs = fingerprints.InputRecorder()
+        rule.prefetch_rule_future = submit_for_service(
+          executor, get_api_service(rule), self._replay_or_prefetch, rule, context
+        )
+      elif rule.prefetch_rule_f:
+        rule.prefetch_rule_future = submit_for_service(
+          executor,
+          get_api_service(rule),
+          wrap_prefetch_rule_f,
+          str(rule),
+          rule.prefetch_rule_f,
+          context,
         )
 
     # While the prefetch_rule functions are still being executed in multiple
     # threads, start executing the rules, but block and wait in case the
     # prefetch for a specific rule is still running.
-    last_threads_dump = time.time()
-    for rule in rules_to_run:
-      rule_report = result.create_rule_report(rule)
-
-      # make sure prefetch_rule_f completed
-      try:
-        if rule.prefetch_rule_future:
-          if rule.prefetch_rule_future.running():
-            logging.info('waiting for query results (%s)', rule)
-          while True:
-            try:
-              rule.prefetch_rule_future.result(10)
-              break
-            except concurrent.futures.TimeoutError:
-              pass
-            if config.get('verbose') >= 2:
-              now = time.time()
-              if now - last_threads_dump > 10:
-                logging.debug('THREADS: %s', ', '.join([t.name for t in threading.enumerate()]))
-                last_threads_dump = now
+    self._last_threads_dump = time.time()
+    workers = config.get('rule_workers') or 1
+    try:
+      if workers <= 1:
+        for rule in rules_to_run:
+          self.run_rule(context, result, rule)
+      else:
+        # The rules wait for their prefetch functions, so they run in their own
+        # threads rather than in the shared pool. The result handlers receive
+        # the rule reports in completion order (see OutputOrderer).
+        with get_executor(context, max_workers=workers) as rule_executor:
+          for future in [
+            rule_executor.submit(self.run_rule, context, result, rule) for rule in rules_to_run
+          ]:
+            future.result()
+    finally:
+      # Stop the log queries and prefetch functions that are still running
+      # (e.g. after Ctrl-C), their results are not needed anymore.
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def _replay_or_prefetch(self, rule: LintRule, context: models.Context):
+    """Returns the previous results of `rule` if its inputs didn't change, or
+    runs its prefetch function recording its inputs."""
+    assert self._incremental is not None
+    results = self._incremental.replay(rule)
+    if results is None and rule.prefetch_rule_f:
+      with fingerprints.recording(rule.inputs):
+        wrap_prefetch_rule_f(str(rule), rule.prefetch_rule_f, context)
+    return results
+
+  def run_rule(self, context: models.Context, result: LintResults, rule: LintRule) -> None:
+    """Waits for the prefetch function of `rule` and runs it.
+
+    Once the run is cancelled (e.g. its deadline exceeded), the remaining rules
+    are skipped without being run.
+    """
+    rule_report = result.create_rule_report(rule)
+    if result.cancelled:
+      rule_report.add_skipped(None, f'Not run: {result.cancelled}', None)
+      rule_report.finish()
+      return
+    self.promote_rule(rule)
+
+    # make sure prefetch_rule_f completed
+    replayed_results = None
+    try:
+      check_cancelled()
+      if rule.prefetch_rule_future:
+        if rule.prefetch_rule_future.running():
+          logging.info('waiting for query results (%s)', rule)
+        wait_start = time.perf_counter()
+        # The future is waited for separately from result(), so that a
+        # TimeoutError raised by the prefetch function isn't mistaken for the
+        # timeout of the wait.
+        while not concurrent.futures.wait([rule.prefetch_rule_future], 10).done:
+          check_cancelled()
+          if config.get('verbose') >= 2:
+            now = time.time()
+            if now - self._last_threads_dump > 10:
+              logging.debug('THREADS: %s', ', '.join([t.name for t in threading.enumerate()]))
+              self._last_threads_dump = now
+        wait_end = time.perf_counter()
+        tracing.record(str(rule), 'wait', wait_start, wait_end)
+        profiling.record(str(rule), 'wait', wait_end - wait_start)
+        replayed_results = rule.prefetch_rule_future.result()
+      if self._incremental:
+        incremental.count_rule(reused=replayed_results is not None)
+      if replayed_results is not None:
+        rule_report.results.extend(replayed_results)
+      else:
         # run the rule
         assert rule.run_rule_f is not None
-        rule.run_rule_f(context, rule_report)
-      except (utils.GcpApiError, googleapiclient.errors.HttpError) as err:
-        if isinstance(err, googleapiclient.errors.HttpError):
-          err = utils.GcpApiError(err)
-        logging.warning('%s: %s while processing rule: %s', type(err).__name__, err, rule)
-        rule_report.add_skipped(None, f'API error: {err}', None)
-      except (RuntimeError, ValueError, KeyError, TypeError) as err:
-        logging.warning('%s: %s while processing rule: %s', type(err).__name__, err, rule)
-        rule_report.add_skipped(None, f'Error: {err}', None)
-      rule_report.finish()
+        with tracing.span(str(rule), 'run'), profiling.run(str(rule)):
+          with fingerprints.recording(rule.inputs):
+            rule.run_rule_f(context, rule_report)
+        if self._incremental and rule.inputs:
+          self._incremental.store(rule, rule.inputs, rule_report.results)
+    except (utils.GcpApiError, googleapiclient.errors.HttpError) as err:
+      if isinstance(err, googleapiclient.errors.HttpError):
+        err = utils.GcpApiError(err)
+      logging.warning('%s: %s while processing rule: %s', type(err).__name__, err, rule)
+      rule_report.add_skipped(None, f'API error: {err}', None)
+    except TaskCancelledError as err:
+      # Only the cancellation of the run stops it, the tasks of a rule can
+      # also be cancelled by the rule itself.
+      reason = current_token().reason()
+      if reason:
+        result.cancelled = reason
+      logging.warning('%s while processing rule: %s', err, rule)
+      rule_report.add_skipped(None, f'Cancelled: {err}', None)
+    except (RuntimeError, ValueError, KeyError, TypeError) as err:
+      logging.warning('%s: %s while processing rule: %s', type(err).__name__, err, rule)
+      rule_report.add_skipped(None, f'Error: {err}', None)
+    rule_report.finish()
+
+  def promote_rule(self, rule: LintRule) -> None:
+    """Starts the queued tasks that `rule` depends on (its logs queries and its
+    prefetch function) before the tasks of the rules that run later."""
+    futures = [q.job.future for q in rule.logs_queries] + [rule.prefetch_rule_future]
+    for future in futures:
+      if future and not future.done() and promote(future):
+        logging.debug('promoted queued task of %s', rule)
@@ -25,7 +25,19 @@ from typing import List, Optional
 
 from google.auth import exceptions
 
-from gcpdiag import config, hooks, lint, models, utils
+from gcpdiag import (
+  caching,
+  config,
+  executor,
+  fingerprints,
+  hooks,
+  lint,
+  models,
+  profiling,
+  tracing,
+  utils,
+)
+from gcpdiag.lint import incremental, manifest
 from gcpdiag.lint.output import api_output, csv_output, json_output, terminal_output
 from gcpdiag.queries import apis, crm, gce, kubectl
 
@@ -85,7 +97,21 @@ def init_args_parser():
   )
 
   parser.add_argument(
-    '--project', metavar='P', required=True, help='Project ID of project to inspect'
+    '--project',
+    metavar='P',
+    help='Project ID of project to inspect, or comma-separated list of projects',
+  )
+
+  parser.add_argument(
+    '--projects-file',
+    metavar='FILE',
+    help='Inspect the projects listed in FILE (one project ID per line)',
+  )
+
+  parser.add_argument(
+    '--project-parent',
+    metavar='PARENT',
+    help='Inspect the active projects in a folder or organization (folders/ID or organizations/ID)',
   )
 
   parser.add_argument(
@@ -256,6 +282,26 @@ def init_args_parser():
     ),
   )
 
+  parser.add_argument(
+    '--rule-workers',
+    metavar='N',
+    type=int,
+    help=(
+      'Number of rules executed in parallel after their prefetch, the output stays in rule'
+      f' order (default: {config.get("rule_workers")})'
+    ),
+  )
+
+  parser.add_argument(
+    '--run-deadline-seconds',
+    metavar='S',
+    type=int,
+    help=(
+      'Stop the run S seconds after the start: the API queries that are still running are'
+      ' stopped and the remaining rules are skipped (default: no deadline)'
+    ),
+  )
+
   parser.add_argument(
     '--output',
     metavar='FORMATTER',
@@ -276,6 +322,83 @@ def init_args_parser():
   parser.add_argument(
     '--reason', type=str, default=config.get('reason'), help='The reason for running gcpdiag'
   )
+
+  parser.add_argument(
+    '--cache-record',
+    action='store_true',
+    help=(
+      'Keep the results of all cached API calls of this execution, to be exported with'
+      ' "gcpdiag cache export"'
+    ),
+  )
+
+  parser.add_argument(
+    '--cache-readonly',
+    action='store_true',
+    help=(
+      'Replay the results of a recorded or imported execution from the cache, without calling'
+      ' the APIs'
+    ),
+  )
+
+  parser.add_argument(
+    '--cache-stats',
+    metavar='FILE',
+    nargs='?',
+    const='-',
+    help=(
+      'Print statistics of the API cache (hits, misses, wait and call time per query) and of'
+      ' the queueing delay per service at exit, or write them as JSON to FILE'
+    ),
+  )
+
+  parser.add_argument(
+    '--cache-share-calls',
+    action='store_true',
+    help=(
+      'Let only one of the gcpdiag processes running in parallel with the same cache directory'
+      ' call an API with given arguments, the others wait for its cached result'
+    ),
+  )
+
+  parser.add_argument(
+    '--profile',
+    metavar='FILE',
+    nargs='?',
+    const='-',
+    help=(
+      'Profile the rules: print the prepare, prefetch, wait and run time and API calls of each'
+      ' rule at exit, or write them as JSON to FILE'
+    ),
+  )
+
+  parser.add_argument(
+    '--profile-memory',
+    action='store_true',
+    help=(
+      'With --profile, also measure the peak memory of each rule. Tracing the memory'
+      ' allocations slows down the rules, so their times are longer than in a normal run'
+    ),
+  )
+
+  parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help=(
+      'Reuse the results of the previous execution of the rules whose inputs (cached API'
+      ' results) did not change, instead of running them again'
+    ),
+  )
+
+  parser.add_argument(
+    '--trace-file',
+    metavar='FILE',
+    help=(
+      'Record an execution trace (rules or steps, tasks, cached calls, HTTP requests and log'
+      ' queries) and write it as Chrome trace JSON to FILE, to be opened with chrome://tracing'
+      ' or https://ui.perfetto.dev'
+    ),
+  )
   return parser
 
 
@@ -302,8 +425,31 @@ def _parse_tag_pattern(
   return None
 
 
+def _get_project_ids(args) -> List[str]:
+  """Returns the projects to inspect, selected with --project, --projects-file
+  and --project-parent."""
+  project_ids = []
+  if args.project:
+    project_ids += [p for p in _flatten_multi_arg([args.project]) if p]
+  if args.projects_file:
+    with open(args.projects_file, encoding='utf-8') as f:
+      for line in f:
+        line = line.split('#', 1)[0].strip()
+        if line:
+          project_ids.append(line)
+  if args.project_parent:
+    project_ids += crm.get_projects_in_parent(args.project_parent)
+  # remove duplicates, but keep the order
+  return list(dict.fromkeys(project_ids))
+
+
 def _load_repository_rules(repo: lint.LintRuleRepository):
-  """Find and load all lint rule modules dynamically"""
+  """Load the lint rules, importing only the rule modules selected by the
+  repository filters if the rules manifest is up to date, or else all of them."""
+  rules_manifest = manifest.load_manifest()
+  if rules_manifest is not None:
+    repo.load_rules_from_manifest(rules_manifest)
+    return
   for module in pkgutil.walk_packages(
     lint.__path__,  # type: ignore
     lint.__name__ + '.',
@@ -344,7 +490,7 @@ def _initialize_output(output_order):
     'show_skipped': config.get('show_skipped'),
   }
   if config.get('interface') == 'cli':
-    if config.get('output') == 'terminal':
+    if config.get('output') in ('terminal', 'json', 'csv'):
       kwargs['output_order'] = output_order
   output = constructor(**kwargs)
   return output
@@ -375,9 +521,74 @@ def create_and_load_repos(
   return repo
 
 
-def run_rules_for_context(context: models.Context, repo: lint.LintRuleRepository):
+def run_rules_for_context(
+  context: models.Context,
+  repo: lint.LintRuleRepository,
+  result: Optional[lint.LintResults] = None,
+):
   """Core function to execute lint rules against a context."""
-  repo.run_rules(context)
+  repo.run_rules(context, result)
+
+
+def _warn_serial_port_logging(context: models.Context):
+  # Warn user to fallback on serial logs buffer if project isn't storing in
+  # cloud logging
+  if not gce.is_project_serial_port_logging_enabled(context.project_id) and not config.get(
+    'enable_gce_serial_buffer'
+  ):
+    # Only print the warning if GCE is enabled in the first place
+    if apis.is_enabled(context.project_id, 'compute'):
+      logging.warning(
+        """Serial output to cloud logging maybe disabled for certain GCE instances.
+          Fallback on serial output buffers by using flag --enable-gce-serial-buffer \n"""
+      )
+
+
+def _run_projects(args, project_ids: List[str], repo: lint.LintRuleRepository, output) -> bool:
+  """Lints multiple projects in turn with the same rules, executor and caches.
+
+  Each project has its own section in the output (see BaseOutput.start_project)
+  and the JSON and CSV outputs contain the results of all projects. A project
+  that can't be accessed is reported and skipped.
+
+  Returns:
+    True if any rule failed, any project couldn't be inspected or the run was
+    cancelled.
+  """
+  output.display_projects_header(project_ids)
+  combined_result = lint.LintResults()
+  any_failed = False
+  for project_id in project_ids:
+    # project-specific configuration
+    config.set_project_id(project_id)
+    try:
+      crm.get_project(project_id)
+      apis.verify_access(project_id)
+    except (utils.GcpApiError, exceptions.GoogleAuthError) as e:
+      print(f'[ERROR]:{e}. skipping project {project_id}', file=sys.stderr)
+      any_failed = True
+      continue
+    context = models.Context(
+      project_id=project_id,
+      locations=args.location,
+      resources=args.name,
+      labels=args.label,
+    )
+    result = lint.LintResults()
+    result.add_result_handler(output.start_project(context))
+    _warn_serial_port_logging(context)
+    run_rules_for_context(context, repo, result)
+    output.end_project(result)
+    for rule_report in result.get_rule_reports():
+      combined_result.register_finished_rule_report(rule_report)
+    any_failed = any_failed or result.any_failed
+    if result.cancelled:
+      # the next projects would be skipped too
+      combined_result.cancelled = result.cancelled
+      break
+  output.display_footer(combined_result)
+  hooks.post_lint_hook(combined_result.get_rule_statuses())
+  return any_failed or bool(combined_result.cancelled)
 
 
 def run(argv) -> int:
@@ -398,20 +609,39 @@ def run(argv) -> int:
     parser = init_args_parser()
     args = parser.parse_args()
     hooks.set_lint_args_hook(args)
+    if not (args.project or args.projects_file or args.project_parent):
+      parser.error('one of the arguments --project --projects-file --project-parent is required')
     config.init(vars(args), terminal_output.is_cloud_shell())
-    config.set_project_id(args.project)
+    # the projects of --project-parent are listed with the cache already
+    # configured for replay (--cache-readonly)
+    caching.configure_session(None, readonly=config.get('cache_readonly'))
+    project_ids = _get_project_ids(args)
+    if not project_ids:
+      parser.error('no project to inspect')
+    config.set_project_id(project_ids[0])
+    caching.configure_session(
+      project_ids, record=config.get('cache_record'), readonly=config.get('cache_readonly')
+    )
+    if config.get('cache_stats'):
+      caching.report_stats_at_exit(config.get('cache_stats'))
+    if config.get('profile'):
+      profiling.report_at_exit(config.get('profile'), memory=config.get('profile_memory'))
+    if config.get('trace_file'):
+      tracing.write_at_exit(config.get('trace_file'))
+    executor.set_run_deadline(config.get('run_deadline_seconds'))
 
     # 2. Perform CLI-specific validation checks
-    try:
-      crm.get_project(args.project)
-      apis.verify_access(args.project)
-    except (utils.GcpApiError, exceptions.GoogleAuthError) as e:
-      print(f'[ERROR]:{e}. exiting program', file=sys.stderr)
-      sys.exit(2)
+    if len(project_ids) == 1:
+      try:
+        crm.get_project(project_ids[0])
+        apis.verify_access(project_ids[0])
+      except (utils.GcpApiError, exceptions.GoogleAuthError) as e:
+        print(f'[ERROR]:{e}. exiting program', file=sys.stderr)
+        sys.exit(2)
 
     # 3. Create the linting context
     context = models.Context(
-      project_id=args.project,
+      project_id=project_ids[0],
       locations=args.location,
       resources=args.name,
       labels=args.label,
@@ -451,30 +681,34 @@ def run(argv) -> int:
 
     # 6. Display CLI Banner
     output.display_banner()
-    output.display_header(context)
-
-    # Warn user to fallback on serial logs buffer if project isn't storing in
-    # cloud logging
-    if not gce.is_project_serial_port_logging_enabled(context.project_id) and not config.get(
-      'enable_gce_serial_buffer'
-    ):
-      # Only print the warning if GCE is enabled in the first place
-      if apis.is_enabled(context.project_id, 'compute'):
-        logger.warning(
-          """Serial output to cloud logging maybe disabled for certain GCE instances.
-            Fallback on serial output buffers by using flag --enable-gce-serial-buffer \n"""
-        )
-
-    # 7. Run the rules
-    run_rules_for_context(context, repo)
-
-    # 8. Display CLI Footer and clean up
-    output.display_footer(repo.result)
-    hooks.post_lint_hook(repo.result.get_rule_statuses())
-    kubectl.clean_up()
 
-    # 9. Exit with the correct status code
-    sys.exit(2 if repo.result.any_failed else 0)
+    # Multiple projects are linted in turn in this process, sharing the rules,
+    # the executor (and its API concurrency limits) and the caches.
+    if len(project_ids) > 1:
+      any_failed = _run_projects(args, project_ids, repo, output)
+    else:
+      output.display_header(context)
+      _warn_serial_port_logging(context)
+
+      # 7. Run the rules
+      run_rules_for_context(context, repo)
+
+      # 8. Display CLI Footer
+      output.display_footer(repo.result)
+      hooks.post_lint_hook(repo.result.get_rule_statuses())
+      any_failed = repo.result.any_failed or bool(repo.result.cancelled)
+
+    if incremental.enabled():
+      stats = incremental.get_stats()
+      print(
+        f'Incremental lint: {stats["reused"]} rules reused, {stats["executed"]} rules executed,'
+        f' {fingerprints.get_probe_requests()} API requests to check the inputs of the rules.',
+        file=sys.stderr,
+      )
+
+    # 9. Clean up and exit with the correct status code
+    kubectl.clean_up()
+    sys.exit(2 if any_failed else 0)
 
   except (utils.GcpApiError, exceptions.GoogleAuthError) as e:
     print(f'[ERROR]:{e}. exiting program', file=sys.stderr)
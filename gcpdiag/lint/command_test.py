@@ -13,10 +13,13 @@
 # limitations under the License.
 """Test code in command.py."""
 
+import io
+import json
 import sys
+import tempfile
 from unittest import TestCase, mock
 
-from gcpdiag import lint
+from gcpdiag import config, lint
 from gcpdiag.lint import command
 from gcpdiag.queries import apis, apis_stub
 
@@ -55,6 +58,29 @@ class TestCommand(TestCase):
     command.run([])
     assert True
 
+  @mock.patch.dict(config._defaults, {'show_skipped': True})
+  @mock.patch.object(config, '_args', {})
+  @mock.patch('gcpdiag.queries.apis.verify_access')
+  def test_run_multiple_projects(self, mock_verify_access, mock_email, mock_api):
+    sys.argv = [
+      'gcpdiag lint',
+      '--project',
+      '12340001,gcpdiag-gke1-aaaa',
+      '--include',
+      'dataproc/BP/2021_001',
+      '--output',
+      'json',
+    ]
+    with mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+      command.run([])
+    # a single JSON report with the results of both projects
+    results = json.loads(stdout.getvalue())
+    self.assertEqual(
+      {r['project'] for r in results},
+      {'12340001', 'gcpdiag-gke1-aaaa'},
+    )
+    self.assertEqual({r['rule'] for r in results}, {'dataproc/BP/2021_001'})
+
 
 class Test(TestCase):
   """Unit tests for command."""
@@ -88,6 +114,7 @@ class Test(TestCase):
     assert args.logging_fetch_max_time_seconds is None
     assert args.output == 'terminal'
     assert args.enable_gce_serial_buffer is False
+    assert args.cache_stats is None
 
   def test_provided_init_args_parser(self):
     parser = command.init_args_parser()
@@ -99,6 +126,16 @@ class Test(TestCase):
     assert args.include_extended is True
     args = parser.parse_args(['--project', 'myproject', '--config', '/path/to/file'])
     assert args.config == '/path/to/file'
+    args = parser.parse_args(['--project', 'myproject', '--cache-stats'])
+    assert args.cache_stats == '-'
+    args = parser.parse_args(['--project', 'myproject', '--cache-stats', 'stats.json'])
+    assert args.cache_stats == 'stats.json'
+    args = parser.parse_args(['--project', 'myproject', '--profile'])
+    assert args.profile == '-'
+    args = parser.parse_args(['--project', 'myproject', '--profile', 'profile.json'])
+    assert args.profile == 'profile.json'
+    args = parser.parse_args(['--project', 'myproject', '--incremental'])
+    assert args.incremental is True
 
   def test_output_casing_and_validation(self):
     parser = command.init_args_parser()
@@ -136,6 +173,29 @@ class Test(TestCase):
     # Check if excluded rules are not present
     self.assertFalse(any(r.product == 'iam' for r in repo.rules_to_run))
 
+  def test_create_and_load_repos_imports_included_rules_only(self):
+    repo = command.create_and_load_repos(
+      include=['gce/ERR/2021_001'],
+      exclude=None,
+      load_extended=False,
+    )
+    self.assertEqual([str(r) for r in repo.rules_to_run], ['gce/ERR/2021_001'])
+    self.assertEqual([str(r) for r in repo._loaded_rules], ['gce/ERR/2021_001'])
+
+  def test_get_project_ids(self):
+    parser = command.init_args_parser()
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+      f.write('# projects\np2\n\np3  # comment\n')
+      f.flush()
+      args = parser.parse_args(['--project', 'p1, p2', '--projects-file', f.name])
+      self.assertEqual(command._get_project_ids(args), ['p1', 'p2', 'p3'])
+
+  @mock.patch('gcpdiag.queries.apis.get_api', new=apis_stub.get_api_stub)
+  def test_get_project_ids_parent(self):
+    parser = command.init_args_parser()
+    args = parser.parse_args(['--project-parent', 'folders/1234569776913'])
+    self.assertEqual(command._get_project_ids(args), ['gcpdiag-billing1-aaaa'])
+
   def test_parse_label(self):
     parser = command.init_args_parser()
     # Test with a single value
@@ -0,0 +1,241 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental lint (--incremental): reuse of the results of unchanged rules.
+
+The results of every rule are stored in a local database (lint_results.db in
+the cache directory) with the fingerprints of its inputs (see fingerprints.py).
+In the next executions with an equivalent context, the recorded inputs of the
+rule are probed before its prefetch function, and if none of them changed, the
+previous results are replayed instead of running the rule.
+
+Rules are not reused:
+  - if they have a prepare_rule function (their logs queries depend on the time
+    of the execution), or if --enable-gce-serial-buffer is used.
+  - if their inputs are incomplete, e.g. they send uncached API requests.
+  - if their results were stored on another day: rules comparing dates to the
+    current one (e.g. end of life dates) can change without their inputs
+    changing. Rules comparing timestamps to the current time can still report
+    results that are up to a day old.
+  - if their module, the modules it uses (transitively, in gcpdiag and in the
+    package of the rule), the data files (YAML, JSON) in the directories of
+    these modules, the gcpdiag version or the configuration they depend on
+    changed since their results were stored. Files read from other
+    directories are not covered.
+"""
+
+import datetime
+import hashlib
+import logging
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
+import types
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from gcpdiag import config, fingerprints, models
+
+DB_FILE = 'lint_results.db'
+
+# Configuration values that change the results of the rules.
+RULE_CONFIG_KEYS = ('within_days', 'universe_domain', 'billing_project')
+
+# Files in the directories of the modules of a rule that it might read.
+DATA_FILE_SUFFIXES = ('.json', '.yaml', '.yml')
+
+_lock = threading.Lock()
+_db: Optional['ResultsDB'] = None
+# rule -> digest of its modules, data files and configuration
+_rule_versions: Dict[str, str] = {}
+# path of a module or data file -> digest of its content
+_file_digests: Dict[str, str] = {}
+_stats = {'reused': 0, 'executed': 0}
+
+
+class ResultsDB:
+  """Results of the rules and fingerprints of their inputs, per context."""
+
+  def __init__(self, path: str) -> None:
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+    with self._conn:
+      self._conn.execute(
+        'CREATE TABLE IF NOT EXISTS rule_results (context TEXT, rule TEXT, version TEXT,'
+        ' inputs BLOB, results BLOB, updated REAL, PRIMARY KEY (context, rule))'
+      )
+
+  def get(self, context_key: str, rule: str, version: str) -> Optional[Tuple[bytes, bytes]]:
+    """Returns the serialized inputs and results of `rule`, if stored for
+    `version` of the rule."""
+    with self._lock:
+      row = self._conn.execute(
+        'SELECT inputs, results FROM rule_results WHERE context=? AND rule=? AND version=?',
+        (context_key, rule, version),
+      ).fetchone()
+    return row
+
+  def put(self, context_key: str, rule: str, version: str, inputs: bytes, results: bytes):
+    with self._lock, self._conn:
+      self._conn.execute(
+        'INSERT OR REPLACE INTO rule_results VALUES (?, ?, ?, ?, ?, ?)',
+        (context_key, rule, version, inputs, results, time.time()),
+      )
+
+  def close(self) -> None:
+    with self._lock:
+      self._conn.close()
+
+
+def _get_db() -> ResultsDB:
+  global _db
+  with _lock:
+    if _db is None:
+      path = pathlib.Path(config.get_cache_dir())
+      path.mkdir(mode=0o700, parents=True, exist_ok=True)
+      _db = ResultsDB(str(path / DB_FILE))
+    return _db
+
+
+def _today() -> str:
+  return datetime.date.today().isoformat()
+
+
+def _module_dependencies(module: types.ModuleType) -> List[types.ModuleType]:
+  """Returns `module` and the modules it uses, directly or through the modules
+  it uses, in gcpdiag and in the top-level package of `module`."""
+  packages = {'gcpdiag', module.__name__.split('.')[0]}
+  found: Dict[str, types.ModuleType] = {}
+  pending = [module]
+  while pending:
+    current = pending.pop()
+    if current.__name__ in found:
+      continue
+    found[current.__name__] = current
+    for value in list(vars(current).values()):
+      if isinstance(value, types.ModuleType):
+        name = value.__name__
+      else:
+        name = getattr(value, '__module__', None)
+        if not isinstance(name, str):
+          continue
+      if name.split('.')[0] in packages and name not in found and name in sys.modules:
+        pending.append(sys.modules[name])
+  return [found[name] for name in sorted(found)]
+
+
+def _file_digest(path: pathlib.Path) -> str:
+  with _lock:
+    digest = _file_digests.get(str(path))
+  if digest is None:
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    with _lock:
+      _file_digests[str(path)] = digest
+  return digest
+
+
+def _data_files(directories: Set[pathlib.Path]) -> List[pathlib.Path]:
+  return sorted(
+    path
+    for directory in directories
+    for path in directory.iterdir()
+    if path.suffix in DATA_FILE_SUFFIXES and path.is_file()
+  )
+
+
+def _rule_version(rule) -> str:
+  """Returns a digest of everything the results of `rule` depend on, except
+  its inputs: the current date, its modules and data files, the gcpdiag
+  version and the configuration."""
+  name = str(rule)
+  with _lock:
+    version = _rule_versions.get(name)
+  if version is None:
+    h = hashlib.sha256(config.VERSION.encode())
+    directories = set()
+    for module in _module_dependencies(sys.modules[rule.run_rule_f.__module__]):
+      module_file = getattr(module, '__file__', None)
+      if not module_file:
+        continue
+      path = pathlib.Path(module_file)
+      directories.add(path.parent)
+      h.update(f'{module.__name__}:{_file_digest(path)}'.encode())
+    for path in _data_files(directories):
+      h.update(f'{path}:{_file_digest(path)}'.encode())
+    for key in RULE_CONFIG_KEYS:
+      h.update(repr(config.get(key)).encode())
+    version = h.hexdigest()
+    with _lock:
+      _rule_versions[name] = version
+  return hashlib.sha256(f'{version}:{_today()}'.encode()).hexdigest()
+
+
+def count_rule(reused: bool) -> None:
+  """Counts a rule whose results were reused, or that was executed."""
+  with _lock:
+    _stats['reused' if reused else 'executed'] += 1
+
+
+def get_stats() -> Dict[str, int]:
+  """Returns how many rules were reused and executed in this execution."""
+  with _lock:
+    return dict(_stats)
+
+
+def enabled() -> bool:
+  return bool(config.get('incremental'))
+
+
+class IncrementalLint:
+  """Reuses the results of the rules of a context whose inputs didn't change."""
+
+  def __init__(self, context: models.Context, db: Optional[ResultsDB] = None) -> None:
+    self.context = context
+    self.context_key = hashlib.sha256(context.__cache_key__()).hexdigest()
+    self.db = db or _get_db()
+
+  @staticmethod
+  def is_reusable(rule) -> bool:
+    return (
+      rule.run_rule_f is not None
+      and not rule.prepare_rule_f
+      and not config.get('enable_gce_serial_buffer')
+    )
+
+  def replay(self, rule) -> Optional[List[Any]]:
+    """Returns the previous results of `rule` if its inputs didn't change, or
+    None if it must be executed."""
+    stored = self.db.get(self.context_key, str(rule), _rule_version(rule))
+    if stored:
+      try:
+        inputs = fingerprints.loads(stored[0], self.context)
+        if fingerprints.probe(inputs, self.context):
+          return fingerprints.loads(stored[1], self.context)
+      except Exception as err:  # pylint: disable=broad-except
+        # e.g. results of classes that were modified
+        logging.debug("can't reuse results of %s: %s", rule, err)
+    return None
+
+  def store(self, rule, recorder: fingerprints.InputRecorder, results: List[Any]) -> None:
+    """Stores the results of `rule` and its inputs, if they are complete."""
+    if not recorder.complete:
+      logging.debug('inputs of %s are incomplete, results not stored', rule)
+      return
+    try:
+      inputs = fingerprints.dumps(recorder.inputs)
+      serialized_results = fingerprints.dumps(results)
+    except Exception as err:  # pylint: disable=broad-except
+      logging.debug("can't store results of %s: %s", rule, err)
+      return
+    self.db.put(self.context_key, str(rule), _rule_version(rule), inputs, serialized_results)
@@ -0,0 +1,167 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test code in incremental.py."""
+
+import importlib
+import os
+import pathlib
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from gcpdiag import caching, config, fingerprints, models
+from gcpdiag.lint import LintResults, LintRule, LintRuleClass, SyncExecutionStrategy, incremental
+
+_instances = ['vm1', 'vm2']
+_executions = []
+
+
+@caching.cached_api_call(in_memory=True)
+def _get_instances(context: models.Context):
+  del context
+  return list(_instances)
+
+
+def _run_rule(context, rule_report):
+  _executions.append('run')
+  for name in _get_instances(context):
+    rule_report.add_ok(None, name)
+
+
+def _run_uncached_rule(context, rule_report):
+  del context
+  _executions.append('run_uncached')
+  fingerprints.record_request()
+  rule_report.add_ok(None)
+
+
+def _make_rule(rule_id, run_rule_f):
+  return LintRule(
+    product='fakeprod',
+    rule_class=LintRuleClass.ERR,
+    rule_id=rule_id,
+    short_desc='',
+    long_desc='',
+    keywords=[],
+    run_rule_f=run_rule_f,
+  )
+
+
+@mock.patch.object(caching, '_use_cache', True)
+@mock.patch.dict(config._defaults, {'incremental': True})
+class IncrementalLintTest(unittest.TestCase):
+  """Test the reuse of the results of lint rules."""
+
+  def setUp(self):
+    tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    self.addCleanup(tmp_dir.cleanup)
+    db = incremental.ResultsDB(os.path.join(tmp_dir.name, incremental.DB_FILE))
+    self.addCleanup(db.close)
+    patcher = mock.patch.object(incremental, '_db', db)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.addCleanup(fingerprints._digests.clear)
+    for versions in [incremental._rule_versions, incremental._file_digests]:
+      patcher = mock.patch.dict(versions, clear=True)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    _executions.clear()
+    # the results of _get_instances are cached per test
+    self.context = models.Context(project_id=self.id().rsplit('.', 1)[1].replace('_', '-'))
+    self.rules = [
+      _make_rule('2025_001', _run_rule),
+      _make_rule('2025_002', _run_uncached_rule),
+    ]
+
+  def _lint(self):
+    result = LintResults()
+    stats = incremental.get_stats()
+    SyncExecutionStrategy().run_rules(self.context, result, self.rules)
+    # new executions start with new digests
+    fingerprints._digests.clear()
+    new_stats = incremental.get_stats()
+    return result, {k: new_stats[k] - stats[k] for k in stats}
+
+  def test_reuse(self):
+    first, stats = self._lint()
+    self.assertEqual(stats, {'reused': 0, 'executed': 2})
+    second, stats = self._lint()
+    self.assertEqual(stats, {'reused': 1, 'executed': 1})
+    self.assertEqual(_executions, ['run', 'run_uncached', 'run_uncached'])
+    self.assertEqual(first.get_rule_statuses(), second.get_rule_statuses())
+    report = next(r for r in second.get_rule_reports() if r.rule == self.rules[0])
+    self.assertEqual([r.short_info for r in report.results], ['vm1', 'vm2'])
+
+  def test_changed_inputs(self):
+    self._lint()
+    _instances.append('vm3')
+    self.addCleanup(_instances.pop)
+    # the probes run in other threads than the test
+    with mock.patch.object(caching, '_get_bypass_cache', return_value=True):
+      _, stats = self._lint()
+    self.assertEqual(stats, {'reused': 0, 'executed': 2})
+    self.assertEqual(_executions.count('run'), 2)
+
+  def test_changed_date(self):
+    self._lint()
+    with mock.patch.object(incremental, '_today', return_value='2100-01-01'):
+      _, stats = self._lint()
+    self.assertEqual(stats, {'reused': 0, 'executed': 2})
+
+  def test_changed_helper_files(self):
+    tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    self.addCleanup(tmp_dir.cleanup)
+    package = pathlib.Path(tmp_dir.name) / 'incremental_test_rules'
+    package.mkdir()
+    (package / '__init__.py').write_text('', encoding='utf-8')
+    (package / 'helper.py').write_text('NAME = "vm1"\n', encoding='utf-8')
+    (package / 'rule.py').write_text(
+      textwrap.dedent("""\
+        from incremental_test_rules import helper
+
+        def run_rule(context, rule_report):
+          rule_report.add_ok(None, helper.NAME)
+        """),
+      encoding='utf-8',
+    )
+    sys.path.insert(0, tmp_dir.name)
+    self.addCleanup(sys.path.remove, tmp_dir.name)
+    for name in [
+      'incremental_test_rules',
+      'incremental_test_rules.helper',
+      'incremental_test_rules.rule',
+    ]:
+      self.addCleanup(sys.modules.pop, name, None)
+    rule_module = importlib.import_module('incremental_test_rules.rule')
+    self.rules = [_make_rule('2025_003', rule_module.run_rule)]
+    self._lint()
+    _, stats = self._lint()
+    self.assertEqual(stats, {'reused': 1, 'executed': 0})
+    # the next executions see the modified helper module and data file
+    for path, content in [
+      (package / 'helper.py', '# modified\n'),
+      (package / 'data.yaml', 'a: 1\n'),
+    ]:
+      with path.open('a', encoding='utf-8') as f:
+        f.write(content)
+      incremental._rule_versions.clear()
+      incremental._file_digests.clear()
+      _, stats = self._lint()
+      self.assertEqual(stats, {'reused': 0, 'executed': 1})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -13,11 +13,23 @@
 # limitations under the License.
 """Tests for LintRuleRepository"""
 
+import threading
+import time
 from functools import cached_property
+from unittest import mock
 
 import pytest
 
-from gcpdiag.lint import LintRuleRepository, LintRulesPattern
+from gcpdiag import caching, config, executor, models
+from gcpdiag.lint import (
+  LintResults,
+  LintRule,
+  LintRuleClass,
+  LintRuleRepository,
+  LintRulesPattern,
+  SyncExecutionStrategy,
+)
+from gcpdiag.lint.output.base_output import OutputOrderer
 
 
 class FakePyPkg:
@@ -130,6 +142,165 @@ def test_sync_happy_path():
   assert fake_module2.get_method('run_rule') in executed_run_rule_fs
 
 
+@mock.patch.dict(config._defaults, {'rule_workers': 4})
+def test_sync_parallel_ordered_output():
+  finished = []
+
+  def mk_rule(rule_id, delay):
+    def run_rule(context, rule_report):
+      del context
+      time.sleep(delay)
+      finished.append(rule_id)
+      rule_report.add_ok(None)
+
+    return LintRule(
+      product='fakeprod',
+      rule_class=LintRuleClass.ERR,
+      rule_id=rule_id,
+      short_desc='',
+      long_desc='',
+      keywords=[],
+      run_rule_f=run_rule,
+    )
+
+  rules = [mk_rule('2022_001', 0.2), mk_rule('2022_002', 0.1), mk_rule('2022_003', 0)]
+  reported = []
+  handler = mock.Mock(process_rule_report=lambda r: reported.append(r.rule.rule_id))
+  result = LintResults()
+  result.add_result_handler(OutputOrderer(handler, sorted(str(r) for r in rules)))
+  SyncExecutionStrategy().run_rules(models.Context(project_id='fake-project'), result, rules)
+
+  # the rules ran in parallel, but are reported in order
+  assert finished == ['2022_003', '2022_002', '2022_001']
+  assert reported == ['2022_001', '2022_002', '2022_003']
+
+
+@mock.patch.object(caching, '_use_cache', True)
+def test_sync_prefetch_wait_timeout():
+  started = threading.Event()
+  release = threading.Event()
+
+  @caching.cached_api_call(in_memory=True)
+  def slow_query(arg):
+    started.set()
+    release.wait(10)
+    return arg
+
+  def prefetch_rule(context):
+    del context
+    slow_query('prefetch-timeout')
+
+  def run_rule(context, rule_report):
+    del context
+    rule_report.add_ok(None)
+
+  rule = LintRule(
+    product='fakeprod',
+    rule_class=LintRuleClass.ERR,
+    rule_id='2022_001',
+    short_desc='',
+    long_desc='',
+    keywords=[],
+    run_rule_f=run_rule,
+    prefetch_rule_f=prefetch_rule,
+  )
+  # the prefetch function waits for a call that is already running
+  leader = threading.Thread(target=slow_query, args=('prefetch-timeout',))
+  leader.start()
+  started.wait(10)
+  result = LintResults()
+  try:
+    with mock.patch.object(caching, '_get_wait_timeout', return_value=0.01):
+      lint = threading.Thread(
+        target=SyncExecutionStrategy().run_rules,
+        args=(models.Context(project_id='fake-project'), result, [rule]),
+        daemon=True,
+      )
+      lint.start()
+      lint.join(30)
+      assert not lint.is_alive()
+  finally:
+    release.set()
+    leader.join()
+
+  # the rule is skipped, like when the cache lock couldn't be acquired
+  (report,) = result.get_rule_reports()
+  assert [r.status for r in report.results] == ['skipped']
+  assert 'timed out' in report.results[0].reason
+
+
+def test_sync_run_deadline():
+  executed = []
+
+  def mk_rule(rule_id, run_seconds):
+    def run_rule(context, rule_report):
+      del context
+      executed.append(rule_id)
+      # the deadline of the run passes while the first rule runs
+      executor.set_run_deadline(run_seconds)
+      time.sleep(0.01)
+      rule_report.add_ok(None)
+
+    return LintRule(
+      product='fakeprod',
+      rule_class=LintRuleClass.ERR,
+      rule_id=rule_id,
+      short_desc='',
+      long_desc='',
+      keywords=[],
+      run_rule_f=run_rule,
+    )
+
+  rules = [mk_rule(f'2022_00{i}', 0.001) for i in range(1, 4)]
+  result = LintResults()
+  try:
+    SyncExecutionStrategy().run_rules(models.Context(project_id='fake-project'), result, rules)
+  finally:
+    executor.set_run_deadline(None)
+
+  assert executed == ['2022_001']
+  assert result.cancelled == 'deadline exceeded'
+  assert [[r.reason for r in report.results] for report in result.get_rule_reports()] == [
+    [None],
+    ['Cancelled: deadline exceeded'],
+    ['Not run: deadline exceeded'],
+  ]
+
+
+def test_load_rules_from_manifest():
+  fake_module1 = mk_simple_rule_module()
+
+  def mk_entry(module, rule_id):
+    return {
+      'module': module,
+      'product': 'fakeprod',
+      'class': 'ERR',
+      'id': rule_id,
+      'short_desc': 'hello world, fake module',
+      'long_desc': '',
+      'keywords': [],
+      'tags': [],
+    }
+
+  setup = Setup(
+    modules_by_name={'gcpdiag.lint.fakeprod.err_2022_001_hello': fake_module1},
+    include=[LintRulesPattern('fakeprod/ERR/2022_001')],
+  )
+  # only the module of the included rule is imported (the other isn't known
+  # to the gateway)
+  setup.repo.load_rules_from_manifest(
+    [
+      mk_entry('gcpdiag.lint.fakeprod.err_2022_001_hello', '2022_001'),
+      mk_entry('gcpdiag.lint.fakeprod.err_2022_002_world', '2022_002'),
+    ]
+  )
+  setup.repo.run_rules(context=None)
+
+  assert [r.run_rule_f for r in setup.execution_strategy.executed_rules] == [
+    fake_module1.get_method('run_rule')
+  ]
+
+
 def test_async_happy_path():
   fake_module1 = mk_simple_async_rule_module()
   fake_module2 = mk_simple_async_rule_module()
@@ -436,3 +607,26 @@ def test_exclude_product():
   assert fake_module1.get_method('run_rule') not in executed_run_rule_fs
   assert fake_module2.get_method('run_rule') not in executed_run_rule_fs
   assert fake_module3.get_method('run_rule') in executed_run_rule_fs
+
+
+def test_sync_prefetch_api_service():
+  def mk_rule(product):
+    return LintRule(
+      product=product,
+      rule_class=LintRuleClass.ERR,
+      rule_id='2022_001',
+      short_desc='',
+      long_desc='',
+      keywords=[],
+      run_rule_f=lambda context, rule_report: None,
+      prefetch_rule_f=lambda context: None,
+    )
+
+  rules = [mk_rule('gke'), mk_rule('dataproc')]
+  with mock.patch('gcpdiag.lint.submit_for_service', wraps=executor.submit_for_service) as submit:
+    SyncExecutionStrategy().run_rules(
+      models.Context(project_id='fake-project'), LintResults(), rules
+    )
+
+  # the prefetch functions are limited per API service, not per product
+  assert [c.args[1] for c in submit.call_args_list] == ['container', 'dataproc']
@@ -0,0 +1,108 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Prebuilt manifest of the lint rules.
+
+The manifest (rules_manifest.json) describes every lint rule: product, class,
+id, short and long description, keywords, tags and module. It is used to filter
+the rules with --include/--exclude/--include-tags/--exclude-tags before
+importing anything, so that only the modules of the rules that will run are
+imported at startup.
+
+The manifest is generated at build time and must be regenerated when a rule is
+added or its metadata changes:
+
+  python -m gcpdiag.lint.manifest
+
+If the manifest is missing or doesn't list the rule modules present on disk,
+all the rule modules are imported as before.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import pkgutil
+import sys
+from typing import Any, Dict, List, Optional
+
+from gcpdiag import lint
+
+MANIFEST_PATH = pathlib.Path(__file__).parent / 'rules_manifest.json'
+
+
+def rule_module_names() -> List[str]:
+  """Returns the names of the lint rule modules, without importing them."""
+  names = []
+  for pkg in pkgutil.iter_modules(lint.__path__, lint.__name__ + '.'):  # type: ignore
+    if not pkg.ispkg:
+      continue
+    pkg_path = [os.path.join(p, pkg.name.rsplit('.', 1)[1]) for p in lint.__path__]  # type: ignore
+    for module in pkgutil.iter_modules(pkg_path, pkg.name + '.'):
+      if lint.parse_rule_module_name(module.name):
+        names.append(module.name)
+  return sorted(names)
+
+
+def build_manifest() -> List[Dict[str, Any]]:
+  """Imports all lint rule modules and returns the manifest entries."""
+  repo = lint.LintRuleRepository(load_extended=True)
+  manifest = []
+  for name in rule_module_names():
+    rule = repo.get_rule_by_module_name(name)
+    manifest.append(
+      {
+        'module': name,
+        'product': rule.product,
+        'class': rule.rule_class.value,
+        'id': rule.rule_id,
+        'short_desc': rule.short_desc,
+        'long_desc': rule.long_desc,
+        'keywords': list(rule.keywords),
+        'tags': list(rule.tags),
+      }
+    )
+  return manifest
+
+
+def write_manifest(path: pathlib.Path = MANIFEST_PATH) -> None:
+  manifest = build_manifest()
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, indent=2, ensure_ascii=False)
+    f.write('\n')
+
+
+def load_manifest(path: pathlib.Path = MANIFEST_PATH) -> Optional[List[Dict[str, Any]]]:
+  """Returns the manifest entries, or None if the manifest is missing or stale
+  (i.e. it doesn't list exactly the rule modules present on disk)."""
+  try:
+    with open(path, encoding='utf-8') as f:
+      manifest = json.load(f)
+  except (OSError, ValueError) as err:
+    logging.debug("can't read lint rules manifest %s: %s", path, err)
+    return None
+  if sorted(entry['module'] for entry in manifest) != rule_module_names():
+    logging.debug('lint rules manifest %s is stale, loading all rule modules', path)
+    return None
+  return manifest
+
+
+def main(argv) -> int:
+  path = pathlib.Path(argv[1]) if len(argv) > 1 else MANIFEST_PATH
+  write_manifest(path)
+  print(f'wrote {path}')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
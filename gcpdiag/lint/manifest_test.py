@@ -0,0 +1,52 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test code in manifest.py."""
+
+import json
+import pathlib
+import tempfile
+import unittest
+
+from gcpdiag.lint import manifest
+
+
+class ManifestTest(unittest.TestCase):
+  """Test the prebuilt manifest of the lint rules."""
+
+  def test_manifest_up_to_date(self):
+    self.assertEqual(
+      manifest.load_manifest(),
+      manifest.build_manifest(),
+      'lint rules manifest is outdated, run: python -m gcpdiag.lint.manifest',
+    )
+
+  def test_rule_module_names(self):
+    names = manifest.rule_module_names()
+    self.assertIn('gcpdiag.lint.gce.err_2021_001_mig_scaleup_failed', names)
+    self.assertFalse([n for n in names if n.endswith('_test')])
+
+  def test_load_stale_manifest(self):
+    entries = manifest.load_manifest()
+    with tempfile.TemporaryDirectory() as d:
+      path = pathlib.Path(d) / 'rules_manifest.json'
+      path.write_text(json.dumps(entries[1:]), encoding='utf-8')
+      self.assertIsNone(manifest.load_manifest(path))
+
+  def test_load_missing_manifest(self):
+    with tempfile.TemporaryDirectory() as d:
+      self.assertIsNone(manifest.load_manifest(pathlib.Path(d) / 'missing.json'))
+
+
+if __name__ == '__main__':
+  unittest.main()
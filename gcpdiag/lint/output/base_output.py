@@ -1,13 +1,57 @@
 """Base class for different output implementations"""
 
+import functools
 import logging
 import sys
 import threading
-from typing import Optional, TextIO
+from typing import Any, Dict, List, Optional, TextIO
 
 from gcpdiag import config, lint, models
 
 
+class OutputOrderer:
+  """Helper to maintain sorting order of the rules
+
+  Rule reports are buffered until the reports of all the rules before them in
+  `output_order` have been processed, so that the output doesn't depend on the
+  order in which the rules finish (e.g. with --rule-workers).
+  """
+
+  _result_handler: 'lint.LintResultsHandler'
+  _output_order: List[str]
+  _next_rule_idx: int
+  _rule_reports_ready: Dict[str, 'lint.LintReportRuleInterface']
+
+  def __init__(self, result_handler: 'lint.LintResultsHandler', output_order: List[str]) -> None:
+    self._result_handler = result_handler
+    self._output_order = output_order
+    self._next_rule_idx = 0
+    self._rule_reports_ready = {}
+
+  def process_rule_report(self, rule_report: Any) -> None:
+    rule_id = str(rule_report.rule)
+    self._rule_reports_ready[rule_id] = rule_report
+    self._output_ready()
+
+  def _output_ready(self) -> None:
+    while self._has_more_work and self._is_next_rule_ready:
+      rule_report = self._rule_reports_ready[self._next_rule_id]
+      self._result_handler.process_rule_report(rule_report)
+      self._next_rule_idx += 1
+
+  @property
+  def _has_more_work(self) -> bool:
+    return self._next_rule_idx < len(self._output_order)
+
+  @property
+  def _is_next_rule_ready(self) -> bool:
+    return self._next_rule_id in self._rule_reports_ready
+
+  @property
+  def _next_rule_id(self) -> str:
+    return self._output_order[self._next_rule_idx]
+
+
 class BaseOutput:
   """Base class for different output implementations"""
 
@@ -16,6 +60,9 @@ class BaseOutput:
   show_skipped: bool
   log_info_for_progress_only: bool
   lock: threading.Lock
+  # project of the current section of a multi-project run (see start_project)
+  project_id: Optional[str]
+  _output_order: Optional[List[str]]
 
   def __init__(
     self,
@@ -23,12 +70,23 @@ class BaseOutput:
     log_info_for_progress_only: bool = True,
     show_ok: bool = True,
     show_skipped: bool = False,
+    output_order: Optional[List[str]] = None,
   ) -> None:
     self.file = file or sys.stdout
     self.show_ok = show_ok
     self.show_skipped = show_skipped
     self.log_info_for_progress_only = log_info_for_progress_only
     self.lock = threading.Lock()
+    self._output_order = output_order
+    self.project_id = None
+
+  @functools.cached_property
+  def result_handler(self) -> 'lint.LintResultsHandler':
+    default_handler = self
+    if self._output_order is None:
+      return default_handler
+    else:
+      return OutputOrderer(result_handler=default_handler, output_order=self._output_order)
 
   def display_banner(self) -> None:
     print(f'gcpdiag {config.VERSION}\n', file=sys.stderr)
@@ -40,6 +98,27 @@ class BaseOutput:
     totals = result.get_totals_by_status()
     state_strs = [f'{totals.get(state, 0)} {state}' for state in ['skipped', 'ok', 'failed']]
     print(f'Rules summary: {", ".join(state_strs)}', file=sys.stderr)
+    if result.cancelled:
+      print(f'Run stopped ({result.cancelled}), the remaining rules were skipped.', file=sys.stderr)
+
+  def display_projects_header(self, project_ids: List[str]) -> None:
+    """Called instead of display_header() when linting multiple projects."""
+    print(f'Starting lint inspection of {len(project_ids)} projects...\n', file=sys.stderr)
+
+  def start_project(self, context: models.Context) -> 'lint.LintResultsHandler':
+    """Starts the section of a project when linting multiple projects, and
+    returns the result handler for the rules of this project."""
+    self.project_id = context.project_id
+    print(f'Starting lint inspection ({context})...\n', file=sys.stderr)
+    if self._output_order is None:
+      return self
+    return OutputOrderer(result_handler=self, output_order=self._output_order)
+
+  def end_project(self, result: 'lint.LintResults') -> None:
+    """Ends the section of the current project when linting multiple projects."""
+    totals = result.get_totals_by_status()
+    state_strs = [f'{totals.get(state, 0)} {state}' for state in ['skipped', 'ok', 'failed']]
+    print(f'Rules summary for {self.project_id}: {", ".join(state_strs)}\n', file=sys.stderr)
 
   def get_logging_handler(self) -> logging.Handler:
     return _LoggingHandler(self)
@@ -15,7 +15,7 @@
 
 import csv
 import sys
-from typing import Optional, TextIO
+from typing import List, Optional, TextIO
 
 from gcpdiag import lint, models
 from gcpdiag.lint.output import base_output
@@ -32,14 +32,11 @@ class CSVOutput(base_output.BaseOutput):
     log_info_for_progress_only: bool = True,
     show_ok: bool = True,
     show_skipped: bool = False,
+    output_order: Optional[List[str]] = None,
   ):
-    super().__init__(file, log_info_for_progress_only, show_ok, show_skipped)
+    super().__init__(file, log_info_for_progress_only, show_ok, show_skipped, output_order)
     self.writer = csv.DictWriter(sys.stdout, fieldnames=self.columns)
 
-  @property
-  def result_handler(self) -> 'lint.LintResultsHandler':
-    return self
-
   def process_rule_report(self, rule_report: lint.LintReportRuleInterface) -> None:
     with self.lock:
       self._print_rule_report(rule_report)
@@ -71,20 +68,26 @@ class CSVOutput(base_output.BaseOutput):
       message = '' + short_info
     else:
       message = '-'
-    self.writer.writerow(
-      {
-        'rule': rule_id,
-        'resource': resource.full_path if resource else '-',
-        'status': status,
-        'message': message,
-        'doc_url': rule.doc_url,
-      }
-    )
+    row = {
+      'rule': rule_id,
+      'resource': resource.full_path if resource else '-',
+      'status': status,
+      'message': message,
+      'doc_url': rule.doc_url,
+    }
+    if self.project_id:
+      row['project'] = self.project_id
+    self.writer.writerow(row)
 
   def display_header(self, context):
     super().display_header(context)
     self.writer.writeheader()
 
+  def display_projects_header(self, project_ids):
+    super().display_projects_header(project_ids)
+    self.writer = csv.DictWriter(sys.stdout, fieldnames=['project'] + self.columns)
+    self.writer.writeheader()
+
   def display_footer(self, result) -> None:
     # add extra line
     self.print_line()
@@ -14,7 +14,7 @@
 """Output implementation that prints result in JSON format."""
 
 import json
-from typing import Optional
+from typing import List, Optional
 
 from gcpdiag import lint, models
 from gcpdiag.lint.output import base_output
@@ -30,6 +30,11 @@ class JSONOutput(base_output.BaseOutput):
     # group output as list - start
     self.print_line('[')
 
+  def display_projects_header(self, project_ids: List[str]) -> None:
+    super().display_projects_header(project_ids)
+    # the results of all projects are in a single list
+    self.print_line('[')
+
   def display_footer(self, result: lint.LintResults) -> None:
     # group output as list - end
     self.print_line(']')
@@ -37,10 +42,6 @@ class JSONOutput(base_output.BaseOutput):
     self.print_line()
     return super().display_footer(result)
 
-  @property
-  def result_handler(self) -> 'lint.LintResultsHandler':
-    return self
-
   def process_rule_report(self, rule_report: lint.LintReportRuleInterface) -> None:
     with self.lock:
       self._print_rule_report(rule_report)
@@ -76,15 +77,18 @@ class JSONOutput(base_output.BaseOutput):
       self.print_line(',')
     else:
       self._printed_first_result = True
+    entry = {
+      'rule': rule_id,
+      'resource': resource.full_path if resource else '-',
+      'status': status,
+      'message': message,
+      'doc_url': rule.doc_url,
+    }
+    if self.project_id:
+      entry = {'project': self.project_id, **entry}
     self.print_line(
       json.dumps(
-        {
-          'rule': rule_id,
-          'resource': resource.full_path if resource else '-',
-          'status': status,
-          'message': message,
-          'doc_url': rule.doc_url,
-        },
+        entry,
         ensure_ascii=False,
         indent=2,
       )
@@ -15,12 +15,11 @@
 # Lint as: python3
 """Output implementation that prints result in human-readable format."""
 
-import functools
 import logging
 import os
 import sys
 import textwrap
-from typing import Any, Dict, List, Optional, TextIO
+from typing import List, Optional, TextIO
 
 from rich.console import Console
 from rich.markup import escape
@@ -43,48 +42,9 @@ def emoji_wrap(char):
     return char
 
 
-class OutputOrderer:
-  """Helper to maintain sorting order of the rules"""
-
-  _result_handler: 'lint.LintResultsHandler'
-  _output_order: List[str]
-  _next_rule_idx: int
-  _rule_reports_ready: Dict[str, 'lint.LintReportRuleInterface']
-
-  def __init__(self, result_handler: 'lint.LintResultsHandler', output_order: List[str]) -> None:
-    self._result_handler = result_handler
-    self._output_order = output_order
-    self._next_rule_idx = 0
-    self._rule_reports_ready = {}
-
-  def process_rule_report(self, rule_report: Any) -> None:
-    rule_id = str(rule_report.rule)
-    self._rule_reports_ready[rule_id] = rule_report
-    self._output_ready()
-
-  def _output_ready(self) -> None:
-    while self._has_more_work and self._is_next_rule_ready:
-      rule_report = self._rule_reports_ready[self._next_rule_id]
-      self._result_handler.process_rule_report(rule_report)
-      self._next_rule_idx += 1
-
-  @property
-  def _has_more_work(self) -> bool:
-    return self._next_rule_idx < len(self._output_order)
-
-  @property
-  def _is_next_rule_ready(self) -> bool:
-    return self._next_rule_id in self._rule_reports_ready
-
-  @property
-  def _next_rule_id(self) -> str:
-    return self._output_order[self._next_rule_idx]
-
-
 class TerminalOutput(base_output.BaseOutput):
   """Output implementation that prints result in human-readable format."""
 
-  _output_order: Optional[List[str]]
   line_unfinished: bool
   console: Console
 
@@ -96,20 +56,11 @@ class TerminalOutput(base_output.BaseOutput):
     show_skipped: bool = False,
     output_order: Optional[List[str]] = None,
   ):
-    super().__init__(file, log_info_for_progress_only, show_ok, show_skipped)
-    self._output_order = output_order
+    super().__init__(file, log_info_for_progress_only, show_ok, show_skipped, output_order)
     self.line_unfinished = False
     self.file = file or sys.stdout
     self.console = Console(file=self.file, highlight=False, soft_wrap=True)
 
-  @functools.cached_property
-  def result_handler(self) -> 'lint.LintResultsHandler':
-    default_handler = self
-    if self._output_order is None:
-      return default_handler
-    else:
-      return OutputOrderer(result_handler=default_handler, output_order=self._output_order)
-
   def process_rule_report(self, rule_report: 'lint.LintReportRuleInterface') -> None:
     if not self._should_rule_be_skipped(rule_report):
       with self.lock:
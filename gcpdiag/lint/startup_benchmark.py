@@ -0,0 +1,72 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of the gcpdiag lint startup time.
+
+Usage: python -m gcpdiag.lint.startup_benchmark [RUNS]
+
+Measures in fresh interpreters the time to import gcpdiag lint and to load the
+rules selected by --include, with the rules manifest (manifest.py) and with the
+import of all rule modules. No API is called.
+"""
+
+import statistics
+import subprocess
+import sys
+import textwrap
+
+# Number of interpreters started per measurement.
+RUNS = 5
+
+# --include patterns: a single rule, a product and all rules.
+INCLUDES = ['gce/ERR/2021_001', 'gke', '*']
+
+_SCRIPT = textwrap.dedent("""
+    import sys, time
+    start = time.perf_counter()
+    from gcpdiag.lint import command, manifest
+    if sys.argv[2] == 'all modules':
+      manifest.load_manifest = lambda *args: None
+    repo = command.create_and_load_repos(
+        include=[sys.argv[1]], exclude=None, load_extended=False)
+    rules = list(repo.rules_to_run)
+    loaded = len([m for m in sys.modules if m.startswith('gcpdiag.lint.')])
+    print(time.perf_counter() - start, len(rules), loaded)
+    """)
+
+
+def _measure(include: str, mode: str, runs: int):
+  times = []
+  for _ in range(runs):
+    out = subprocess.run(
+      [sys.executable, '-c', _SCRIPT, include, mode],
+      check=True,
+      capture_output=True,
+      text=True,
+    ).stdout.split()
+    times.append(float(out[0]))
+  return statistics.median(times), int(out[1]), int(out[2])
+
+
+def main(argv):
+  runs = int(argv[1]) if len(argv) > 1 else RUNS
+  print(f'{"--include":<18} {"loading":<12} {"rules":>6} {"modules":>8} {"startup ms":>11}')
+  for include in INCLUDES:
+    for mode in ['manifest', 'all modules']:
+      seconds, rules, modules = _measure(include, mode, runs)
+      print(f'{include:<18} {mode:<12} {rules:>6} {modules:>8} {seconds * 1000:>11.0f}')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
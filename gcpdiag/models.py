@@ -17,6 +17,8 @@
 
 import abc
 import dataclasses
+import functools
+import pickle
 import re
 from types import MappingProxyType
 from typing import Any, Generic, Iterable, List, Mapping, Optional, TypeVar
@@ -74,6 +76,10 @@ class Parameter(dict[T, V], Generic[T, V]):
     return _mapping_str(self)
 
 
+def _pattern_key(pattern: Optional[re.Pattern]):
+  return (pattern.pattern, pattern.flags) if pattern else None
+
+
 @dataclasses.dataclass
 class Context:
   """List of resource groups / scopes that should be analyzed."""
@@ -187,6 +193,22 @@ class Context:
   def __hash__(self):
     return self.__str__().__hash__()
 
+  def __cache_key__(self) -> bytes:
+    """Returns the identity of this context in caching.cached_api_call keys.
+
+    This is much cheaper than pickling the whole context (compiled patterns,
+    context_provider), which isn't part of the identity.
+    """
+    return pickle.dumps(
+      (
+        self.project_id,
+        _pattern_key(self.resources_pattern),
+        _pattern_key(self.locations_pattern),
+        sorted(self.labels.items()) if self.labels else None,
+        sorted(self.parameters.items()),
+      )
+    )
+
   IGNORELOCATION = 'IGNORELOCATION'
   IGNORELABEL = MappingProxyType({'IGNORELABEL': 'IGNORELABEL'})
 
@@ -260,6 +282,16 @@ class Resource(abc.ABC):
     else:
       return False
 
+  def __cache_key__(self) -> bytes:
+    """Returns the identity of this resource in caching.cached_api_call keys:
+    its class and full path, like __eq__."""
+    return self._cache_key
+
+  @functools.cached_property
+  def _cache_key(self) -> bytes:
+    cls = type(self)
+    return f'{cls.__module__}.{cls.__qualname__}:{self.full_path}'.encode()
+
   @property
   def project_id(self) -> str:
     """Project id (not project number)."""
@@ -59,6 +59,45 @@ def test_context_to_string():
   )
 
 
+def test_context_cache_key():
+  """Equivalent contexts have the same cache key, different scopes don't."""
+  c1 = models.Context(project_id='project1', locations=['us-central1'], labels={'X': 'Y'})
+  c2 = models.Context(
+    project_id='project1',
+    locations=['us-central1'],
+    labels={'X': 'Y'},
+    context_provider=object(),
+  )
+  assert c1.__cache_key__() == c2.__cache_key__()
+  keys = {
+    c.__cache_key__()
+    for c in [
+      c1,
+      models.Context(project_id='project2', locations=['us-central1'], labels={'X': 'Y'}),
+      models.Context(project_id='project1', locations=['us-west1'], labels={'X': 'Y'}),
+      models.Context(project_id='project1', locations=['us-central1'], labels={'X': 'Z'}),
+      models.Context(project_id='project1', locations=['us-central1'], resources=['X']),
+      models.Context(project_id='project1', parameters={'name': 'vm1'}),
+    ]
+  }
+  assert len(keys) == 6
+
+
+class _Resource(models.Resource):
+  def __init__(self, project_id, name):
+    super().__init__(project_id)
+    self.name = name
+
+  @property
+  def full_path(self):
+    return f'projects/{self.project_id}/things/{self.name}'
+
+
+def test_resource_cache_key():
+  assert _Resource('p1', 'a').__cache_key__() == _Resource('p1', 'a').__cache_key__()
+  assert _Resource('p1', 'a').__cache_key__() != _Resource('p1', 'b').__cache_key__()
+
+
 def test_match_project_resource():
   """Verify Context matching evaluations"""
 
@@ -0,0 +1,231 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-rule and per-phase profiling of lint executions (--profile).
+
+When profiling is started, the following is recorded for every rule:
+
+  - prepare_s, prefetch_s, run_s: time spent in prepare_rule, prefetch_rule
+    and run_rule.
+  - wait_s: time run_rule was blocked waiting for the prefetch_rule results.
+  - api_calls, api_misses: calls of cached API functions made in the thread of
+    run_rule, and how many of them were not served from the cache.
+  - memory_peak_kb: only if memory tracking is enabled (--profile-memory),
+    peak of the memory allocated while run_rule was running, above the memory
+    allocated when it started. It is measured with tracemalloc for the whole
+    process, so with --rule-workers it includes the allocations of the rules
+    running concurrently. Tracing the allocations slows down Python code
+    several times, so the times recorded with memory tracking are longer than
+    in a normal execution.
+"""
+
+import atexit
+import contextlib
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, Optional
+
+PHASES = ('prepare', 'prefetch', 'wait', 'run')
+
+_lock = threading.Lock()
+# Recorded counters per rule, None when profiling is disabled.
+_profiles: Optional[Dict[str, Dict[str, float]]] = None
+# Whether the memory allocations are traced, and whether by start().
+_memory = False
+_started_tracemalloc = False
+# API call counters of the run_rule executing in the current thread.
+_local = threading.local()
+
+
+def enabled() -> bool:
+  return _profiles is not None
+
+
+def memory_tracked() -> bool:
+  return _memory
+
+
+def start(memory: bool = False):
+  """Starts profiling, and with `memory` the tracing of memory allocations
+  (which slows down the execution, see the module docstring)."""
+  global _profiles, _memory, _started_tracemalloc
+  with _lock:
+    if _profiles is None:
+      _profiles = {}
+    if memory and not _memory:
+      _memory = True
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+
+
+def stop():
+  """Stops profiling and discards the recorded profiles."""
+  global _profiles, _memory, _started_tracemalloc
+  with _lock:
+    _profiles = None
+    _memory = False
+    if _started_tracemalloc:
+      tracemalloc.stop()
+      _started_tracemalloc = False
+
+
+def record(name: str, phase: str, seconds: float, **counters: float):
+  """Adds the time spent by rule `name` in `phase` and other counters to its
+  profile."""
+  with _lock:
+    if _profiles is None:
+      return
+    profile = _profiles.setdefault(name, {})
+    profile[f'{phase}_s'] = profile.get(f'{phase}_s', 0) + seconds
+    for counter, value in counters.items():
+      profile[counter] = profile.get(counter, 0) + value
+
+
+def span(name: str, phase: str):
+  """Context manager recording the execution of its block as `phase` of rule
+  `name`. This is a no-op if profiling isn't started."""
+  if _profiles is None:
+    return contextlib.nullcontext()
+  return _span(name, phase)
+
+
+@contextlib.contextmanager
+def _span(name: str, phase: str):
+  start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    record(name, phase, time.perf_counter() - start_time)
+
+
+def run(name: str):
+  """Context manager recording the execution of run_rule of rule `name`,
+  including its API calls and memory usage."""
+  if _profiles is None:
+    return contextlib.nullcontext()
+  return _run(name)
+
+
+@contextlib.contextmanager
+def _run(name: str):
+  counters = {'api_calls': 0, 'api_misses': 0}
+  previous = getattr(_local, 'counters', None)
+  _local.counters = counters
+  memory = _memory and tracemalloc.is_tracing()
+  memory_start = 0
+  if memory:
+    memory_start = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+  start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    seconds = time.perf_counter() - start_time
+    _local.counters = previous
+    record(name, 'run', seconds, api_calls=counters['api_calls'], api_misses=counters['api_misses'])
+    if memory and tracemalloc.is_tracing():
+      memory_peak = max(tracemalloc.get_traced_memory()[1] - memory_start, 0)
+      with _lock:
+        if _profiles is not None:
+          # the peak of multiple executions (e.g. for multiple projects) is their max
+          profile = _profiles.setdefault(name, {})
+          profile['memory_peak_kb'] = max(profile.get('memory_peak_kb', 0), memory_peak / 1024)
+
+
+def count_api_call(miss: bool = False):
+  """Counts a call of a cached API function (or, with `miss`, its execution)
+  for the run_rule executing in the current thread, if any."""
+  counters = getattr(_local, 'counters', None)
+  if counters is not None:
+    counters['api_misses' if miss else 'api_calls'] += 1
+
+
+def get_profiles() -> Dict[str, Dict[str, float]]:
+  """Returns the profile of every rule, with all counters and their total time
+  (total_s), rounded so that profiles can be compared across executions."""
+  with _lock:
+    profiles = {name: dict(profile) for name, profile in (_profiles or {}).items()}
+  counters = [f'{p}_s' for p in PHASES] + ['api_calls', 'api_misses']
+  if _memory:
+    counters.append('memory_peak_kb')
+  result = {}
+  for name, profile in profiles.items():
+    for counter in counters:
+      profile.setdefault(counter, 0)
+    profile['total_s'] = sum(profile[f'{p}_s'] for p in PHASES)
+    result[name] = {
+      counter: round(value, 3) if isinstance(value, float) else value
+      for counter, value in profile.items()
+    }
+  return result
+
+
+def get_phase_totals(profiles: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+  """Returns the time spent in each phase by all rules."""
+  return {p: round(sum(profile[f'{p}_s'] for profile in profiles.values()), 3) for p in PHASES}
+
+
+def format_profiles(profiles: Dict[str, Dict[str, float]]) -> str:
+  """Format the rule profiles as a table, sorted by total time."""
+  header = (
+    f'{"rule":<28} {"total s":>8} {"prepare":>8} {"prefetch":>8} {"wait":>8} {"run":>8}'
+    f' {"api":>5} {"misses":>6}'
+  )
+  if _memory:
+    header += f' {"peak KB":>9}'
+  lines = [header, '-' * len(header)]
+  for name, p in sorted(profiles.items(), key=lambda item: item[1]['total_s'], reverse=True):
+    line = (
+      f'{name:<28} {p["total_s"]:>8.2f} {p["prepare_s"]:>8.2f} {p["prefetch_s"]:>8.2f}'
+      f' {p["wait_s"]:>8.2f} {p["run_s"]:>8.2f} {p["api_calls"]:>5.0f}'
+      f' {p["api_misses"]:>6.0f}'
+    )
+    if _memory:
+      line += f' {p["memory_peak_kb"]:>9.1f}'
+    lines.append(line)
+  lines.append('')
+  lines.append(
+    'total: ' + ', '.join(f'{p} {s:.2f}s' for p, s in get_phase_totals(profiles).items())
+  )
+  if _memory:
+    lines.append(
+      'note: the memory allocations were traced, which slows down the rules: the times are'
+      ' longer than in an execution without --profile-memory.'
+    )
+  return '\n'.join(lines)
+
+
+def _report(destination: str):
+  profiles = get_profiles()
+  if destination == '-':
+    print(format_profiles(profiles), file=sys.stderr)
+    return
+  with open(destination, 'w', encoding='utf-8') as f:
+    json.dump(
+      {'rules': profiles, 'phases': get_phase_totals(profiles), 'memory_traced': _memory},
+      f,
+      indent=2,
+      sort_keys=True,
+    )
+
+
+def report_at_exit(destination: str, memory: bool = False):
+  """Starts profiling (see start()), and prints the rule profiles at exit as a
+  table on stderr if destination is '-', otherwise writes them as JSON to the
+  file `destination`."""
+  start(memory)
+  atexit.register(_report, destination)
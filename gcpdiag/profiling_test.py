@@ -0,0 +1,118 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test code in profiling.py."""
+
+import json
+import pathlib
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+from gcpdiag import caching, models, profiling
+from gcpdiag.lint import LintResults, LintRule, LintRuleClass, SyncExecutionStrategy
+
+
+@caching.cached_api_call(in_memory=True)
+def _cached_query(arg):
+  return [arg] * 1000
+
+
+@mock.patch.object(caching, '_use_cache', True)
+class ProfilingTest(unittest.TestCase):
+  """Test the profiling of lint rules."""
+
+  def setUp(self):
+    profiling.start()
+    self.addCleanup(profiling.stop)
+
+  def test_disabled(self):
+    profiling.stop()
+    with profiling.span('gce/ERR/2021_001', 'prepare'):
+      pass
+    with profiling.run('gce/ERR/2021_001'):
+      profiling.count_api_call()
+    self.assertFalse(profiling.enabled())
+    self.assertEqual(profiling.get_profiles(), {})
+
+  def test_phases(self):
+    profiling.record('gce/ERR/2021_001', 'wait', 0.5)
+    profiling.record('gce/ERR/2021_001', 'wait', 0.25)
+    with profiling.span('gce/ERR/2021_001', 'prefetch'):
+      pass
+    profile = profiling.get_profiles()['gce/ERR/2021_001']
+    self.assertEqual(profile['wait_s'], 0.75)
+    self.assertEqual(profile['prepare_s'], 0)
+    self.assertGreaterEqual(profile['total_s'], 0.75)
+
+  def test_rule_execution(self):
+    def prefetch_rule(context):
+      del context
+      _cached_query('prefetched')
+
+    def run_rule(context, rule_report):
+      del context
+      _cached_query('prefetched')
+      _cached_query('new')
+      rule_report.add_ok(None)
+
+    rule = LintRule(
+      product='fakeprod',
+      rule_class=LintRuleClass.ERR,
+      rule_id='2022_001',
+      short_desc='',
+      long_desc='',
+      keywords=[],
+      run_rule_f=run_rule,
+      prefetch_rule_f=prefetch_rule,
+    )
+    profiling.start(memory=True)
+    SyncExecutionStrategy().run_rules(
+      models.Context(project_id='fake-project'), LintResults(), [rule]
+    )
+    profile = profiling.get_profiles()['fakeprod/ERR/2022_001']
+    # only the calls in run_rule are counted
+    self.assertEqual((profile['api_calls'], profile['api_misses']), (2, 1))
+    self.assertGreater(profile['memory_peak_kb'], 0)
+    self.assertIn('peak KB', profiling.format_profiles(profiling.get_profiles()))
+    self.assertAlmostEqual(
+      profile['total_s'], sum(profile[f'{p}_s'] for p in profiling.PHASES), delta=0.01
+    )
+
+  def test_memory_not_tracked_by_default(self):
+    with profiling.run('gce/ERR/2021_001'):
+      self.assertFalse(tracemalloc.is_tracing())
+    self.assertNotIn('memory_peak_kb', profiling.get_profiles()['gce/ERR/2021_001'])
+    self.assertNotIn('peak KB', profiling.format_profiles(profiling.get_profiles()))
+    profiling.start(memory=True)
+    self.assertTrue(tracemalloc.is_tracing())
+    self.assertIn('slows down', profiling.format_profiles(profiling.get_profiles()))
+    profiling.stop()
+    self.assertFalse(tracemalloc.is_tracing())
+
+  def test_report(self):
+    profiling.record('gce/ERR/2021_001', 'run', 2)
+    profiling.record('gke/BP/2021_001', 'run', 1)
+    table = profiling.format_profiles(profiling.get_profiles())
+    self.assertLess(table.index('gce/ERR/2021_001'), table.index('gke/BP/2021_001'))
+    with tempfile.TemporaryDirectory() as d:
+      path = pathlib.Path(d) / 'profile.json'
+      profiling._report(str(path))
+      report = json.loads(path.read_text(encoding='utf-8'))
+    self.assertEqual(report['phases']['run'], 3)
+    self.assertEqual(report['rules']['gke/BP/2021_001']['run_s'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
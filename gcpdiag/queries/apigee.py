@@ -15,7 +15,6 @@
 # Lint as: python3
 """Queries related to Apigee."""
 
-import functools
 import re
 from typing import Dict, Iterable, List, Mapping, Optional
 
@@ -268,7 +267,7 @@ def get_instances_attachments(instance_name: str) -> List[str]:
   return environments
 
 
-@functools.lru_cache()
+@caching.cached_api_call(in_memory=True)
 def get_network_bridge_instance_groups(project_id: str) -> List[gce.ManagedInstanceGroup]:
   """Get a list of managed instance groups used by Apigee for routing purposes."""
   migs: List[gce.ManagedInstanceGroup] = []
@@ -18,6 +18,7 @@
 import json
 import logging
 import os
+import urllib.parse
 from typing import Dict, Optional, Set
 
 import google.auth
@@ -29,7 +30,7 @@ from google.auth import exceptions
 from google.oauth2 import credentials as oauth2_credentials
 from googleapiclient import discovery
 
-from gcpdiag import caching, config, hooks, utils
+from gcpdiag import caching, config, fingerprints, hooks, tracing, utils
 
 _credentials = None
 
@@ -125,6 +126,19 @@ def get_user_email() -> str:
   return data['email']
 
 
+def _trace_requests(http):
+  """Records the HTTP requests sent with `http` as trace spans."""
+  send = http.request
+
+  def request(uri, *args, **kwargs):
+    method = kwargs.get('method', args[0] if args else 'GET')
+    with tracing.span(f'{method} {urllib.parse.urlsplit(uri).path}', 'http', uri=uri):
+      return send(uri, *args, **kwargs)
+
+  http.request = request
+  return http
+
+
 @caching.cached_api_call(in_memory=True)
 def get_api(
   service_name: str, version: str, project_id: Optional[str] = None, region: Optional[str] = None
@@ -148,10 +162,13 @@ def get_api(
         headers['x-goog-user-project'] = _get_project_or_billing_id(project_id)
 
     hooks.request_builder_hook(*args, **kwargs)
+    fingerprints.record_request()
 
     # thread safety: create a new AuthorizedHttp object for every request
     # https://github.com/googleapis/google-api-python-client/blob/master/docs/thread_safety.md
     new_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    if tracing.enabled():
+      _trace_requests(new_http)
     return googleapiclient.http.HttpRequest(new_http, *args, **kwargs)
 
   universe_domain = config.get('universe_domain')
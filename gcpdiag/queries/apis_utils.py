@@ -17,7 +17,8 @@ import concurrent.futures
 import logging
 import random
 import time
-from typing import Any, Callable, Iterator, List, Optional, Tuple
+import urllib.parse
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
 
 import apiclient
 import googleapiclient.errors
@@ -42,13 +43,17 @@ def execute_concurrently(
     exec_ = executor.get_executor(context)
     future_to_request = {exec_.submit(execute_single_request, req): req for req in requests}
 
-    for future in concurrent.futures.as_completed(future_to_request):
-      request = future_to_request[future]
-      try:
-        response, exception = future.result()
-        yield (request, response, exception)
-      except googleapiclient.errors.HttpError as e:
-        yield (request, None, e)
+    try:
+      for future in concurrent.futures.as_completed(future_to_request):
+        request = future_to_request[future]
+        try:
+          response, exception = future.result()
+          yield (request, response, exception)
+        except googleapiclient.errors.HttpError as e:
+          yield (request, None, e)
+    finally:
+      # The remaining requests aren't needed if the caller stopped iterating.
+      exec_.shutdown(wait=False, cancel_futures=True)
   else:
     # CLI context: Use original batch_execute_all
     yield from batch_execute_all(api, requests)
@@ -114,6 +119,7 @@ def list_all(request, next_function: Callable, response_keyword='items') -> Iter
   the results are under a `items` key."""
 
   while True:
+    executor.check_cancelled()
     try:
       response = request.execute(num_retries=config.API_RETRIES)
     except googleapiclient.errors.HttpError as err:
@@ -199,21 +205,46 @@ def should_retry(resp_status):
   return False
 
 
+def is_throttled(resp_status) -> bool:
+  """Whether the status means that the service is overloaded or rate limiting."""
+  return resp_status in (429, 503)
+
+
+def api_service(request: Any) -> str:
+  """Returns the API service called by `request` (e.g. 'compute'), used to
+  adapt the concurrency of the requests per service (see executor.AdaptiveLimit)."""
+  uri = urllib.parse.urlsplit(getattr(request, 'uri', '') or '')
+  host = uri.hostname or ''
+  if host.endswith('.googleapis.com') and host != 'www.googleapis.com':
+    return host.split('.')[0]
+  return uri.path.strip('/').split('/')[0] or host
+
+
 def get_nth_exponential_random_retry(n, random_pct, multiplier, random_fn=None):
   random_fn = random_fn or random.random
   return (1 - random_fn() * random_pct) * multiplier**n
 
 
-def batch_execute_all(api, requests: list):
+def batch_execute_all(api, requests: Iterable[Any]):
   """Execute all `requests` using the batch API and yield (request,response,exception)
-  tuples."""
+  tuples.
+
+  The outcome of every batch (whether some of its requests were throttled) is
+  recorded in the adaptive concurrency limit of the service (see
+  executor.AdaptiveLimit), which limits the concurrent tasks and single
+  requests of the service."""
   # results: (request, result, exception) tuples
   results: List[Tuple[Any, Optional[Any], Optional[Exception]]] = []
-  requests_todo = requests
+  requests_todo = list(requests)
+  if not requests_todo:
+    return
   requests_in_flight: List = []
   retry_count = 0
+  throttled = False
+  limit = executor.get_adaptive_limit(api_service(requests_todo[0]))
 
   def fetch_all_cb(request_id, response, exception):
+    nonlocal throttled
     try:
       request = requests_in_flight[int(request_id)]
     except (IndexError, ValueError, TypeError):
@@ -223,6 +254,8 @@ def batch_execute_all(api, requests: list):
       return
 
     if exception:
+      if isinstance(exception, googleapiclient.errors.HttpError):
+        throttled = throttled or is_throttled(exception.status_code)
       if (
         isinstance(exception, googleapiclient.errors.HttpError)
         and should_retry(exception.status_code)
@@ -242,9 +275,11 @@ def batch_execute_all(api, requests: list):
     results.append((request, response, None))
 
   while True:
+    executor.check_cancelled()
     requests_in_flight = requests_todo
     requests_todo = []
     results = []
+    throttled = False
 
     # Do the batch API request
     try:
@@ -255,6 +290,7 @@ def batch_execute_all(api, requests: list):
     except (googleapiclient.errors.HttpError, httplib2.HttpLib2Error) as err:
       if isinstance(err, googleapiclient.errors.HttpError):
         error_msg = f'received HTTP error status code {err.status_code} from Batch API, retrying'
+        throttled = is_throttled(err.status_code)
       else:
         error_msg = f'received exception from Batch API: {err}, retrying'
       if (
@@ -264,7 +300,9 @@ def batch_execute_all(api, requests: list):
         requests_todo = requests_in_flight
         results = []
       else:
+        limit.record(count=len(requests_in_flight), throttled=throttled)
         raise utils.GcpApiError(err) from err
+    limit.record(count=len(requests_in_flight), throttled=throttled)
 
     # Yield results
     yield from results
@@ -274,20 +312,47 @@ def batch_execute_all(api, requests: list):
       break
 
     # for example: retry delay: 20% is random, progression: 1, 1.4, 2.0, 2.7, ... 28.9 (10 retries)
-    sleep_time = get_nth_exponential_random_retry(
-      n=retry_count,
-      random_pct=config.API_RETRY_SLEEP_RANDOMNESS_PCT,
-      multiplier=config.API_RETRY_SLEEP_MULTIPLIER,
-    )
-    logging.debug('sleeping %.2f seconds before retry #%d', sleep_time, retry_count + 1)
-    time.sleep(sleep_time)
+    _sleep_before_retry(retry_count)
     retry_count += 1
 
 
+def _sleep_before_retry(retry_count: int):
+  sleep_time = get_nth_exponential_random_retry(
+    n=retry_count,
+    random_pct=config.API_RETRY_SLEEP_RANDOMNESS_PCT,
+    multiplier=config.API_RETRY_SLEEP_MULTIPLIER,
+  )
+  logging.debug('sleeping %.2f seconds before retry #%d', sleep_time, retry_count + 1)
+  time.sleep(sleep_time)
+
+
 def execute_single_request(request: Any) -> Tuple[Optional[Any], Optional[Exception]]:
-  """Executes a single API request and returns the response and exception."""
-  try:
-    response = request.execute(num_retries=config.API_RETRIES)
-    return response, None
-  except googleapiclient.errors.HttpError as e:
-    return None, e
+  """Executes a single API request and returns the response and exception.
+
+  Every attempt waits for a slot within the adaptive concurrency limit of its
+  service (see executor.AdaptiveLimit), and its outcome is recorded there. The
+  request is therefore retried here rather than by the API client, so that
+  the limit is reduced as soon as the service throttles it."""
+  limit = executor.get_adaptive_limit(api_service(request))
+  retry_count = 0
+  while True:
+    executor.check_cancelled()
+    with limit.slot():
+      start = time.perf_counter()
+      try:
+        response = request.execute(num_retries=0)
+      except googleapiclient.errors.HttpError as e:
+        limit.record(throttled=is_throttled(e.status_code))
+        if not should_retry(e.status_code) or retry_count >= config.API_RETRIES:
+          return None, e
+        logging.debug('received HTTP error status code %d from API, retrying', e.status_code)
+      except (httplib2.HttpLib2Error, OSError) as err:
+        # transport errors, retried by the API client with num_retries
+        if retry_count >= config.API_RETRIES:
+          raise
+        logging.debug('received exception from API: %s, retrying', err)
+      else:
+        limit.record(latency=time.perf_counter() - start)
+        return response, None
+    _sleep_before_retry(retry_count)
+    retry_count += 1
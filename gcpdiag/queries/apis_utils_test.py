@@ -20,7 +20,7 @@ from unittest import mock
 import googleapiclient.errors
 import httplib2
 
-from gcpdiag import config, models, utils
+from gcpdiag import config, executor, models, utils
 from gcpdiag.queries import apis_stub, apis_utils
 
 
@@ -68,6 +68,14 @@ class Test(unittest.TestCase):
     results = list(apis_utils.list_all(RequestMock(1), next_function_mock))
     assert results == ['a', 'b', 'c', 'd']
 
+  def test_list_all_cancelled(self):
+    with executor.cancellation_scope() as token:
+      results = apis_utils.list_all(RequestMock(1), next_function_mock)
+      self.assertEqual(next(results), 'a')
+      token.cancel()
+      with self.assertRaises(executor.TaskCancelledError):
+        list(results)
+
   def test_multi_list_all(self):
     results = list(
       apis_utils.multi_list_all(
@@ -147,6 +155,72 @@ class Test(unittest.TestCase):
     # responses
     assert [x[1] for x in results] == [{'items': ['a', 'b']}, {'items': ['e']}]
 
+  @mock.patch('gcpdiag.executor._adaptive_limits', {})
+  def test_batch_execute_all_adaptive_limit(self):
+    api = apis_stub.get_api_stub('compute', 'v1')
+    limit = executor.get_adaptive_limit('compute')
+    limit._limit = 1.0
+    batches = []
+
+    def new_batch_http_request(callback=None):
+      batches.append(apis_stub.BatchRequestStub(callback))
+      return batches[-1]
+
+    with mock.patch.object(api, 'new_batch_http_request', new=new_batch_http_request):
+      requests = (RequestMock(n, uri='https://compute.googleapis.com/') for n in (1, 2, 3))
+      results = list(apis_utils.batch_execute_all(api, requests))
+    # the requests are sent in a single batch, whose success raises the limit
+    self.assertEqual([len(b.queue) for b in batches], [3])
+    self.assertEqual(limit.limit, 3)
+    self.assertEqual([x[0].n for x in results], [1, 2, 3])
+
+  def test_batch_execute_all_no_requests(self):
+    api = apis_stub.get_api_stub('compute', 'v1')
+    self.assertEqual(list(apis_utils.batch_execute_all(api, [])), [])
+    self.assertEqual(list(apis_utils.batch_execute_all(api, iter([]))), [])
+
+  @mock.patch('gcpdiag.executor._adaptive_limits', {})
+  def test_batch_execute_all_throttled(self):
+    api = apis_stub.get_api_stub('compute', 'v1')
+    requests = [
+      RequestMock(1, fail_count=1, fail_status=503, uri='https://compute.googleapis.com/')
+    ]
+    list(apis_utils.batch_execute_all(api, requests))
+    self.assertEqual(
+      executor.get_concurrency_limits(), {'compute': config.API_CONCURRENCY_INITIAL // 2}
+    )
+
+  @mock.patch('gcpdiag.executor._adaptive_limits', {})
+  def test_execute_single_request_throttled(self):
+    global mock_sleep_slept_time
+    mock_sleep_slept_time = []
+    request = RequestMock(1, fail_count=1, fail_status=429, uri='https://logging.googleapis.com/')
+    with mock.patch.object(request, 'execute', wraps=request.execute) as execute:
+      self.assertEqual(apis_utils.execute_single_request(request), ({'items': ['a', 'b']}, None))
+    # the request is retried here, and the throttled attempt reduced the limit
+    self.assertEqual(execute.call_args_list, [mock.call(num_retries=0)] * 2)
+    self.assertEqual(len(mock_sleep_slept_time), 1)
+    self.assertEqual(
+      executor.get_concurrency_limits(), {'logging': config.API_CONCURRENCY_INITIAL // 2}
+    )
+
+  @mock.patch('gcpdiag.executor._adaptive_limits', {})
+  def test_execute_single_request_errors(self):
+    request = RequestMock(1, fail_count=1, fail_status=403)
+    _, err = apis_utils.execute_single_request(request)
+    self.assertEqual(err.status_code, 403)
+    request = RequestMock(1, fail_count=config.API_RETRIES + 1, fail_status=503)
+    _, err = apis_utils.execute_single_request(request)
+    self.assertEqual(err.status_code, 503)
+
+  def test_api_service(self):
+    for uri, service in [
+      ('https://compute.googleapis.com/compute/v1/projects/p/zones', 'compute'),
+      ('https://www.googleapis.com/storage/v1/b?project=p', 'storage'),
+      ('', ''),
+    ]:
+      self.assertEqual(apis_utils.api_service(mock.Mock(uri=uri)), service)
+
   @mock.patch('gcpdiag.queries.apis_utils.execute_single_request')
   @mock.patch('gcpdiag.executor.get_executor')
   def test_execute_concurrently_api_server(self, mock_get_executor, mock_execute_single_request):
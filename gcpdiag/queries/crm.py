@@ -75,7 +75,7 @@ class Project(models.Resource):
     return self._resource_data['parent']
 
 
-@caching.cached_api_call
+@caching.cached_api_call(tiered=True)
 def get_project(project_id: str) -> Project:
   """Attempts to retrieve project details for the supplied project id or number.
   If the project is found/accessible, it returns a Project object with the resource data.
@@ -171,6 +171,26 @@ def get_all_projects_in_parent(project_id: str) -> List[ProjectBillingInfo]:
   return projects
 
 
+@caching.cached_api_call
+def get_projects_in_parent(parent: str) -> List[str]:
+  """Returns the ids of the active projects directly in a folder or organization.
+
+  Args:
+    parent: 'folders/ID' or 'organizations/ID'.
+  """
+  if not re.match(r'(folders|organizations)/\d+$', parent):
+    raise ValueError(f'parent must be folders/ID or organizations/ID, got: {parent}')
+  api = apis.get_api('cloudresourcemanager', 'v3')
+  return [
+    p['projectId']
+    for p in apis_utils.list_all(
+      request=api.projects().search(query=f'parent:{parent} state:ACTIVE'),
+      next_function=api.projects().search_next,
+      response_keyword='projects',
+    )
+  ]
+
+
 class Organization(models.Resource):
   """Represents an Organization resource.
 
@@ -16,6 +16,8 @@
 import tempfile
 from unittest import mock
 
+import pytest
+
 from gcpdiag import caching
 from gcpdiag.queries import apis_stub, crm
 
@@ -47,6 +49,11 @@ class Test:
     assert p.name == DUMMY_PROJECT_NAME
     assert p.parent == DUMMY_PROJECT_PARENT
 
+  def test_get_projects_in_parent(self):
+    assert crm.get_projects_in_parent('folders/1234569776913') == ['gcpdiag-billing1-aaaa']
+    with pytest.raises(ValueError):
+      crm.get_projects_in_parent('projects/gcpdiag-billing1-aaaa')
+
   # getIamPolicy is tested in iam_test.py
   # getEffectiveOrgPolicy is tested in orgpolicy_test.py
   # listOrgPolicies is tested in orgpolicy_test.py
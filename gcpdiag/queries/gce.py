@@ -1149,7 +1149,7 @@ def get_region_managed_instance_groups(
   return migs
 
 
-@caching.cached_api_call
+@caching.cached_api_call(tiered=True)
 def get_instance_templates(project_id: str) -> Mapping[str, InstanceTemplate]:
   logging.info('fetching instance templates')
   templates = {}
@@ -1540,7 +1540,9 @@ def execute_fetch_serial_port_outputs(
   jobs_todo = {}
   # query_executor = get_executor(context)
   for job in jobs_executing.values():
-    job.future = query_executor.submit(get_instances_serial_port_output, job.context)
+    job.future = executor.submit_for_service(
+      query_executor, 'compute', get_instances_serial_port_output, job.context
+    )
 
 
 def fetch_serial_port_outputs(context: models.Context) -> SerialOutputQuery:
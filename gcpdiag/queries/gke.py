@@ -16,7 +16,6 @@
 """Queries related to GCP Kubernetes Engine clusters."""
 
 import datetime
-import functools
 import ipaddress
 import logging
 import re
@@ -544,7 +543,7 @@ class Cluster(models.Resource):
     return dns_cache_config.get('enabled', False)
 
 
-@caching.cached_api_call
+@caching.cached_api_call(tiered=True)
 def get_clusters(context: models.Context) -> Mapping[str, Cluster]:
   """Get a list of Cluster matching the given context, indexed by cluster full path."""
   clusters: Dict[str, Cluster] = {}
@@ -680,10 +679,10 @@ class Node(models.Resource):
     return self.instance.short_path
 
 
-# Note: we don't use caching.cached_api_call here to avoid the locking
-# overhead. which is not required because all API calls are wrapper already
-# around caching.cached_api_call.
-@functools.lru_cache()
+# Note: this isn't a functools.lru_cache, which would hide the API calls done
+# by the first call from the incremental lint of the other rules (see
+# fingerprints.py).
+@caching.cached_api_call(in_memory=True)
 def get_node_by_instance_id(context: models.Context, instance_id: str) -> Node:
   """Get a gke.Node instance by instance id.
 
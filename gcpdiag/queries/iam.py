@@ -17,7 +17,6 @@
 
 import abc
 import collections
-import functools
 import logging
 import re
 from typing import Any, Dict, List, Optional, Tuple, Type
@@ -88,13 +87,19 @@ def _fetch_iam_roles(parent: str, api_project_id: str) -> Dict[str, Role]:
 # gcpdiag execution are very quick, but also results are cached on disk
 # for the next execution. Only caching on disk causes slowness because this method
 # is called multiple times.
-@functools.lru_cache()
-@caching.cached_api_call(expire=config.STATIC_DOCUMENTS_EXPIRY_SECONDS)
+@caching.cached_api_call(
+  expire=config.STATIC_DOCUMENTS_EXPIRY_SECONDS,
+  tiered=True,
+  stale_while_revalidate=config.STATIC_DOCUMENTS_MAX_STALENESS_SECONDS,
+)
 def _get_predefined_roles(api_project_id: str) -> Dict[str, Role]:
   return _fetch_iam_roles('', api_project_id)
 
 
-@caching.cached_api_call(expire=config.STATIC_DOCUMENTS_EXPIRY_SECONDS)
+@caching.cached_api_call(
+  expire=config.STATIC_DOCUMENTS_EXPIRY_SECONDS,
+  stale_while_revalidate=config.STATIC_DOCUMENTS_MAX_STALENESS_SECONDS,
+)
 def _get_predefined_role(name: str, api_project_id: str) -> Role:
   """Returns a predefined role using roles.get
 
@@ -126,7 +131,9 @@ def _get_project_roles(project_name: str, api_project_id: str) -> Dict[str, Role
   return _fetch_iam_roles(project_name, api_project_id)
 
 
-@functools.lru_cache()
+# Not functools.lru_cache: the calls must be recorded as inputs of every rule
+# using the role (see fingerprints.py).
+@caching.cached_api_call(in_memory=True)
 def _get_iam_role(name: str, default_project_id: str) -> Role:
   m = re.match(r'(.*)(^|/)roles/.*$', name)
   if not m:
@@ -23,7 +23,7 @@ import threading
 
 import yaml
 
-from gcpdiag import config
+from gcpdiag import config, fingerprints
 from gcpdiag.queries import gke
 
 
@@ -107,6 +107,8 @@ class KubectlExecutor:
     Will take a list of strings which contains all the command and parameters to be executed
     and return the stdout and stderr of the execution.
     """
+    # the results of kubectl can't be fingerprinted for incremental lint
+    fingerprints.record_request()
     res = subprocess.run(command_list, check=False, capture_output=True, text=True)
     return res.stdout, res.stderr
 
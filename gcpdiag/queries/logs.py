@@ -37,6 +37,7 @@ the standard python library for logging.
 """
 
 import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
 import logging
@@ -47,7 +48,7 @@ import dateutil.parser
 import ratelimit
 from googleapiclient import errors
 
-from gcpdiag import caching, config, executor, models, utils
+from gcpdiag import caching, config, executor, models, tracing, utils
 from gcpdiag.queries import apis
 from gcpdiag.utils import get_path
 
@@ -85,6 +86,21 @@ class LogsQuery:
 
 
 jobs_todo: Dict[Tuple[str, str, str], _LogsQueryJob] = {}
+# Queries created within record_queries().
+_recorded_queries: Optional[List[LogsQuery]] = None
+
+
+@contextlib.contextmanager
+def record_queries():
+  """Yields the list of the queries created with query() within the context
+  (e.g. by the prepare_rule function of a lint rule), so that their execution
+  can be promoted when their results are needed (see executor.promote())."""
+  global _recorded_queries
+  previous, _recorded_queries = _recorded_queries, []
+  try:
+    yield _recorded_queries
+  finally:
+    _recorded_queries = previous
 
 
 class LogEntryShort:
@@ -158,7 +174,10 @@ def query(project_id: str, resource_type: str, log_name: str, filter_str: str) -
     ),
   )
   job.filters.add(filter_str)
-  return LogsQuery(job=job)
+  logs_query = LogsQuery(job=job)
+  if _recorded_queries is not None:
+    _recorded_queries.append(logs_query)
+  return logs_query
 
 
 @ratelimit.sleep_and_retry
@@ -214,12 +233,13 @@ def _execute_query_job(job: _LogsQueryJob, context: models.Context):
   query_pages = 0
   query_start_time = datetime.datetime.now()
   while req is not None:
+    executor.check_cancelled()
     query_pages += 1
-    res = _ratelimited_execute(req)
+    with tracing.span(f'{job.log_name} page {query_pages}', 'logs', project=job.project_id):
+      res = _ratelimited_execute(req)
     if 'entries' in res:
-      for e in res['entries']:
-        fetched_entries_count += 1
-        deque.appendleft(e)
+      fetched_entries_count += len(res['entries'])
+      deque.extendleft(res['entries'])
 
     # Verify that we aren't above limits, exit otherwise.
     if fetched_entries_count > config.get('logging_fetch_max_entries'):
@@ -336,7 +356,9 @@ def execute_queries(query_executor: executor.ContextAwareExecutor, context: mode
   jobs_executing = jobs_todo
   jobs_todo = {}
   for job in jobs_executing.values():
-    job.future = query_executor.submit(_execute_query_job, job, context)
+    job.future = executor.submit_for_service(
+      query_executor, 'logging', _execute_query_job, job, context
+    )
 
 
 def log_entry_timestamp(log_entry: Mapping[str, Any]) -> datetime.datetime:
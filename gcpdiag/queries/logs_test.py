@@ -79,6 +79,22 @@ class TestLogs:
     assert logs_stub.logging_body['pageSize'] == 500
     assert logs_stub.logging_body['resourceNames'] == ['projects/gcpdiag-gke1-aaaa']
 
+  def test_record_queries(self):
+    with logs.record_queries() as queries:
+      query = logs.query(
+        project_id=DUMMY_PROJECT_ID,
+        resource_type='gce_instance',
+        log_name='fake.log',
+        filter_str='filter1',
+      )
+    logs.query(
+      project_id=DUMMY_PROJECT_ID,
+      resource_type='gce_instance',
+      log_name='fake.log',
+      filter_str='filter2',
+    )
+    assert queries == [query]
+
   def test_format_log_entry(self):
     with mock.patch.dict('os.environ', {'TZ': 'America/Los_Angeles'}):
       time.tzset()
@@ -36,7 +36,7 @@ from typing import Callable, Deque, Dict, List, Mapping, Optional, Set, Tuple, T
 import googleapiclient.errors
 from jinja2 import TemplateNotFound
 
-from gcpdiag import caching, config, models, utils
+from gcpdiag import caching, config, executor, models, tracing, utils
 from gcpdiag import context as gcpdiag_context
 from gcpdiag.queries import crm
 from gcpdiag.runbook import constants, exceptions, flags, op, report, util
@@ -813,11 +813,14 @@ class DiagnosticEngine:
         self.process_parameters(runbook=tree, caller_args=parameter)
         tree.hook_build_tree(operator)
       self.finalize = False
-      self.find_path_dfs(
-        step=tree.start,
-        operator=operator,
-        executed_steps=set(),
-      )
+      # Tasks started by the steps are cancelled when the investigation is
+      # finalized (or interrupted), their results can't be used anymore.
+      with executor.cancellation_scope():
+        self.find_path_dfs(
+          step=tree.start,
+          operator=operator,
+          executed_steps=set(),
+        )
 
     except (RuntimeError, exceptions.InvalidDiagnosticTreeError) as err:
       logging.warning('%s: %s while processing runbook rule: %s', type(err).__name__, err, tree)
@@ -975,7 +978,8 @@ class DiagnosticEngine:
         step=step
       )
     self.interface.rm.reports[operator.run_id].results[step.execution_id].start_time = start
-    step.execute_hook(operator)
+    with tracing.span(step.id, 'step', execution_id=step.execution_id):
+      step.execute_hook(operator)
     end = datetime.now(timezone.utc).isoformat()
     with report_lock:
       self.interface.rm.reports[operator.run_id].results[step.execution_id].end_time = end
@@ -25,7 +25,7 @@ from typing import List
 
 import yaml
 
-from gcpdiag import config, hooks, models, runbook
+from gcpdiag import caching, config, executor, hooks, models, runbook, tracing
 from gcpdiag.queries import apis, kubectl
 from gcpdiag.runbook.exceptions import DiagnosticTreeNotFoundError
 from gcpdiag.runbook.output import api_output, base_output, terminal_output
@@ -164,6 +164,16 @@ def _init_runbook_args_parser():
     ),
   )
 
+  parser.add_argument(
+    '--run-deadline-seconds',
+    metavar='S',
+    type=int,
+    help=(
+      'Stop the API queries that are still running S seconds after the start, the rules or'
+      ' steps depending on them are skipped (default: no deadline)'
+    ),
+  )
+
   parser.add_argument(
     'runbook',
     help='Runbook to execute in the format product/runbook-name or product/name',
@@ -238,6 +248,54 @@ def _init_runbook_args_parser():
     '--reason', type=str, default=config.get('reason'), help='The reason for running gcpdiag'
   )
 
+  parser.add_argument(
+    '--cache-record',
+    action='store_true',
+    help=(
+      'Keep the results of all cached API calls of this execution, to be exported with'
+      ' "gcpdiag cache export"'
+    ),
+  )
+
+  parser.add_argument(
+    '--cache-readonly',
+    action='store_true',
+    help=(
+      'Replay the results of a recorded or imported execution from the cache, without calling'
+      ' the APIs'
+    ),
+  )
+
+  parser.add_argument(
+    '--cache-stats',
+    metavar='FILE',
+    nargs='?',
+    const='-',
+    help=(
+      'Print statistics of the API cache (hits, misses, wait and call time per query) and of'
+      ' the queueing delay per service at exit, or write them as JSON to FILE'
+    ),
+  )
+
+  parser.add_argument(
+    '--cache-share-calls',
+    action='store_true',
+    help=(
+      'Let only one of the gcpdiag processes running in parallel with the same cache directory'
+      ' call an API with given arguments, the others wait for its cached result'
+    ),
+  )
+
+  parser.add_argument(
+    '--trace-file',
+    metavar='FILE',
+    help=(
+      'Record an execution trace (rules or steps, tasks, cached calls, HTTP requests and log'
+      ' queries) and write it as Chrome trace JSON to FILE, to be opened with chrome://tracing'
+      ' or https://ui.perfetto.dev'
+    ),
+  )
+
   return parser
 
 
@@ -344,6 +402,16 @@ def run_and_get_report(argv=None, credentials: str = None) -> dict:
 
   # Initialize configuration
   _init_config(args)
+  caching.configure_session(
+    args.parameter.get('project_id'),
+    record=config.get('cache_record'),
+    readonly=config.get('cache_readonly'),
+  )
+  if config.get('cache_stats'):
+    caching.report_stats_at_exit(config.get('cache_stats'))
+  if config.get('trace_file'):
+    tracing.write_at_exit(config.get('trace_file'))
+  executor.set_run_deadline(config.get('run_deadline_seconds'))
 
   # Initialize Repository, and Tests.
 
@@ -0,0 +1,129 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Execution traces in the Chrome trace event format.
+
+When tracing is started (--trace-file), spans are recorded for the lint rules
+(prepare, prefetch, wait and run), runbook steps, executor tasks, cached API
+calls, HTTP requests and log query pages. The trace can be opened with
+chrome://tracing or https://ui.perfetto.dev to see the critical path of an
+execution and the idle time of the threads.
+
+Format: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+"""
+
+import atexit
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+_lock = threading.Lock()
+# Recorded events, None when tracing is disabled.
+_events: Optional[List[Dict[str, Any]]] = None
+_thread_names: Dict[int, str] = {}
+_origin = time.perf_counter()
+
+
+def enabled() -> bool:
+  return _events is not None
+
+
+def start():
+  """Starts recording spans."""
+  global _events
+  with _lock:
+    if _events is None:
+      _events = []
+
+
+def stop():
+  """Stops recording spans and discards the recorded ones."""
+  global _events
+  with _lock:
+    _events = None
+    _thread_names.clear()
+
+
+def span(name: str, category: str, **args: Any):
+  """Context manager recording the execution of its block as a span of the
+  current thread. Keyword arguments are shown with the span. This is a no-op
+  if tracing isn't started."""
+  if _events is None:
+    return contextlib.nullcontext()
+  return _span(name, category, args)
+
+
+@contextlib.contextmanager
+def _span(name: str, category: str, args: Dict[str, Any]):
+  start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    record(name, category, start_time, time.perf_counter(), **args)
+
+
+def record(name: str, category: str, start_time: float, end_time: float, **args: Any):
+  """Records a span of the current thread, with `start_time` and `end_time` as
+  returned by time.perf_counter()."""
+  thread = threading.current_thread()
+  event = {
+    'name': name,
+    'cat': category,
+    'ph': 'X',
+    'ts': round((start_time - _origin) * 1e6, 1),
+    'dur': round((end_time - start_time) * 1e6, 1),
+    'pid': os.getpid(),
+    'tid': thread.ident,
+  }
+  if args:
+    event['args'] = args
+  with _lock:
+    if _events is None:
+      return
+    _events.append(event)
+    _thread_names.setdefault(thread.ident or 0, thread.name)
+
+
+def get_trace() -> Dict[str, Any]:
+  """Returns the recorded spans as a Chrome trace (JSON object format)."""
+  with _lock:
+    events = list(_events or [])
+    metadata = [
+      {
+        'name': 'thread_name',
+        'ph': 'M',
+        'pid': os.getpid(),
+        'tid': tid,
+        'args': {'name': name},
+      }
+      for tid, name in _thread_names.items()
+    ]
+  return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+
+def write(path: str):
+  """Writes the recorded spans as Chrome trace JSON to `path`."""
+  trace = get_trace()
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(trace, f)
+  logging.info('wrote execution trace (%d events) to %s', len(trace['traceEvents']), path)
+
+
+def write_at_exit(path: str):
+  """Starts recording spans, and writes them to `path` at exit."""
+  start()
+  atexit.register(write, path)
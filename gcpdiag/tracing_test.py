@@ -0,0 +1,77 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Test code in tracing.py."""
+
+import json
+import pathlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from gcpdiag import executor, models, tracing
+
+
+class TracingTest(unittest.TestCase):
+  """Test the recording of execution traces."""
+
+  def setUp(self):
+    tracing.start()
+    self.addCleanup(tracing.stop)
+
+  def test_disabled(self):
+    tracing.stop()
+    with tracing.span('rule', 'run'):
+      pass
+    self.assertFalse(tracing.enabled())
+    self.assertEqual(tracing.get_trace()['traceEvents'], [])
+
+  def test_span(self):
+    with tracing.span('gce/ERR/2021_001', 'run', project='p'):
+      pass
+    (metadata, event) = tracing.get_trace()['traceEvents']
+    self.assertEqual(
+      (event['name'], event['cat'], event['ph'], event['args']),
+      ('gce/ERR/2021_001', 'run', 'X', {'project': 'p'}),
+    )
+    self.assertGreaterEqual(event['dur'], 0)
+    self.assertEqual(metadata['tid'], threading.get_ident())
+    self.assertEqual(metadata['args'], {'name': threading.current_thread().name})
+
+  def test_span_exception(self):
+    with self.assertRaises(ValueError):
+      with tracing.span('failing', 'task'):
+        raise ValueError()
+    self.assertEqual(tracing.get_trace()['traceEvents'][-1]['name'], 'failing')
+
+  def test_executor_tasks(self):
+    pool = executor.ContextAwareExecutor(context=mock.Mock(spec=models.Context))
+    self.assertEqual(pool.submit(len, 'abc').result(10), 3)
+    (event,) = [e for e in tracing.get_trace()['traceEvents'] if e['ph'] == 'X']
+    self.assertEqual((event['name'], event['cat']), ('len', 'task'))
+    self.assertIn('queued_ms', event['args'])
+
+  def test_write(self):
+    with tracing.span('step', 'step'):
+      pass
+    with tempfile.TemporaryDirectory() as d:
+      path = pathlib.Path(d) / 'trace.json'
+      tracing.write(str(path))
+      trace = json.loads(path.read_text(encoding='utf-8'))
+    self.assertEqual(trace['displayTimeUnit'], 'ms')
+    self.assertEqual([e['ph'] for e in trace['traceEvents']], ['M', 'X'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,6 +21,9 @@ for root, dirs, files in os.walk("gcpdiag/runbook"):
       path = os.path.join(root, f)
       a.datas.append((path, path, 'DATA'))
 
+# add the lint rules manifest as data
+a.datas.append(('gcpdiag/lint/rules_manifest.json', 'gcpdiag/lint/rules_manifest.json', 'DATA'))
+
 pyz = PYZ(a.pure, a.zipped_data,
              cipher=block_cipher)
 exe = EXE(pyz,